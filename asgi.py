@@ -0,0 +1,866 @@
+"""Tema 2 SPRC - asynchronous (ASGI) entry point
+
+The read endpoints run on the event loop with an asynchronous database
+pool, so thousands of slow clients only cost coroutines instead of one
+blocked thread each. URL params are validated and queries are built by
+the same functions as in `main`. The write endpoints (and every route
+not listed here) are served by the Flask app of `main` on a small
+thread pool, so their validation and side effects on the in-process
+caches stay shared with the synchronous server.
+"""
+import asyncio
+import re
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import partial, wraps
+from os import getenv
+from urllib.parse import urlencode
+import psycopg
+from a2wsgi import WSGIMiddleware
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from starlette.applications import Starlette
+from starlette.datastructures import Headers, QueryParams
+from starlette.middleware import Middleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MIMEAccept, MultiDict
+from werkzeug.http import (
+    http_date, parse_accept_header, parse_cookie, parse_date, parse_etags,
+    quote_etag
+)
+import compress
+import livefeed
+import main
+import metrics
+import queries
+import tracing
+from cache import response_cache, table_versions
+from database import (
+    DB_PARAMS, REPLICA_CONNECT_TIMEOUT, REPLICA_STICKY_SECONDS, STICKY_COOKIE,
+    replica_health
+)
+from livefeed import live_feed
+from spatial import city_grid
+
+db_pool = AsyncConnectionPool(
+    make_conninfo(
+        host=getenv("DB_HOST", "tema2_db"),
+        dbname=getenv("DB"),
+        user=getenv("DB_USER"),
+        password=getenv("DB_PASSWORD"),
+        port=int(getenv("DB_PORT", "5432")),
+        options=DB_PARAMS["options"]
+    ),
+    min_size=int(getenv("DB_POOL_MIN", "1")),
+    max_size=int(getenv("DB_POOL_MAX", "10")),
+    timeout=float(getenv("DB_POOL_TIMEOUT", "30")),
+    open=False
+)
+
+# read replicas (see database.ReadPool), same settings as the primary
+replica_pools = [
+    AsyncConnectionPool(
+        make_conninfo(
+            host=params["host"],
+            dbname=params["database"],
+            user=params["user"],
+            password=params["password"],
+            port=params["port"],
+            connect_timeout=params["connect_timeout"],
+            options=params["options"]
+        ),
+        min_size=0,
+        max_size=db_pool.max_size,
+        timeout=db_pool.timeout,
+        open=False
+    )
+    for params in replica_health.params
+]
+
+# threads running the Flask handlers (writes)
+WSGI_WORKERS = int(getenv("WSGI_WORKERS", "10"))
+
+# reads of the current request go to the primary (read your writes)
+_primary_reads = ContextVar("primary_reads", default=False)
+
+
+def pool_stats():
+    """Connections in use, requests waiting and size of the async pool"""
+
+    stats = db_pool.get_stats()
+    return [
+        (("in_use",), stats["pool_size"] - stats.get("pool_available", 0)),
+        (("waiting",), stats.get("requests_waiting", 0)),
+        (("max",), stats["pool_max"])
+    ]
+
+metrics.Callback(
+    "db_async_pool_connections",
+    "Connections of the asynchronous pool: in use, waiting requests, size",
+    ("state",),
+    pool_stats
+)
+
+
+def replica_may_lag(*tables):
+    """
+    True if the reads of the current request go to the replicas right
+    after a local write to `tables` (see main.replica_may_lag)
+    """
+
+    return (bool(replica_pools) and not _primary_reads.get()
+            and table_versions.changed_within(REPLICA_STICKY_SECONDS,
+                                              *tables))
+
+
+@asynccontextmanager
+async def read_connection():
+    """
+    Connection for read-only work, from a read replica when possible
+    (see database.ReadPool)
+    """
+
+    index = None
+    if replica_pools and not _primary_reads.get():
+        index = replica_health.pick([
+            stats["pool_size"] - stats.get("pool_available", 0)
+            for stats in (elem.get_stats() for elem in replica_pools)
+        ])
+
+    if index is not None:
+        replica = replica_pools[index]
+        try:
+            # not the pool timeout: the primary serves the read instead of
+            # making it wait for a replica which may be down
+            conn = await replica.getconn(timeout=REPLICA_CONNECT_TIMEOUT)
+        except PoolTimeout:
+            # without a single connection the replica can't be reached
+            if replica.get_stats()["pool_size"] == 0:
+                replica_health.mark_down(index)
+        else:
+            try:
+                yield conn
+            finally:
+                if not conn.closed:
+                    await conn.rollback()
+                await replica.putconn(conn)
+            return
+
+    async with db_pool.connection() as conn:
+        yield conn
+
+async def fetch_all(query, params=None):
+    """Run a query in its own transaction and return every row"""
+
+    async with read_connection() as conn:
+        start = time.perf_counter()
+        cursor = await conn.execute(query, params)
+        rows = await cursor.fetchall()
+        seconds = time.perf_counter() - start
+
+        statement = metrics.statement_label(query)
+        metrics.observe_query(statement, seconds, len(rows))
+        tracing.record(statement, query, params, start, seconds, len(rows))
+        await explain_slow(conn, statement, query, params, seconds,
+                           len(rows))
+        return rows
+
+async def explain_slow(conn, statement, query, params, seconds, rows):
+    """Write a slow read statement with its plan to the slow query log"""
+
+    if not tracing.is_slow(seconds):
+        return
+    if not tracing.explainable(query):
+        tracing.log_slow(statement, query, params, seconds, rows, None)
+        return
+
+    # in a savepoint, so a failure doesn't abort the transaction
+    try:
+        async with conn.transaction():
+            cursor = await conn.execute(tracing.EXPLAIN + query, params)
+            plan = (await cursor.fetchone())[0]
+    except psycopg.Error as err:
+        plan = f"EXPLAIN failed: {err}"
+    tracing.log_slow(statement, query, params, seconds, rows, plan)
+
+def read_args(request):
+    """URL params of a request, with the interface expected by `main`"""
+
+    return MultiDict(request.query_params.multi_items())
+
+def error_response(error):
+    """400 Bad Request with the description of an invalid param"""
+
+    return Response(status_code=400, content=error, media_type="text/html")
+
+def read_format(request, args):
+    """Output format asked for by a request (see main.read_format)"""
+
+    return main.read_format(
+        args, parse_accept_header(request.headers.get("accept"), MIMEAccept)
+    )
+
+def records_response(records, cols, fmt, headers=None):
+    """200 OK with some records in an output format"""
+
+    return Response(
+        status_code=200,
+        content=main.render_records(records, cols, fmt),
+        media_type=main.FORMATS[fmt],
+        headers=headers
+    )
+
+async def stream_records(select, cols, params=None, fmt="json"):
+    """
+    Send the result of a query in an output format, chunk by chunk,
+    through a server-side cursor, its transaction ending after
+    STREAM_IDLE_TIMEOUT seconds without progress (see main.stream_records)
+    """
+
+    query = main.stream_query(select, cols, fmt) + ";"
+
+    async def generate():
+        async with read_connection() as conn:
+            await conn.execute(main.STREAM_IDLE_SQL, (main.STREAM_IDLE_MS,))
+            async with conn.cursor(name="stream_records") as cursor:
+                started = start = time.perf_counter()
+                await cursor.execute(query, params)
+                rows = await cursor.fetchmany(main.STREAM_CHUNK_SIZE)
+                seconds = time.perf_counter() - start
+                count = len(rows)
+                metrics.observe_query("stream", seconds, count)
+
+                # the query ran fine, the response can be started
+                yield None
+
+                for chunk in main.encode_chunks(rows, cols, fmt):
+                    yield chunk
+                while rows:
+                    start = time.perf_counter()
+                    rows = await cursor.fetchmany(main.STREAM_CHUNK_SIZE)
+                    metrics.observe_query(
+                        "stream_fetch", time.perf_counter() - start,
+                        len(rows)
+                    )
+                    seconds += time.perf_counter() - start
+                    count += len(rows)
+
+                    for chunk in main.encode_chunks(
+                            rows, cols, fmt, first=False):
+                        yield chunk
+
+                # traced as a whole: DECLARE plus fetches
+                tracing.record(
+                    "stream", query, params, started, seconds, count
+                )
+                await explain_slow(
+                    conn, "stream", query, params, seconds, count
+                )
+
+    # run the query now so errors are reported before the status is sent
+    chunks = generate()
+    await chunks.__anext__()
+
+    return StreamingResponse(chunks, media_type=main.FORMATS[fmt])
+
+async def send_page(request, args, select, conds, page, cols,
+                    time_keyed=False, fmt="json"):
+    """Send one page of a listing (see main.page_query)"""
+
+    query, params = main.page_query(select, conds, page, time_keyed)
+    res = await fetch_all(query, params)
+
+    base_url = str(request.url.replace(query=""))
+    records, headers = main.page_result(
+        res, page, cols, args, base_url, time_keyed
+    )
+    return records_response(records, cols, fmt, headers)
+
+async def send_list(request, select, conds, cols):
+    """Send every row of a listing or, with `limit`/`after`, one page"""
+
+    args = read_args(request)
+    fmt, error = read_format(request, args)
+    if error:
+        return error_response(error)
+
+    page, error = main.read_page_args(args)
+    if error:
+        return error_response(error)
+    if page:
+        return await send_page(
+            request, args, select, conds, page, cols, fmt=fmt
+        )
+
+    clause, params = main.where(conds)
+    if fmt != "json":
+        return await stream_records(select + clause, cols, params, fmt)
+
+    # the JSON array is built by the database
+    res = await fetch_all(queries.json_array(select + clause) + ";", params)
+    return Response(
+        status_code=200, content=res[0][0], media_type="application/json"
+    )
+
+def conditional(table):
+    """
+    Answer conditional GET requests for data read from `table` with
+    304 Not Modified while the table is unchanged (see main.conditional)
+    """
+
+    def decorator(handler):
+
+        @wraps(handler)
+        async def wrapper(request):
+            etag, last_modified = table_versions.get(table)
+            lagging = replica_may_lag(table)
+            # every output format is a separate representation
+            fmt, _ = read_format(request, read_args(request))
+            if fmt and fmt != "json":
+                etag = f"{etag}-{fmt}"
+
+            if main.is_fresh(
+                    etag, last_modified,
+                    parse_etags(request.headers.get("if-none-match")),
+                    parse_date(request.headers.get("if-modified-since"))):
+                response = Response(status_code=304)
+            else:
+                response = await handler(request)
+                if response.status_code != 200 or lagging:
+                    return response
+
+            response.headers["ETag"] = quote_etag(etag)
+            response.headers["Last-Modified"] = http_date(last_modified)
+            response.headers["Vary"] = "Accept"
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+@conditional("Tari")
+async def get_countries(request):
+    """handle GET request for countries"""
+
+    return await send_list(
+        request, queries.COUNTRY_SELECT, [], main.COUNTRY_COLS
+    )
+
+@conditional("Orase")
+async def get_cities(request):
+    """handle GET request for cities"""
+
+    return await send_list(
+        request, queries.CITY_SELECT, [], main.CITY_COLS
+    )
+
+@conditional("Orase")
+async def get_cities_by_country(request):
+    """handle GET request for cities from a certain country"""
+
+    req_id = request.path_params["req_id"]
+    return await send_list(
+        request, queries.CITY_SELECT, [("idTara = %s", [req_id])],
+        main.CITY_COLS
+    )
+
+
+async def query_temperatures(request, args, city_conds, time_conds,
+                             scope, fmt):
+    """
+    Send the temperature readings matching the city and time conditions
+    (see main.query_temperatures)
+    """
+
+    aggregate, error = main.read_aggregate_args(args)
+    if error:
+        return error_response(error)
+    if aggregate:
+        bucket, aggs = aggregate
+        res = await fetch_all(*main.aggregate_query(
+            city_conds, time_conds, scope, bucket, aggs, args
+        ))
+        return records_response(
+            main.aggregate_records(res, aggs), ["bucket"] + aggs, fmt
+        )
+
+    conds = list(city_conds) + list(time_conds)
+
+    page, error = main.read_page_args(args, time_keyed=True)
+    if error:
+        return error_response(error)
+    if page:
+        return await send_page(
+            request, args, main.TEMP_PAGE_SELECT, conds, page,
+            main.TEMP_COLS, time_keyed=True, fmt=fmt
+        )
+
+    clause, params = main.where(conds)
+    return await stream_records(
+        main.TEMP_SELECT + clause, main.TEMP_COLS, params, fmt
+    )
+
+async def capture_stream(chunks, store):
+    """
+    Pass a streamed body through, handing it to `store` once completely
+    sent, unless it grew too large to be cached
+    """
+
+    parts = []
+    size = 0
+    try:
+        async for chunk in chunks:
+            if parts is not None:
+                data = chunk.encode() if isinstance(chunk, str) else chunk
+                size += len(data)
+                if size > response_cache.max_entry_bytes:
+                    parts = None
+                else:
+                    parts.append(data)
+            yield chunk
+    finally:
+        await chunks.aclose()
+
+    if parts is not None:
+        store(b"".join(parts))
+
+async def send_temperatures(request, args, city_conds, time_conds, scope,
+                            tags, fmt):
+    """
+    Send the temperature readings matching the city and time conditions
+    through the response cache (see main.send_temperatures)
+    """
+
+    if (not response_cache.enabled or _primary_reads.get()
+            or replica_may_lag("Temperaturi", "Orase", "Tari")):
+        return await query_temperatures(
+            request, args, city_conds, time_conds, scope, fmt
+        )
+
+    params = urlencode(sorted(args.items(multi=True)))
+    key = f"{request.url.path}?{params} {fmt}"
+    entry = response_cache.get(key)
+    if entry:
+        response = Response(
+            status_code=200,
+            content=entry.body,
+            media_type=entry.mimetype,
+            headers=entry.headers
+        )
+        response.headers["X-Cache"] = "HIT"
+        return response
+
+    sequence = response_cache.sequence
+    response = await query_temperatures(
+        request, args, city_conds, time_conds, scope, fmt
+    )
+    response.headers["X-Cache"] = "MISS"
+    if response.status_code != 200:
+        return response
+
+    headers = {
+        k: response.headers[k] for k in ("X-Next-Cursor", "Link")
+        if k in response.headers
+    }
+    store = partial(
+        response_cache.put,
+        key,
+        mimetype=response.media_type,
+        headers=headers,
+        tags=tags,
+        sequence=sequence
+    )
+
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = capture_stream(response.body_iterator, store)
+    else:
+        store(response.body)
+
+    return response
+
+async def get_temperatures(request):
+    """handle GET request for temperatures"""
+
+    args = read_args(request)
+    time_conds, error = main.read_time_args(args)
+    if error:
+        return error_response(error)
+
+    area, error = main.read_area_args(args)
+    if error:
+        return error_response(error)
+
+    fmt, error = read_format(request, args)
+    if error:
+        return error_response(error)
+
+    city_conds = []
+    tags = ["all"]
+    if area:
+        # the grid is (re)loaded here, so the lookup never needs a cursor
+        async with request.app.state.grid_lock:
+            if city_grid.stale:
+                built_at = time.monotonic()
+                city_grid.load(
+                    await fetch_all("SELECT id, lat, lon FROM Orase;"),
+                    built_at
+                )
+        city_conds, tags = main.area_filter(area(None))
+
+    return await send_temperatures(
+        request, args, city_conds, time_conds, ("AgregateOrase", city_conds),
+        tags, fmt
+    )
+
+async def get_city_temperatures(request):
+    """handle GET request for city temperatures"""
+
+    req_id = request.path_params["req_id"]
+    args = read_args(request)
+    time_conds, error = main.read_time_args(args)
+    if error:
+        return error_response(error)
+
+    fmt, error = read_format(request, args)
+    if error:
+        return error_response(error)
+
+    city_conds = [("idOras = %s", [req_id])]
+
+    return await send_temperatures(
+        request, args, city_conds, time_conds, ("AgregateOrase", city_conds),
+        [("city", req_id)], fmt
+    )
+
+async def get_country_temperatures(request):
+    """handle GET request for country temperatures"""
+
+    req_id = request.path_params["req_id"]
+    args = read_args(request)
+    time_conds, error = main.read_time_args(args)
+    if error:
+        return error_response(error)
+
+    fmt, error = read_format(request, args)
+    if error:
+        return error_response(error)
+
+    city_conds = [
+        ("idOras IN (SELECT id FROM Orase WHERE idTara = %s)", [req_id])
+    ]
+
+    return await send_temperatures(
+        request, args, city_conds, time_conds,
+        ("AgregateTari", [("idTara = %s", [req_id])]),
+        [("country", req_id), "countries"], fmt
+    )
+
+async def get_temperature_stream(request):
+    """Live feed of reading changes (see main.get_temperature_stream)"""
+
+    if not livefeed.LIVE_FEED_ENABLED:
+        return Response(status_code=404, content="live feed disabled")
+
+    city_ids, country_ids, error = main.read_feed_args(read_args(request))
+    if error:
+        return error_response(error)
+
+    if live_feed.full():
+        return Response(
+            status_code=503,
+            content="Error: too many live feed subscribers, retry later",
+            headers={"Retry-After": "5"}
+        )
+
+    async def generate():
+        try:
+            subscriber = live_feed.subscribe(
+                city_ids, country_ids, asyncio.get_running_loop()
+            )
+        except livefeed.TooManySubscribers:
+            return
+        try:
+            yield livefeed.RETRY
+            async for text in subscriber.amessages():
+                yield text
+        finally:
+            live_feed.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        generate(), media_type="text/event-stream", headers=livefeed.HEADERS
+    )
+
+
+class MetricsMiddleware:
+    """
+    Record the duration and size of the responses of the asynchronous
+    routes (the Flask app records the routes it serves itself)
+    """
+
+    def __init__(self, asgi_app):
+        self.app = asgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status, size = 500, 0
+
+        async def send_measured(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_measured)
+        finally:
+            route = scope.get("route")
+            if isinstance(route, Route):
+                metrics.observe_request(
+                    route_label(route.path), scope["method"], status,
+                    time.perf_counter() - started, size
+                )
+
+class TraceMiddleware:
+    """
+    Collect the SQL statements of each request (see tracing), sending
+    them in the X-SQL-Trace header when the client asked for it
+    """
+
+    def __init__(self, asgi_app):
+        self.app = asgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        traced = tracing.requested(
+            Headers(scope=scope), QueryParams(scope["query_string"])
+        )
+        tracing.begin(scope["path"], traced)
+        if not traced:
+            await self.app(scope, receive, send)
+            return
+
+        # the statements of a streamed body run while it is sent, so the
+        # response is held back until complete (traced requests only)
+        messages = []
+        passed = False
+
+        async def hold(message):
+            nonlocal passed
+            if message["type"] == "http.response.start" and any(
+                    key.lower() == b"content-type"
+                    and value.startswith(b"text/event-stream")
+                    for key, value in message.get("headers", [])):
+                # event streams never end, they are sent without a trace
+                passed = True
+            if passed:
+                await send(message)
+            else:
+                messages.append(message)
+
+        await self.app(scope, receive, hold)
+        trace = tracing.end()
+        if passed:
+            return
+
+        start = messages[0]
+        headers = list(start.get("headers", []))
+        # routes served by Flask send their own trace
+        name = tracing.TRACE_HEADER.lower().encode()
+        if all(key.lower() != name for key, _ in headers):
+            headers.append((name, tracing.header(trace).encode()))
+        start["headers"] = headers
+
+        for message in messages:
+            await send(message)
+
+class CompressionMiddleware:
+    """
+    Compress textual bodies for clients accepting it (see compress),
+    streamed ones chunk by chunk while they are sent
+    """
+
+    def __init__(self, asgi_app):
+        self.app = asgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not compress.COMPRESS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        encoding = compress.choose_encoding(
+            Headers(scope=scope).get("accept-encoding")
+        )
+
+        start = None
+        head = []
+        size = 0
+        compressor = None
+
+        async def send_start(headers, encoded):
+            headers = [(key, value) for key, value in headers
+                       if not encoded or key.lower() != b"content-length"]
+            if encoded:
+                headers.append((b"content-encoding", encoding.encode()))
+            await send(dict(start, headers=headers))
+
+        async def compressing(message):
+            nonlocal start, size, compressor
+
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message.get("headers", []))
+                if (message["status"] != 200 or "content-encoding" in headers
+                        or not compress.compressible(
+                            headers.get("content-type", "").split(";")[0]
+                        )):
+                    await send(message)
+                    return
+                if encoding is None:
+                    await send(dict(message, headers=vary_encoding(
+                        message.get("headers", [])
+                    )))
+                    return
+                start = message
+                return
+
+            if start is None or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            more = message.get("more_body", False)
+            if compressor is None:
+                # small bodies aren't worth it, the start of the body tells
+                head.append(message.get("body", b""))
+                size += len(head[-1])
+                if size < compress.COMPRESS_MIN_SIZE and more:
+                    return
+
+                headers = vary_encoding(start.get("headers", []))
+                if size < compress.COMPRESS_MIN_SIZE:
+                    await send_start(headers, False)
+                    await send({"type": "http.response.body",
+                                "body": b"".join(head), "more_body": more})
+                    start = None
+                    return
+
+                await send_start(weak_etag(headers), True)
+                compressor = compress.Compressor(encoding)
+                body = compressor.compress(b"".join(head))
+            else:
+                body = compressor.compress(message.get("body", b""))
+
+            if not more:
+                body += compressor.finish()
+            await send({"type": "http.response.body", "body": body,
+                        "more_body": more})
+
+        await self.app(scope, receive, compressing)
+
+def vary_encoding(headers):
+    """Response headers with Accept-Encoding added to Vary"""
+
+    headers = list(headers)
+    for pos, (key, value) in enumerate(headers):
+        if key.lower() == b"vary":
+            # the routes served by Flask have it already
+            if b"accept-encoding" not in value.lower():
+                headers[pos] = (key, value + b", Accept-Encoding")
+            return headers
+    headers.append((b"vary", b"Accept-Encoding"))
+    return headers
+
+def weak_etag(headers):
+    """Response headers with a weak ETag: same content, other bytes"""
+
+    return [(key, b"W/" + value)
+            if key.lower() == b"etag" and not value.startswith(b"W/")
+            else (key, value) for key, value in headers]
+
+class StickyReadsMiddleware:
+    """
+    Send the reads of a client which just wrote to the primary (see
+    main.stick_to_primary)
+    """
+
+    def __init__(self, asgi_app):
+        self.app = asgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            cookies = parse_cookie(Headers(scope=scope).get("cookie"))
+            _primary_reads.set(STICKY_COOKIE in cookies)
+        await self.app(scope, receive, send)
+
+def route_label(path):
+    """Route path in the Flask syntax ({id:int} -> <int:id>)"""
+
+    return re.sub(r"\{(\w+):(\w+)\}", r"<\2:\1>", path)
+
+
+@asynccontextmanager
+async def lifespan(asgi_app):
+    """Open the database pool for the lifetime of the server"""
+
+    asgi_app.state.grid_lock = asyncio.Lock()
+    await db_pool.open()
+    for elem in replica_pools:
+        # connections are opened in the background, a replica which is
+        # down doesn't keep the server from starting
+        await elem.open(wait=False)
+    try:
+        yield
+    finally:
+        for elem in replica_pools:
+            await elem.close()
+        await db_pool.close()
+
+
+app = Starlette(
+    routes=[
+        Route("/api/countries", get_countries, methods=["GET"]),
+        Route("/api/cities", get_cities, methods=["GET"]),
+        Route(
+            "/api/cities/country/{req_id:int}", get_cities_by_country,
+            methods=["GET"]
+        ),
+        Route("/api/temperatures", get_temperatures, methods=["GET"]),
+        Route(
+            "/api/temperatures/stream", get_temperature_stream,
+            methods=["GET"]
+        ),
+        Route(
+            "/api/temperatures/cities/{req_id:int}", get_city_temperatures,
+            methods=["GET"]
+        ),
+        Route(
+            "/api/temperatures/countries/{req_id:int}",
+            get_country_temperatures, methods=["GET"]
+        ),
+        # everything else (writes, cache stats) is handled by Flask
+        Mount("", app=WSGIMiddleware(main.app, workers=WSGI_WORKERS))
+    ],
+    middleware=[
+        Middleware(MetricsMiddleware),
+        Middleware(TraceMiddleware),
+        Middleware(StickyReadsMiddleware),
+        Middleware(CompressionMiddleware)
+    ],
+    lifespan=lifespan
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=5000)
@@ -0,0 +1,642 @@
+"""
+Load tests of the server: throughput and latency per endpoint
+
+    seed       insert a synthetic dataset (countries, cities, readings)
+    run        replay a weighted workload of requests at a given concurrency
+    compare    compare two saved results and report the regressions
+    serialize  CPU time spent turning readings into JSON, in Python and in
+               the database
+
+Every client is a coroutine opening its own connection per request, so
+a single process can keep thousands of requests in flight. `--slow`
+makes clients read the response in small pieces with a pause between
+them, like clients on a slow network.
+
+The workload (workload.jsonl by default) holds one request template per
+line:
+
+    {"name": "GET /api/cities/country/:id", "method": "GET",
+     "path": "/api/cities/country/{country_id}", "weight": 3}
+
+`body` (any JSON value) and `path` may contain placeholders, a string
+made of a single placeholder is replaced by a value of the right JSON
+type. The placeholders of one request share their values:
+
+    country_id, city_id, reading_id     existing ids, read before the run
+    created_country_id, ...             ids created by this run, from the
+                                        requests with "save": "country"
+                                        ("forget": "country" drops the id
+                                        after the request, e.g. DELETE);
+                                        requests are skipped until one
+                                        exists
+    uid, value, lat, lon, bbox          random name suffix / data
+    date, date_to                       random week of the last `--days`
+
+Comparing the synchronous and the asynchronous server, then two commits:
+
+    python3 benchmark.py seed --countries 50 --cities 2000 \\
+        --readings 1000000
+    python3 benchmark.py run --url sync=http://localhost:5000 \\
+        --url async=http://localhost:5001 --concurrency 500 \\
+        --output before.json
+    python3 benchmark.py compare before.json after.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+
+DEFAULT_WORKLOAD = "workload.jsonl"
+
+# statuses counted as failures (None = no response at all)
+ERROR_STATUSES = (None,) + tuple(range(500, 600))
+
+
+class Skip(Exception):
+    """The request needs an id which doesn't exist (yet)"""
+
+
+class Context(dict):
+    """Placeholder values of one request, drawn on first use"""
+
+    def __init__(self, rng, ids, created, days):
+        super().__init__()
+        self.rng = rng
+        self.ids = ids
+        self.created = created
+        self.days = days
+
+    def __missing__(self, name):
+        rng = self.rng
+
+        if name in ("country_id", "city_id", "reading_id"):
+            kind = name[:-3]
+            candidates = self.ids[kind] or self.created[kind]
+            if not candidates:
+                raise Skip(name)
+            value = rng.choice(candidates)
+        elif name.startswith("created_"):
+            kind = name[len("created_"):-3]
+            if not self.created[kind]:
+                raise Skip(name)
+            value = rng.choice(self.created[kind])
+        elif name == "uid":
+            value = uuid.UUID(int=rng.getrandbits(128)).hex[:12]
+        elif name == "value":
+            value = round(rng.uniform(-20.0, 40.0), 1)
+        elif name == "lat":
+            value = round(rng.uniform(-80.0, 80.0), 4)
+        elif name == "lon":
+            value = round(rng.uniform(-180.0, 170.0), 4)
+        elif name == "bbox":
+            lat, lon = self["lat"], self["lon"]
+            value = f"{lat},{lon},{lat + 10},{lon + 10}"
+        elif name == "date":
+            start = date.today() - timedelta(days=rng.randrange(self.days))
+            value = start.isoformat()
+        elif name == "date_to":
+            start = date.fromisoformat(self["date"])
+            value = (start + timedelta(days=7)).isoformat()
+        else:
+            raise KeyError(name)
+
+        self[name] = value
+        return value
+
+    def fill(self, template):
+        """Replace the placeholders of a path or body template"""
+
+        if isinstance(template, dict):
+            return {k: self.fill(v) for k, v in template.items()}
+        if isinstance(template, list):
+            return [self.fill(elem) for elem in template]
+        if isinstance(template, str):
+            name = template[1:-1]
+            if (template.startswith("{") and template.endswith("}")
+                    and name.isidentifier()):
+                return self[name]
+            return template.format_map(self)
+        return template
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of already sorted values"""
+
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, round(fraction * len(values)) - 1))
+    return values[index]
+
+
+def load_workload(path):
+    """Request templates of a workload file, with default fields"""
+
+    entries = []
+    with open(path) as workload:
+        for line in workload:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            entry.setdefault("method", "GET")
+            entry.setdefault("name", f"{entry['method']} {entry['path']}")
+            entry.setdefault("weight", 1)
+            entries.append(entry)
+
+    return entries
+
+
+def load_ids(base, limit=10000):
+    """Ids of (some of) the existing countries, cities and readings"""
+
+    ids = {}
+    for kind, path in (("country", "/api/countries"),
+                       ("city", "/api/cities"),
+                       ("reading", "/api/temperatures")):
+        with urlopen(f"{base}{path}?limit={limit}") as response:
+            ids[kind] = [elem["id"] for elem in json.load(response)]
+
+    return ids
+
+
+async def fetch(host, port, method, path, body, slow, keep_body):
+    """
+    Send one request on a new connection and read the whole response
+
+    Only the beginning of the response is kept, unless `keep_body` is
+    set, so large listings don't pile up in memory.
+
+    Returns
+    -------
+        status: int
+            HTTP status code of the response
+
+        body: bytes
+            raw response body (possibly chunk encoded or truncated)
+    """
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        headers = f"Host: {host}:{port}\r\nConnection: close\r\n"
+        payload = b""
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers += ("Content-Type: application/json\r\n"
+                        f"Content-Length: {len(payload)}\r\n")
+        writer.write(
+            f"{method} {path} HTTP/1.1\r\n{headers}\r\n".encode() + payload
+        )
+        await writer.drain()
+
+        parts = []
+        while True:
+            data = await reader.read(1024 if slow else 65536)
+            if not data:
+                break
+            if keep_body or not parts:
+                parts.append(data)
+            if slow:
+                await asyncio.sleep(slow)
+    finally:
+        writer.close()
+
+    head, _, content = b"".join(parts).partition(b"\r\n\r\n")
+    return int(head.split(None, 2)[1]), content
+
+
+async def client(target, entries, weights, settings, ids, created,
+                 results, index):
+    """Send requests from the workload back to back until the deadline"""
+
+    host, port = target
+    rng = random.Random(settings["seed"] * 100003 + index)
+
+    while time.monotonic() < settings["deadline"]:
+        entry = rng.choices(entries, weights)[0]
+        context = Context(rng, ids, created, settings["days"])
+        try:
+            path = context.fill(entry["path"])
+            body = context.fill(entry.get("body"))
+        except Skip:
+            results[entry["name"]]["skipped"] += 1
+            await asyncio.sleep(0)
+            continue
+
+        forget = entry.get("forget")
+        if forget:
+            # no other client may use an id which is being deleted
+            created_id = context[f"created_{forget}_id"]
+            if created_id in created[forget]:
+                created[forget].remove(created_id)
+
+        start = time.monotonic()
+        try:
+            status, content = await fetch(
+                host, port, entry["method"], path, body, settings["slow"],
+                keep_body=bool(entry.get("save"))
+            )
+        except (OSError, ValueError, IndexError):
+            status, content = None, b""
+        latency = time.monotonic() - start
+
+        if start >= settings["measure"]:
+            results[entry["name"]]["samples"].append((status, latency))
+
+        if entry.get("save") and status == 201:
+            try:
+                created[entry["save"]].append(json.loads(content)["id"])
+            except (ValueError, KeyError, TypeError):
+                pass
+
+
+async def run(base, entries, settings):
+    """
+    Load one server with the workload
+
+    Returns
+    -------
+        results: Dict[str, Dict[str, Any]]
+            (status, seconds) of every measured request and number of
+            skipped requests, per workload entry
+    """
+
+    parts = urlsplit(base)
+    target = (parts.hostname, parts.port or 80)
+
+    ids = load_ids(base)
+    created = {"country": [], "city": [], "reading": []}
+    results = {
+        entry["name"]: {"samples": [], "skipped": 0} for entry in entries
+    }
+    weights = [entry["weight"] for entry in entries]
+
+    now = time.monotonic()
+    settings = dict(
+        settings,
+        measure=now + settings["warmup"],
+        deadline=now + settings["warmup"] + settings["duration"]
+    )
+    await asyncio.gather(*(
+        client(target, entries, weights, settings, ids, created, results,
+               index)
+        for index in range(settings["concurrency"])
+    ))
+
+    return results
+
+
+def summarize(samples, duration):
+    """Throughput, errors, status counts and latency percentiles"""
+
+    latencies = sorted(
+        latency for status, latency in samples
+        if status not in ERROR_STATUSES
+    )
+    statuses = {}
+    for status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    def millis(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "requests": len(samples),
+        "errors": len(samples) - len(latencies),
+        "throughput": round(len(samples) / duration, 2),
+        "statuses": statuses,
+        "mean_ms": millis(sum(latencies) / len(latencies))
+                   if latencies else None,
+        "p50_ms": millis(percentile(latencies, 0.50)),
+        "p95_ms": millis(percentile(latencies, 0.95)),
+        "p99_ms": millis(percentile(latencies, 0.99)),
+        "max_ms": millis(latencies[-1] if latencies else None)
+    }
+
+
+def report(name, endpoints):
+    """Print the summary of one run"""
+
+    def fmt(value):
+        return f"{value:9.1f}" if value is not None else f"{'-':>9}"
+
+    print(f"== {name}")
+    print(f"{'endpoint':44} {'req/s':>8} {'errors':>7}"
+          f" {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+
+    for endpoint, stats in endpoints.items():
+        print(f"{endpoint[:44]:44} {stats['throughput']:8.1f}"
+              f" {stats['errors']:7}"
+              f" {fmt(stats['p50_ms'])} {fmt(stats['p95_ms'])}"
+              f" {fmt(stats['p99_ms'])}")
+
+
+def git_commit():
+    """Commit the results are measured for, None outside a repository"""
+
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def command_run(args):
+    """Replay the workload against every --url and save the results"""
+
+    if args.path:
+        entries = [{"name": f"GET {path}", "method": "GET", "path": path,
+                    "weight": 1} for path in args.path]
+    else:
+        entries = load_workload(args.workload)
+
+    settings = {
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "slow": args.slow,
+        "seed": args.seed,
+        "days": args.days
+    }
+
+    output = {
+        "commit": git_commit(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "workload": None if args.path else args.workload,
+        "settings": settings,
+        "runs": {}
+    }
+
+    for url in args.url:
+        name, _, base = url.rpartition("=")
+        name = name or base
+        results = asyncio.run(run(base, entries, settings))
+
+        endpoints = {}
+        samples = []
+        for entry, res in results.items():
+            endpoints[entry] = summarize(res["samples"], args.duration)
+            endpoints[entry]["skipped"] = res["skipped"]
+            samples.extend(res["samples"])
+
+        output["runs"][name] = {
+            "url": base,
+            "total": summarize(samples, args.duration),
+            "endpoints": endpoints
+        }
+        report(name, dict(endpoints, TOTAL=output["runs"][name]["total"]))
+
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(output, out, indent=2)
+
+
+def command_compare(args):
+    """
+    Print the changes between two saved results, exit with status 1 when
+    the throughput of an endpoint dropped or its p99 latency grew by more
+    than `threshold`, or it failed more often
+    """
+
+    with open(args.baseline) as baseline:
+        old = json.load(baseline)
+    with open(args.candidate) as candidate:
+        new = json.load(candidate)
+
+    print(f"baseline {old.get('commit')} -> candidate {new.get('commit')}")
+
+    def change(before, after):
+        if not before or after is None:
+            return None
+        return (after - before) / before
+
+    def error_rate(stats):
+        return stats["errors"] / max(stats["requests"], 1)
+
+    regressions = 0
+    for run_name, new_run in new["runs"].items():
+        old_run = old["runs"].get(run_name)
+        if old_run is None:
+            continue
+
+        print(f"== {run_name}")
+        print(f"{'endpoint':44} {'req/s':>9} {'p50':>9} {'p99':>9}")
+        endpoints = dict(new_run["endpoints"], TOTAL=new_run["total"])
+        old_endpoints = dict(old_run["endpoints"], TOTAL=old_run["total"])
+
+        for endpoint, stats in endpoints.items():
+            before = old_endpoints.get(endpoint)
+            if before is None:
+                continue
+
+            deltas = (
+                change(before["throughput"], stats["throughput"]),
+                change(before["p50_ms"], stats["p50_ms"]),
+                change(before["p99_ms"], stats["p99_ms"])
+            )
+            slower = (
+                (deltas[0] is not None and deltas[0] < -args.threshold)
+                or (deltas[2] is not None and deltas[2] > args.threshold)
+                or error_rate(stats) > error_rate(before)
+            )
+            regressions += slower
+
+            print(f"{endpoint[:44]:44} " + " ".join(
+                f"{delta:+9.1%}" if delta is not None else f"{'-':>9}"
+                for delta in deltas
+            ) + ("  REGRESSION" if slower else ""))
+
+    sys.exit(1 if regressions else 0)
+
+
+def command_seed(args):
+    """Insert the synthetic dataset straight into the database"""
+
+    # imported here so running the load needs no database access
+    import partitions
+    import rollup
+    from database import pool
+
+    token = uuid.uuid4().hex[:6]
+    with pool.transaction() as cursor:
+        cursor.execute("SET LOCAL statement_timeout = 0;")
+        if args.reset:
+            cursor.execute(
+                "TRUNCATE Tari, Orase, Temperaturi, AgregateOrase,"
+                " AgregateTari RESTART IDENTITY CASCADE;"
+            )
+
+        cursor.execute(
+            "INSERT INTO Tari(nume, lat, lon)"
+            " SELECT 'Tara ' || %s || '-' || i, random() * 160 - 80,"
+            " random() * 360 - 180 FROM generate_series(1, %s) i"
+            " RETURNING id;",
+            (token, args.countries)
+        )
+        country_ids = [elem[0] for elem in cursor.fetchall()]
+
+        # cities are spread evenly over the new countries, around them
+        cursor.execute(
+            "INSERT INTO Orase(idTara, nume, lat, lon)"
+            " SELECT t.id, 'Oras ' || %s || '-' || i,"
+            " LEAST(GREATEST(t.lat + random() * 10 - 5, -90), 90),"
+            " LEAST(GREATEST(t.lon + random() * 10 - 5, -180), 180)"
+            " FROM generate_series(0, %s - 1) i"
+            " JOIN Tari t ON t.id = (%s::int[])[1 + i %% %s]"
+            " RETURNING id;",
+            (token, args.cities, country_ids, len(country_ids))
+        )
+        city_ids = [elem[0] for elem in cursor.fetchall()]
+
+        # the readings of every city are evenly spaced over the last
+        # `days` days, which keeps (timestamp, idOras) unique
+        per_city = -(-args.readings // max(len(city_ids), 1))
+        step = args.days * 86400.0 / max(per_city, 1)
+        partitions.create(
+            cursor, date.today() - timedelta(days=args.days), date.today()
+        )
+        cursor.execute(
+            "INSERT INTO Temperaturi(idOras, valoare, timestamp)"
+            " SELECT (%s::int[])[1 + i %% %s],"
+            " round((15 + 10 * sin(i) + random() * 10)::numeric, 1),"
+            " date_trunc('second', now()::timestamp)"
+            " - make_interval(days => %s)"
+            " + make_interval(secs => (i / %s) * %s)"
+            " FROM generate_series(0, %s - 1) i;",
+            (city_ids, len(city_ids), args.days, len(city_ids), step,
+             args.readings)
+        )
+
+        rollup.rebuild(cursor)
+
+    print(f"inserted {len(country_ids)} countries, {len(city_ids)} cities,"
+          f" {args.readings} readings")
+
+
+def command_serialize(args):
+    """Compare the CPU time of JSON built in Python and by the database"""
+
+    # both variants stream the same readings through a server-side cursor,
+    # "python" builds a dict and calls json.dumps per row (as the handlers
+    # used to), "database" joins the row_to_json texts
+
+    # imported here so running the load needs no database access
+    import main as server
+    import queries
+    from database import pool
+
+    select = f"{server.TEMP_SELECT} LIMIT {int(args.rows)}"
+
+    def python_chunks(rows):
+        return ",".join(
+            json.dumps({k:v for k, v in zip(server.TEMP_COLS, elem)})
+            for elem in rows
+        )
+
+    def database_chunks(rows):
+        return ",".join([elem[0] for elem in rows])
+
+    variants = [
+        ("python", select, python_chunks),
+        ("database", queries.json_rows(select), database_chunks)
+    ]
+
+    for name, query, encode in variants:
+        best = None
+        for _ in range(args.repeat):
+            with pool.connection() as conn:
+                with conn.cursor(name="serialize") as cursor:
+                    cpu, wall = time.process_time(), time.perf_counter()
+                    cursor.execute(query)
+                    count = size = 0
+                    rows = cursor.fetchmany(server.STREAM_CHUNK_SIZE)
+                    while rows:
+                        count += len(rows)
+                        size += len(encode(rows))
+                        rows = cursor.fetchmany(server.STREAM_CHUNK_SIZE)
+                    cpu = time.process_time() - cpu
+                    wall = time.perf_counter() - wall
+            if best is None or cpu < best[0]:
+                best = (cpu, wall)
+
+        scale = 100000 / max(count, 1)
+        print(f"{name:>8}: {count} rows, {size} bytes,"
+              f" {best[0] * scale * 1000:.0f} ms CPU and"
+              f" {best[1] * scale * 1000:.0f} ms total per 100k rows")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed = commands.add_parser("seed", help=command_seed.__doc__)
+    seed.add_argument("--countries", type=int, default=20)
+    seed.add_argument("--cities", type=int, default=500)
+    seed.add_argument("--readings", type=int, default=100000)
+    seed.add_argument("--days", type=int, default=30)
+    seed.add_argument(
+        "--reset", action="store_true", help="delete all the data first"
+    )
+    seed.set_defaults(handler=command_seed)
+
+    run_cmd = commands.add_parser("run", help=command_run.__doc__)
+    run_cmd.add_argument(
+        "--url", action="append", required=True,
+        help="[name=]base URL of a server, can be repeated"
+    )
+    run_cmd.add_argument("--workload", default=DEFAULT_WORKLOAD)
+    run_cmd.add_argument(
+        "--path", action="append",
+        help="GET this path instead of the workload, can be repeated"
+    )
+    run_cmd.add_argument("--concurrency", type=int, default=100)
+    run_cmd.add_argument("--duration", type=float, default=30.0)
+    run_cmd.add_argument(
+        "--warmup", type=float, default=5.0,
+        help="seconds of load before measuring"
+    )
+    run_cmd.add_argument(
+        "--slow", type=float, default=0.0,
+        help="seconds clients wait after reading each 1 KiB of a response"
+    )
+    run_cmd.add_argument("--seed", type=int, default=1)
+    run_cmd.add_argument(
+        "--days", type=int, default=30,
+        help="days covered by the {date} placeholder"
+    )
+    run_cmd.add_argument("--output", help="save the results as JSON")
+    run_cmd.set_defaults(handler=command_run)
+
+    compare = commands.add_parser("compare", help=command_compare.__doc__)
+    compare.add_argument("baseline")
+    compare.add_argument("candidate")
+    compare.add_argument(
+        "--threshold", type=float, default=0.1,
+        help="relative change counted as a regression"
+    )
+    compare.set_defaults(handler=command_compare)
+
+    serialize = commands.add_parser(
+        "serialize", help=command_serialize.__doc__
+    )
+    serialize.add_argument("--rows", type=int, default=100000)
+    serialize.add_argument(
+        "--repeat", type=int, default=3, help="runs kept the best of"
+    )
+    serialize.set_defaults(handler=command_serialize)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
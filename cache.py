@@ -0,0 +1,285 @@
+"""In-process caching helpers for the read endpoints"""
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+from os import getenv
+
+
+class TableVersions:
+    """
+    Change counters of the tables, bumped by the write handlers
+
+    A table version changes on every local write to it, so it can be
+    used as an ETag without touching the database. Writes done by other
+    processes are not seen, hence versions older than `max_age` seconds
+    are renewed, which bounds for how long a stale 304 can be sent.
+
+    Parameters
+    ----------
+    max_age: float
+        seconds a version is trusted for
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._nonce = None
+        self._versions = {}  # table -> (counter, last modified, renewed at)
+        self._changed = {}   # table -> time of the last local write
+
+    def _reset_if_forked(self):
+        # versions must never be shared between processes
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._nonce = uuid.uuid4().hex[:8]
+            self._versions = {}
+            self._changed = {}
+
+    def bump(self, *tables):
+        """Record a change of the given tables"""
+
+        now = time.time()
+        with self._lock:
+            self._reset_if_forked()
+            for table in tables:
+                counter = self._versions.get(table, (0, None, None))[0]
+                self._versions[table] = (counter + 1, now, now)
+                self._changed[table] = now
+
+    def get(self, table):
+        """
+        Current version of a table
+
+        Returns
+        -------
+            etag: str
+                opaque tag changing with every version
+
+            last_modified: datetime
+                time of the change which produced this version
+        """
+
+        now = time.time()
+        with self._lock:
+            self._reset_if_forked()
+            version = self._versions.get(table)
+            if version is None or now - version[2] >= self.max_age:
+                counter = version[0] + 1 if version else 0
+                # HTTP dates have a resolution of one second
+                version = (counter, float(int(now)), now)
+                self._versions[table] = version
+
+        etag = f"{table}-{self._nonce}-{version[0]}"
+        last_modified = datetime.fromtimestamp(int(version[1]), timezone.utc)
+        return etag, last_modified
+
+    def changed_within(self, seconds, *tables):
+        """
+        True if a local write changed any of the given tables less than
+        `seconds` ago (a read replica may not have it yet)
+        """
+
+        since = time.time() - seconds
+        with self._lock:
+            self._reset_if_forked()
+            return any(
+                self._changed.get(table, since) > since for table in tables
+            )
+
+
+CacheEntry = namedtuple(
+    "CacheEntry", ["body", "mimetype", "headers", "expires", "tags"]
+)
+
+
+class ResponseCache:
+    """
+    Serialized responses kept for `ttl` seconds, least recently used
+    ones evicted first once `max_bytes` are used
+
+    Every entry carries tags (e.g. ("city", 3)) naming the data it was
+    built from, so writes can drop exactly the entries they affect. The
+    cache belongs to one process: the writes handled by other processes
+    don't invalidate it.
+    Invalidations also bump `sequence`: a response computed while an
+    invalidation happened is not stored (see `put`).
+
+    Parameters
+    ----------
+    max_bytes: int
+        total size of the cached bodies, 0 disables the cache
+
+    ttl: float
+        seconds an entry is served for
+
+    max_entry_bytes: int
+        larger responses are not cached
+    """
+
+    def __init__(self, max_bytes, ttl, max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> CacheEntry, LRU first
+        self._tags = {}                # tag -> set of keys
+        self._size = 0
+        self.sequence = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        """False when configured with no space at all"""
+
+        return self.max_bytes > 0
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._size -= len(entry.body)
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get(self, key):
+        """Cached entry for `key`, None on a miss"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                self._drop(key)
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, mimetype, headers, tags, sequence):
+        """
+        Store a response
+
+        Parameters
+        ----------
+        key: str
+            normalized request
+
+        body: bytes
+            serialized response body
+
+        mimetype: str
+            response content type
+
+        headers: Dict[str, str]
+            extra response headers to be sent with the body
+
+        tags: Iterable[Any]
+            data the response was built from
+
+        sequence: int
+            value of `sequence` before the response was computed, the
+            response is discarded if anything was invalidated since
+
+        Returns
+        -------
+            res: bool
+                True = response stored
+        """
+
+        if len(body) > self.max_entry_bytes:
+            return False
+
+        with self._lock:
+            if sequence != self.sequence:
+                return False
+
+            if key in self._entries:
+                self._drop(key)
+
+            tags = frozenset(tags)
+            self._entries[key] = CacheEntry(
+                body, mimetype, headers, time.monotonic() + self.ttl, tags
+            )
+            self._size += len(body)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while self._size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+        return True
+
+    def invalidate(self, *tags):
+        """Drop the entries carrying any of the given tags"""
+
+        with self._lock:
+            self.sequence += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._drop(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        """Drop every entry"""
+
+        with self._lock:
+            self.sequence += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._tags.clear()
+            self._size = 0
+
+    def stats(self):
+        """Counters and usage of the cache"""
+
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes
+            }
+
+
+table_versions = TableVersions(
+    max_age=float(getenv("REFDATA_MAX_AGE", "30"))
+)
+
+# every worker process has its own cache, which the writes handled by the
+# other workers don't invalidate: only on by default with a single worker
+# (WEB_CONCURRENCY, see gunicorn.conf.py)
+_WORKERS = int(getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+
+response_cache = ResponseCache(
+    max_bytes=int(getenv(
+        "RESPONSE_CACHE_BYTES",
+        str(64 * 1024 * 1024) if _WORKERS == 1 else "0"
+    )),
+    ttl=float(getenv("RESPONSE_CACHE_TTL", "30")),
+    max_entry_bytes=int(
+        getenv("RESPONSE_CACHE_MAX_ENTRY", str(4 * 1024 * 1024))
+    )
+)
@@ -0,0 +1,149 @@
+"""
+Compression of the response bodies, negotiated with Accept-Encoding
+
+gzip is always available, brotli (br) when the brotli package is
+installed. Streamed bodies are compressed chunk by chunk and every
+compressed chunk is flushed, so clients can decode a listing while it
+is being sent.
+"""
+import zlib
+from os import getenv
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_ENABLED = getenv("COMPRESS_ENABLED", "1") == "1"
+# bodies smaller than this are sent as they are
+COMPRESS_MIN_SIZE = int(getenv("COMPRESS_MIN_SIZE", "1024"))
+# 1 (fastest) to 9 (smallest)
+GZIP_LEVEL = int(getenv("GZIP_LEVEL", "6"))
+# 0 (fastest) to 11 (smallest)
+BROTLI_QUALITY = int(getenv("BROTLI_QUALITY", "4"))
+
+# media types worth compressing, besides text/*
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/x-ndjson",
+    "application/vnd.columnar+json"
+}
+
+
+def compressible(mimetype):
+    """
+    True for the media types of textual bodies, except event streams
+    (their events must not wait for the size threshold)
+    """
+
+    return bool(mimetype) and mimetype != "text/event-stream" and (
+        mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES
+    )
+
+def choose_encoding(accept_encoding):
+    """
+    Content coding to use for a client, brotli preferred
+
+    Parameters
+    ----------
+    accept_encoding: str
+        Accept-Encoding header of the request (None if missing)
+
+    Returns
+    -------
+        res: str
+            "br" or "gzip", None = send the body as it is
+    """
+
+    if not COMPRESS_ENABLED or not accept_encoding:
+        return None
+
+    accepted = parse_accept_header(accept_encoding)
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted[encoding] > 0:
+            return encoding
+    return None
+
+
+class Compressor:
+    """Incremental compressor of one body"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._obj = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._obj = zlib.compressobj(
+                GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+
+    def compress(self, data):
+        """Compressed form of the next piece, decodable right away"""
+
+        if self.encoding == "br":
+            return self._obj.process(data) + self._obj.flush()
+        return self._obj.compress(data) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """End of the compressed body"""
+
+        if self.encoding == "br":
+            return self._obj.finish()
+        return self._obj.flush()
+
+
+def compress_body(data, encoding):
+    """Compressed form of a complete body"""
+
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+def peek(chunks, size):
+    """
+    Read the first pieces of a streamed body, until at least `size`
+    bytes or its end
+
+    Returns
+    -------
+        head: List[bytes]
+            pieces read
+
+        done: bool
+            True if the body ended
+    """
+
+    head = []
+    total = 0
+    for chunk in chunks:
+        data = chunk.encode() if isinstance(chunk, str) else chunk
+        head.append(data)
+        total += len(data)
+        if total >= size:
+            return head, False
+    return head, True
+
+def compress_chunks(head, chunks, encoding):
+    """
+    Compressed pieces of a streamed body: the `head` read by peek, then
+    the rest of `chunks` (closed at the end, or when the client goes
+    away)
+    """
+
+    compressor = Compressor(encoding)
+    try:
+        data = compressor.compress(b"".join(head))
+        if data:
+            yield data
+        for chunk in chunks:
+            data = compressor.compress(
+                chunk.encode() if isinstance(chunk, str) else chunk
+            )
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
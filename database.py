@@ -0,0 +1,568 @@
+"""PostgreSQL connection pool shared by the request handlers"""
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from os import getenv
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import ThreadedConnectionPool
+import metrics
+import queries
+import tracing
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out in time"""
+
+
+class MeteredCursor(extensions.cursor):
+    """
+    psycopg2 cursor recording the duration and rows of its statements
+    (see metrics) and reporting them to the request trace (see tracing)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # statement, parameters, start, time spent and rows fetched of a
+        # server-side cursor
+        self._stream = None
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        failed = True
+        try:
+            res = super().execute(query, vars)
+            failed = False
+            return res
+        finally:
+            seconds = time.perf_counter() - start
+            # DECLARE of a server-side cursor, its rows come with fetches
+            statement = (
+                "stream" if self.name else metrics.statement_label(query)
+            )
+            metrics.observe_query(statement, seconds, self.rowcount)
+
+            if self.name:
+                self._stream = [query, vars, start, seconds, 0]
+            elif tracing.active() or tracing.is_slow(seconds):
+                self._trace(statement, query, vars, start, seconds, failed)
+
+    def fetchmany(self, size=None):
+        if not self.name:
+            return super().fetchmany(size)
+
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        seconds = time.perf_counter() - start
+        metrics.observe_query("stream_fetch", seconds, len(rows))
+
+        if self._stream is not None:
+            self._stream[3] += seconds
+            self._stream[4] += len(rows)
+        return rows
+
+    def close(self):
+        # server-side cursors are traced as a whole: DECLARE plus fetches
+        stream, self._stream = self._stream, None
+        if stream is not None and not self.closed:
+            query, params, start, seconds, rows = stream
+            if tracing.active() or tracing.is_slow(seconds):
+                self._trace("stream", query, params, start, seconds, False,
+                            rows)
+        super().close()
+
+    def _trace(self, statement, query, params, start, seconds, failed,
+               rows=None):
+        sql = tracing.source(query, self.connection.prepared)
+        if rows is None:
+            rows = self.rowcount
+        tracing.record(statement, sql, params, start, seconds, rows)
+
+        conn = self.connection
+        if failed or not tracing.is_slow(seconds):
+            return
+        # statements with side effects are logged without running them
+        # again (nor outside of a transaction)
+        if (not tracing.explainable(query, queries.read_only)
+                or conn.get_transaction_status()
+                != extensions.TRANSACTION_STATUS_INTRANS):
+            tracing.log_slow(statement, sql, params, seconds, rows, None)
+            return
+
+        # the plan is read through a separate plain cursor, so the rows
+        # of this one are kept and the EXPLAIN itself isn't traced, in a
+        # savepoint so a failure doesn't abort the request's transaction
+        with conn.cursor(cursor_factory=extensions.cursor) as cursor:
+            cursor.execute("SAVEPOINT explain_slow")
+            try:
+                cursor.execute(tracing.EXPLAIN + query, params)
+                plan = cursor.fetchone()[0]
+                cursor.execute("RELEASE SAVEPOINT explain_slow")
+            except psycopg2.Error as err:
+                cursor.execute("ROLLBACK TO SAVEPOINT explain_slow")
+                plan = f"EXPLAIN failed: {err}"
+        tracing.log_slow(statement, sql, params, seconds, rows, plan)
+
+
+class Connection(extensions.connection):
+    """psycopg2 connection carrying the bookkeeping done by the pool"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = MeteredCursor
+        self.slots = None
+        self.last_used = time.monotonic()
+        # SQL of the prepared statements of this session by name, LRU first
+        self.prepared = OrderedDict()
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of PostgreSQL connections
+
+    Connections are opened lazily (so the pool can be created at import
+    time and after a fork each process opens its own connections) and are
+    checked out per request. Checkout blocks while all `maxconn`
+    connections are in use, up to `timeout` seconds.
+
+    Parameters
+    ----------
+    minconn: int
+        connections kept open while idle
+
+    maxconn: int
+        upper bound of simultaneously open connections
+
+    timeout: float
+        seconds to wait for a free connection before giving up
+
+    ping_after: float
+        connections idle for longer than this are checked with a
+        trivial query before being handed out
+
+    dsn: Dict[str, Any]
+        keyword arguments forwarded to psycopg2.connect
+    """
+
+    def __init__(self, minconn, maxconn, timeout, ping_after, **dsn):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.dsn = dict(dsn, connection_factory=Connection)
+
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+        # checkouts waiting for / holding a connection
+        self._stats_lock = threading.Lock()
+        self._waiting = 0
+        self._in_use = 0
+
+    def _get_pool(self):
+        """Create the underlying pool on first use (and again after fork)"""
+
+        pid = os.getpid()
+        if self._pool is None or self._pid != pid:
+            with self._lock:
+                if self._pool is None or self._pid != pid:
+                    # connections inherited from the parent process must
+                    # not be used nor closed here, simply forget them
+                    self._pool = ThreadedConnectionPool(
+                        self.minconn, self.maxconn, **self.dsn
+                    )
+                    self._pid = pid
+                    self._slots = threading.BoundedSemaphore(self.maxconn)
+                    self._waiting = self._in_use = 0
+
+        return self._pool
+
+    def open(self):
+        """Open the `minconn` connections of this process right away"""
+
+        self._get_pool()
+
+    def close(self):
+        """Close every connection opened by this process"""
+
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.closeall()
+            self._pool = None
+
+    def getconn(self):
+        """Check out a usable connection, replacing stale ones"""
+
+        db_pool = self._get_pool()
+        slots = self._slots
+
+        start = time.perf_counter()
+        with self._stats_lock:
+            self._waiting += 1
+        acquired = slots.acquire(timeout=self.timeout)
+        with self._stats_lock:
+            self._waiting -= 1
+        metrics.pool_wait_seconds.observe(time.perf_counter() - start)
+        if not acquired:
+            metrics.pool_timeouts.inc()
+            raise PoolTimeout("no database connection available")
+
+        try:
+            conn = db_pool.getconn()
+            while not self._is_alive(conn):
+                db_pool.putconn(conn, close=True)
+                conn = db_pool.getconn()
+        except BaseException:
+            slots.release()
+            raise
+
+        with self._stats_lock:
+            self._in_use += 1
+        conn.slots = slots
+        return conn
+
+    def _is_alive(self, conn):
+        """Detect connections dropped by the server while idle"""
+
+        if conn.closed:
+            return False
+        status = conn.get_transaction_status()
+        if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+
+        if time.monotonic() - conn.last_used > self.ping_after:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+
+        return True
+
+    def putconn(self, conn, close=False):
+        """Return a connection to the pool (closing it if broken)"""
+
+        slots = conn.slots
+        conn.last_used = time.monotonic()
+        try:
+            self._get_pool().putconn(conn, close=close or bool(conn.closed))
+        finally:
+            with self._stats_lock:
+                self._in_use -= 1
+            slots.release()
+
+    def stats(self):
+        """Connections checked out and checkouts waiting for one"""
+
+        with self._stats_lock:
+            return {
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "max": self.maxconn
+            }
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the block"""
+
+        conn = self.getconn()
+        with self.checked_out(conn):
+            yield conn
+
+    @contextmanager
+    def checked_out(self, conn):
+        """
+        Return a connection checked out with getconn when the block
+        exits, rolled back (or closed if broken)
+        """
+
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if not broken and not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            self.putconn(conn, close=broken)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the block in its own transaction and yield a cursor
+
+        The transaction is committed when the block exits normally and
+        rolled back on any exception, so a failing request never leaves
+        an aborted transaction behind for the next one.
+        """
+
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                yield cursor
+            conn.commit()
+
+
+class ReplicaHealth:
+    """
+    Reachability of the read replicas and choice of the one serving
+    the next read
+
+    Each process checks every replica from a background thread (started
+    by its first read), every `interval` seconds. A replica is also
+    marked down as soon as a connection to it fails, until a check
+    finds it up again.
+
+    Parameters
+    ----------
+    params: List[Dict[str, Any]]
+        psycopg2.connect keyword arguments of each replica
+
+    policy: str
+        "round_robin" or "least_loaded"
+
+    interval: float
+        seconds between two checks of a replica
+
+    timeout: int
+        seconds a check waits for the connection
+    """
+
+    def __init__(self, params, policy, interval, timeout):
+        self.params = params
+        self.policy = policy
+        self.interval = interval
+        self.timeout = timeout
+        self.up = [True] * len(params)
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._turn = itertools.count()
+
+    def _start(self):
+        """Start the checks of this process on first use"""
+
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    threading.Thread(
+                        target=self._run, name="replica-health", daemon=True
+                    ).start()
+                    self._pid = pid
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            for index in range(len(self.params)):
+                self.up[index] = self._check(index)
+
+    def _check(self, index):
+        """True if the replica accepts connections and answers"""
+
+        try:
+            conn = psycopg2.connect(
+                **dict(self.params[index], connect_timeout=self.timeout)
+            )
+        except psycopg2.Error:
+            return False
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            return True
+        except psycopg2.Error:
+            return False
+        finally:
+            conn.close()
+
+    def mark_down(self, index):
+        """Stop using a replica until it is found up again"""
+
+        self.up[index] = False
+
+    def pick(self, loads):
+        """
+        Replica serving the next read
+
+        Parameters
+        ----------
+        loads: List[int]
+            connections in use of each replica (for "least_loaded")
+
+        Returns
+        -------
+            res: int
+                index of the replica, None if every replica is down
+        """
+
+        self._start()
+        healthy = [index for index, up in enumerate(self.up) if up]
+        if not healthy:
+            return None
+
+        if self.policy == "least_loaded":
+            return min(healthy, key=lambda index: loads[index])
+        return healthy[next(self._turn) % len(healthy)]
+
+    def states(self):
+        """(connection params, up) of every replica"""
+
+        return list(zip(self.params, self.up))
+
+
+class ReadPool:
+    """
+    Connections for read-only work, from the read replicas
+
+    The primary serves the reads when no replica is configured, when
+    every replica is down and when the chosen replica can't hand out a
+    connection (which also marks it down if unreachable).
+
+    Parameters
+    ----------
+    primary: ConnectionPool
+        pool of the primary server
+
+    replicas: List[ConnectionPool]
+        pools of the replicas, in the order of `health.params`
+
+    health: ReplicaHealth
+        reachability of the replicas
+    """
+
+    def __init__(self, primary, replicas, health):
+        self.primary = primary
+        self.replicas = replicas
+        self.health = health
+
+    def _checkout(self):
+        """Pool and connection serving a read"""
+
+        if self.replicas:
+            index = self.health.pick([
+                replica.stats()["in_use"] for replica in self.replicas
+            ])
+            if index is not None:
+                replica = self.replicas[index]
+                try:
+                    return replica, replica.getconn()
+                except psycopg2.OperationalError:
+                    self.health.mark_down(index)
+                except PoolTimeout:
+                    pass
+
+        return self.primary, self.primary.getconn()
+
+    def close(self):
+        """Close every replica connection opened by this process"""
+
+        for replica in self.replicas:
+            replica.close()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the block"""
+
+        owner, conn = self._checkout()
+        with owner.checked_out(conn):
+            yield conn
+
+    @contextmanager
+    def transaction(self):
+        """Run the block in its own transaction and yield a cursor"""
+
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                yield cursor
+            conn.commit()
+
+
+def replica_params(address):
+    """Connection params of a replica from its "host[:port]" address"""
+
+    host, _, port = address.partition(":")
+    return dict(
+        DB_PARAMS, host=host, port=int(port or "5432"),
+        connect_timeout=REPLICA_CONNECT_TIMEOUT
+    )
+
+
+# seconds a database statement may run before the server cancels it, the
+# bound of the requests (the gunicorn timeout only catches hung workers),
+# 0 = no limit; maintenance commands lift it for their transaction
+REQUEST_TIMEOUT = float(getenv("REQUEST_TIMEOUT", "30"))
+
+# credentials and session settings shared by the primary and the replicas
+DB_PARAMS = {
+    "database": getenv("DB"),
+    "user": getenv("DB_USER"),
+    "password": getenv("DB_PASSWORD"),
+    "options": f"-c statement_timeout={int(REQUEST_TIMEOUT * 1000)}"
+}
+
+# read replicas, comma separated "host[:port]" addresses
+REPLICAS = [elem.strip() for elem in getenv("DB_REPLICAS", "").split(",")
+            if elem.strip()]
+# seconds during which the reads of a client go to the primary after one
+# of its writes (read your writes), 0 = never
+REPLICA_STICKY_SECONDS = int(getenv("DB_REPLICA_STICKY_SECONDS", "5"))
+# seconds a read waits for a replica connection before falling back to the
+# primary (an unreachable host would otherwise block for the TCP timeout)
+REPLICA_CONNECT_TIMEOUT = int(getenv("DB_REPLICA_CONNECT_TIMEOUT", "2"))
+STICKY_COOKIE = "db_primary"
+
+pool = ConnectionPool(
+    minconn=int(getenv("DB_POOL_MIN", "1")),
+    maxconn=int(getenv("DB_POOL_MAX", "10")),
+    timeout=float(getenv("DB_POOL_TIMEOUT", "30")),
+    ping_after=float(getenv("DB_POOL_PING_AFTER", "60")),
+    host=getenv("DB_HOST", "tema2_db"),
+    port=int(getenv("DB_PORT", "5432")),
+    **DB_PARAMS
+)
+
+replica_health = ReplicaHealth(
+    [replica_params(elem) for elem in REPLICAS],
+    policy=getenv("DB_REPLICA_POLICY", "round_robin"),
+    interval=float(getenv("DB_REPLICA_CHECK_INTERVAL", "5")),
+    timeout=int(getenv("DB_REPLICA_CHECK_TIMEOUT", "2"))
+)
+
+read_pool = ReadPool(
+    pool,
+    [
+        ConnectionPool(
+            minconn=0,
+            maxconn=pool.maxconn,
+            timeout=pool.timeout,
+            ping_after=pool.ping_after,
+            **params
+        )
+        for params in replica_health.params
+    ],
+    replica_health
+)
+
+metrics.Callback(
+    "db_pool_connections",
+    "Database connections in use, checkouts waiting and the pool size",
+    ("state",),
+    lambda: [((state,), value) for state, value in pool.stats().items()]
+)
+metrics.Callback(
+    "db_replica_up",
+    "Read replicas found reachable (1) or not (0)",
+    ("replica",),
+    lambda: [((f"{params['host']}:{params['port']}",), int(up))
+             for params, up in replica_health.states()]
+)
@@ -0,0 +1,69 @@
+"""
+Production server settings (gunicorn)
+
+The application is imported once by the master process and the worker
+processes are forked from it, each one opening its own database
+connections. Every setting can be overridden from the environment.
+
+    gunicorn -c gunicorn.conf.py main:app
+    gunicorn -c gunicorn.conf.py -k uvicorn_worker.UvicornWorker asgi:app
+
+`kill -HUP <master pid>` replaces the workers, letting the old ones
+finish their requests (graceful restart). The preloaded code is kept,
+code changes need a full restart (or `kill -USR2` for a new master).
+"""
+import multiprocessing
+from os import getenv
+
+bind = getenv("BIND", "0.0.0.0:5000")
+
+# one worker process per core, each one serving several threads
+workers = int(getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = getenv("WORKER_CLASS", "gthread")
+threads = int(getenv("WORKER_THREADS", "4"))
+
+preload_app = True
+
+# workers whose heartbeat stops for longer than this are killed and
+# replaced; with gthread the heartbeat comes from the main thread, so this
+# does not limit the duration of the requests (REQUEST_TIMEOUT does, see
+# database)
+timeout = int(getenv("WORKER_TIMEOUT", "30"))
+# time given to workers to finish their requests on restart / shutdown
+graceful_timeout = int(getenv("GRACEFUL_TIMEOUT", "30"))
+keepalive = int(getenv("KEEPALIVE", "5"))
+
+# recycle workers after this many requests (0 = never)
+max_requests = int(getenv("MAX_REQUESTS", "0"))
+max_requests_jitter = int(getenv("MAX_REQUESTS_JITTER", "0"))
+
+accesslog = getenv("ACCESS_LOG", "-")
+errorlog = "-"
+
+
+def post_fork(server, worker):
+    """Open the connection pool of the new worker"""
+
+    import psycopg2
+    from database import pool
+
+    try:
+        pool.open()
+    except psycopg2.OperationalError as err:
+        # the pool is opened again by the first request
+        server.log.warning("worker %s: database unavailable: %s",
+                           worker.pid, err)
+
+
+def worker_exit(server, worker):
+    """
+    Write the readings still queued (see ingest), then close the
+    database connections of a stopping worker
+    """
+
+    from database import pool, read_pool
+    from main import ingest_buffer
+
+    ingest_buffer.close()
+    read_pool.close()
+    pool.close()
@@ -0,0 +1,249 @@
+"""
+Write-behind buffer for the temperature readings posted one by one
+
+With INGEST_BUFFERED=1 the readings accepted by POST /api/temperatures
+are queued in memory and a background thread of each process writes
+them in batches (INGEST_FLUSH_ROWS readings or every INGEST_FLUSH_MS
+milliseconds, whichever comes first), with one commit per batch. The
+client is answered once its reading is committed (INGEST_ACK=commit,
+with its id) or as soon as it is queued (INGEST_ACK=enqueue, readings
+still queued are lost if the process dies). A full queue makes requests
+wait for room up to INGEST_ENQUEUE_TIMEOUT seconds, then turns them
+away.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from os import getenv
+import metrics
+
+INGEST_BUFFERED = getenv("INGEST_BUFFERED", "0") == "1"
+# "commit" or "enqueue"
+INGEST_ACK = getenv("INGEST_ACK", "commit")
+INGEST_QUEUE_SIZE = int(getenv("INGEST_QUEUE_SIZE", "10000"))
+INGEST_FLUSH_ROWS = int(getenv("INGEST_FLUSH_ROWS", "500"))
+INGEST_FLUSH_MS = float(getenv("INGEST_FLUSH_MS", "20"))
+# seconds a request waits for room in a full queue / for its commit
+INGEST_ENQUEUE_TIMEOUT = float(getenv("INGEST_ENQUEUE_TIMEOUT", "1"))
+INGEST_COMMIT_TIMEOUT = float(getenv("INGEST_COMMIT_TIMEOUT", "10"))
+
+_logger = logging.getLogger("ingest")
+
+flush_rows = metrics.Histogram(
+    "ingest_flush_rows",
+    "Readings written by each flush of the ingest buffer",
+    buckets=metrics.ROWS_BUCKETS
+)
+flush_seconds = metrics.Histogram(
+    "ingest_flush_duration_seconds",
+    "Time spent writing (and committing) each flush of the ingest buffer"
+)
+rejected = metrics.Counter(
+    "ingest_rejected_total",
+    "Readings turned away because the ingest buffer was full"
+)
+
+
+class QueueFull(Exception):
+    """Raised when a reading found no room in the queue in time"""
+
+
+class Pending:
+    """
+    A queued reading, resolved once its batch is written
+
+    `result` is then the (id, timestamp) of the new row, or `error` the
+    reason it was rejected.
+    """
+
+    __slots__ = ("reading", "result", "error", "_done")
+
+    def __init__(self, reading):
+        self.reading = reading
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def resolve(self, result=None, error=None):
+        """Record the outcome and wake up the waiting request"""
+
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """Wait for the outcome, False if it didn't come in time"""
+
+        return self._done.wait(timeout)
+
+
+class IngestBuffer:
+    """
+    Bounded queue of readings and the thread writing them in batches
+
+    The thread (and the queue) of a process are created by its first
+    reading, so buffers are never shared with forked processes.
+
+    Parameters
+    ----------
+    write: Callable[[List[Tuple[int, float]]], List[Any]]
+        writes some (city id, value) readings in one transaction and
+        returns, for each one, the (id, timestamp) of its row or the
+        description of the error rejecting it
+
+    max_size: int
+        readings the queue holds at most
+
+    max_rows: int
+        readings written by one batch at most
+
+    interval: float
+        seconds a batch waits for more readings after its first one
+    """
+
+    def __init__(self, write, max_size, max_rows, interval):
+        self.write = write
+        self.max_size = max_size
+        self.max_rows = max_rows
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        # notified when the last submit in flight is done with the queue
+        self._idle = threading.Condition(self._lock)
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._closed = False
+        self._submitting = 0
+
+    def _start(self):
+        """Create the queue and the thread of this process on first use"""
+
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._queue = queue.Queue(self.max_size)
+                    self._thread = threading.Thread(
+                        target=self._run, name="ingest-flusher", daemon=True
+                    )
+                    self._thread.start()
+                    self._closed = False
+                    self._submitting = 0
+                    self._pid = pid
+
+        return self._queue
+
+    def submit(self, reading, timeout):
+        """
+        Queue a (city id, value) reading
+
+        Returns
+        -------
+            res: Pending
+                resolved once the reading is written
+
+        Raises
+        ------
+        QueueFull
+            no room was made within `timeout` seconds (or the buffer
+            is closing)
+        """
+
+        pending = Pending(reading)
+        items = self._start()
+
+        # counted as in flight under the lock of close(), which waits for
+        # them before queuing the sentinel (a reading queued after it would
+        # never be written); the wait for room is done without the lock
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._submitting += 1
+
+        if not closed:
+            try:
+                items.put(pending, timeout=timeout)
+                return pending
+            except queue.Full:
+                pass
+            finally:
+                with self._lock:
+                    self._submitting -= 1
+                    if not self._submitting:
+                        self._idle.notify_all()
+
+        rejected.inc()
+        raise QueueFull("ingest buffer full")
+
+    def size(self):
+        """Readings currently queued"""
+
+        return self._queue.qsize() if self._pid == os.getpid() else 0
+
+    def _run(self):
+        items = self._queue
+        while True:
+            first = items.get()
+            if first is None:
+                return
+
+            # gather the batch: max_rows readings or `interval` seconds
+            batch = [first]
+            deadline = time.monotonic() + self.interval
+            stop = False
+            while len(batch) < self.max_rows:
+                remaining = deadline - time.monotonic()
+                try:
+                    elem = (items.get(timeout=remaining) if remaining > 0
+                            else items.get_nowait())
+                except queue.Empty:
+                    break
+                if elem is None:
+                    stop = True
+                    break
+                batch.append(elem)
+
+            self._flush(batch)
+            if stop:
+                return
+
+    def _flush(self, batch):
+        start = time.perf_counter()
+        try:
+            results = self.write([elem.reading for elem in batch])
+        except Exception as err:
+            _logger.exception("ingest flush of %d readings failed",
+                              len(batch))
+            for elem in batch:
+                elem.resolve(error=f"Error: reading not saved ({err})")
+            return
+
+        flush_seconds.observe(time.perf_counter() - start)
+        flush_rows.observe(len(batch))
+        for elem, res in zip(batch, results):
+            if isinstance(res, str):
+                elem.resolve(error=res)
+            else:
+                elem.resolve(result=res)
+
+    def close(self):
+        """
+        Stop accepting readings and write the queued ones before
+        returning (process shutdown)
+        """
+
+        with self._lock:
+            if self._pid != os.getpid() or self._closed:
+                return
+            self._closed = True
+            # submits in flight give up within their timeout at most
+            while self._submitting:
+                self._idle.wait()
+
+        # the sentinel is queued after every reading already accepted
+        self._queue.put(None)
+        self._thread.join()
+
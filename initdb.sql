@@ -15,11 +15,54 @@ CREATE TABLE IF NOT EXISTS Orase (
     FOREIGN KEY (idTara) REFERENCES Tari (id) ON DELETE CASCADE
 );
 
+-- readings are partitioned by month (temperaturi_YYYY_MM, created by
+-- partitions.py): time range queries only read the partitions of their
+-- months and old months are dropped as whole tables; readings outside
+-- the created months are kept by the default partition
 CREATE TABLE IF NOT EXISTS Temperaturi (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     valoare REAL NOT NULL,
-    timestamp timestamp DEFAULT CURRENT_TIMESTAMP,
+    timestamp timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
     idOras INT,
+    PRIMARY KEY (id, timestamp),
     UNIQUE (timestamp, idOras),
     FOREIGN KEY (idOras) REFERENCES Orase (id) ON DELETE CASCADE
-);
\ No newline at end of file
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE IF NOT EXISTS Temperaturi_default PARTITION OF Temperaturi DEFAULT;
+
+-- keyset pagination: cities are paged by id (optionally per country, which
+-- also serves the cities-of-a-country subqueries), readings by
+-- (timestamp, id), optionally per city
+CREATE INDEX IF NOT EXISTS orase_idtara_id ON Orase (idTara, id);
+CREATE INDEX IF NOT EXISTS temperaturi_timestamp_id ON Temperaturi (timestamp, id);
+CREATE INDEX IF NOT EXISTS temperaturi_idoras_timestamp_id ON Temperaturi (idOras, timestamp, id);
+-- readings are inserted in time order, so a few bytes per block range
+-- are enough for wide time range scans (aggregates over months)
+CREATE INDEX IF NOT EXISTS temperaturi_timestamp_brin ON Temperaturi USING BRIN (timestamp);
+
+-- readings pre-aggregated per hour and per day ('hour'/'day' buckets),
+-- kept up to date by the server on every write (see rollup.py)
+CREATE TABLE IF NOT EXISTS AgregateOrase (
+    granularitate VARCHAR(5) NOT NULL,
+    bucket timestamp NOT NULL,
+    idOras INT NOT NULL,
+    numar BIGINT NOT NULL,
+    suma DOUBLE PRECISION NOT NULL,
+    minim REAL NOT NULL,
+    maxim REAL NOT NULL,
+    PRIMARY KEY (granularitate, idOras, bucket),
+    FOREIGN KEY (idOras) REFERENCES Orase (id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS AgregateTari (
+    granularitate VARCHAR(5) NOT NULL,
+    bucket timestamp NOT NULL,
+    idTara INT NOT NULL,
+    numar BIGINT NOT NULL,
+    suma DOUBLE PRECISION NOT NULL,
+    minim REAL NOT NULL,
+    maxim REAL NOT NULL,
+    PRIMARY KEY (granularitate, idTara, bucket),
+    FOREIGN KEY (idTara) REFERENCES Tari (id) ON DELETE CASCADE
+);
@@ -0,0 +1,327 @@
+"""
+Live feed of the temperature readings (Server-Sent Events)
+
+The write handlers publish every new, changed or deleted reading with
+pg_notify in their transaction, so it is only seen once committed. Each
+server process keeps a single connection listening on the channel, from
+a background thread, and fans every notification out to the matching
+subscribers. Each subscriber has a bounded buffer: a client too slow to
+keep up gets an `overflow` event and is disconnected (it then re-reads
+the listing and subscribes again) instead of growing the memory of the
+server.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+from os import getenv
+import psycopg2
+import metrics
+from database import pool
+
+# off by default: every write then also sends a notification
+LIVE_FEED_ENABLED = getenv("LIVE_FEED_ENABLED", "0") == "1"
+# events buffered per subscriber
+LIVE_FEED_BUFFER = int(getenv("LIVE_FEED_BUFFER", "256"))
+LIVE_FEED_MAX_SUBSCRIBERS = int(getenv("LIVE_FEED_MAX_SUBSCRIBERS", "10000"))
+# subscribers of a synchronous server process, each one holding one of its
+# WORKER_THREADS threads (see gunicorn.conf.py) while connected: kept below
+# that so the API stays served, 0 = the feed is only served by asgi.py
+LIVE_FEED_THREAD_SUBSCRIBERS = max(min(
+    int(getenv("LIVE_FEED_THREAD_SUBSCRIBERS", "0")),
+    int(getenv("WORKER_THREADS", "4")) - 1
+), 0)
+# seconds between two comments keeping idle streams open
+LIVE_FEED_KEEPALIVE = float(getenv("LIVE_FEED_KEEPALIVE", "15"))
+
+# also hardcoded in queries.STATEMENTS["notify_readings"]
+CHANNEL = "temperaturi"
+# reconnection delay for the clients (ms)
+RETRY = "retry: 3000\n\n"
+KEEPALIVE = ": keepalive\n\n"
+OVERFLOW = "event: overflow\ndata: {}\n\n"
+# headers of the streams, proxies must neither cache nor buffer them
+HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+_logger = logging.getLogger("livefeed")
+
+events_total = metrics.Counter(
+    "live_feed_events_total",
+    "Reading changes received from the database"
+)
+dropped_total = metrics.Counter(
+    "live_feed_overflows_total",
+    "Subscribers disconnected because their buffer was full"
+)
+
+
+class TooManySubscribers(Exception):
+    """
+    Raised when a process already serves LIVE_FEED_MAX_SUBSCRIBERS (or
+    LIVE_FEED_THREAD_SUBSCRIBERS threads)
+    """
+
+
+def payload(event, record):
+    """
+    Text of the notification of a reading change (the database adds
+    "idTara", see queries.STATEMENTS["notify_readings"])
+
+    Parameters
+    ----------
+    event: str
+        "insert", "update" or "delete"
+
+    record: Dict[str, Any]
+        "id", "idOras", "valoare" and "timestamp" of the reading
+    """
+
+    return json.dumps(dict(record, event=event))
+
+def message(record):
+    """SSE message of a decoded notification (see payload)"""
+
+    record = dict(record)
+    event = record.pop("event")
+    return (f"event: {event}\nid: {record['id']}\n"
+            f"data: {json.dumps(record)}\n\n")
+
+
+class Subscriber:
+    """
+    Client of the feed and its buffer of SSE messages
+
+    Parameters
+    ----------
+    city_ids, country_ids: Set[int]
+        readings of these cities and of the cities of these countries
+        are sent, every reading when both are empty
+
+    loop: asyncio.AbstractEventLoop
+        loop of an asynchronous subscriber, None for a thread
+    """
+
+    def __init__(self, city_ids, country_ids, loop=None):
+        self.city_ids = city_ids
+        self.country_ids = country_ids
+        self.loop = loop
+        self.queue = (asyncio.Queue(LIVE_FEED_BUFFER) if loop
+                      else queue.Queue(LIVE_FEED_BUFFER))
+        self.lagged = False
+
+    def keys(self):
+        """Keys the subscriber is indexed by"""
+
+        if not self.city_ids and not self.country_ids:
+            return [("all",)]
+        return ([("city", elem) for elem in self.city_ids]
+                + [("country", elem) for elem in self.country_ids])
+
+    def put(self, text):
+        """Buffer a message (in the thread / loop of the subscriber)"""
+
+        if self.lagged:
+            return
+        try:
+            self.queue.put_nowait(text)
+        except (queue.Full, asyncio.QueueFull):
+            self.lagged = True
+            dropped_total.inc()
+
+    def messages(self):
+        """SSE messages for a thread, until the buffer overflows"""
+
+        while not self.lagged:
+            try:
+                yield self.queue.get(timeout=LIVE_FEED_KEEPALIVE)
+            except queue.Empty:
+                yield KEEPALIVE
+        yield OVERFLOW
+
+    async def amessages(self):
+        """SSE messages for a coroutine, until the buffer overflows"""
+
+        while not self.lagged:
+            try:
+                yield await asyncio.wait_for(
+                    self.queue.get(), LIVE_FEED_KEEPALIVE
+                )
+            except asyncio.TimeoutError:
+                yield KEEPALIVE
+        yield OVERFLOW
+
+
+class LiveFeed:
+    """
+    Subscribers of a process and the connection listening for them
+
+    The listening connection is opened by the first subscriber of the
+    process and reopened if lost (changes made meanwhile are missed).
+
+    Parameters
+    ----------
+    params: Dict[str, Any]
+        psycopg2.connect keyword arguments of the primary server
+    """
+
+    def __init__(self, params):
+        self.params = params
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._subscribers = {}  # key -> set of Subscriber
+        self._count = 0
+        self._threads = 0
+
+    def _start(self):
+        """Start the listening thread of this process on first use"""
+
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._subscribers = {}
+                    self._count = self._threads = 0
+                    threading.Thread(
+                        target=self._run, name="live-feed", daemon=True
+                    ).start()
+                    self._pid = pid
+
+    def subscribe(self, city_ids=(), country_ids=(), loop=None):
+        """
+        Register a new subscriber (see Subscriber)
+
+        Raises
+        ------
+        TooManySubscribers
+            the process serves LIVE_FEED_MAX_SUBSCRIBERS already (or
+            LIVE_FEED_THREAD_SUBSCRIBERS threads, for a thread)
+        """
+
+        self._start()
+        subscriber = Subscriber(set(city_ids), set(country_ids), loop)
+        with self._lock:
+            if self._count >= LIVE_FEED_MAX_SUBSCRIBERS or (
+                    loop is None
+                    and self._threads >= LIVE_FEED_THREAD_SUBSCRIBERS):
+                raise TooManySubscribers("too many live feed subscribers")
+            self._count += 1
+            if loop is None:
+                self._threads += 1
+            for key in subscriber.keys():
+                self._subscribers.setdefault(key, set()).add(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Forget a subscriber which went away"""
+
+        with self._lock:
+            self._count -= 1
+            if subscriber.loop is None:
+                self._threads -= 1
+            for key in subscriber.keys():
+                group = self._subscribers.get(key)
+                if group is not None:
+                    group.discard(subscriber)
+                    if not group:
+                        del self._subscribers[key]
+
+    def count(self):
+        """Subscribers of this process"""
+
+        return self._count if self._pid == os.getpid() else 0
+
+    def full(self, threads=False):
+        """
+        True when a new subscriber would be turned away (see subscribe),
+        `threads` for one served by a thread
+        """
+
+        if self._pid != os.getpid():
+            return threads and LIVE_FEED_THREAD_SUBSCRIBERS == 0
+        return self._count >= LIVE_FEED_MAX_SUBSCRIBERS or (
+            threads and self._threads >= LIVE_FEED_THREAD_SUBSCRIBERS
+        )
+
+    def publish(self, text):
+        """Hand a notification to the subscribers interested in it"""
+
+        record = json.loads(text)
+        keys = [("all",), ("city", record.get("idOras")),
+                ("country", record.get("idTara"))]
+        with self._lock:
+            targets = set()
+            for key in keys:
+                targets.update(self._subscribers.get(key, ()))
+        if not targets:
+            return
+
+        text = message(record)
+        # one wakeup per event loop, not per subscriber
+        loops = {}
+        for subscriber in targets:
+            if subscriber.loop is None:
+                subscriber.put(text)
+            else:
+                loops.setdefault(subscriber.loop, []).append(subscriber)
+        for loop, group in loops.items():
+            loop.call_soon_threadsafe(_deliver, group, text)
+
+    def _run(self):
+        delay = 1
+        while True:
+            started = time.monotonic()
+            try:
+                self._listen()
+            except psycopg2.Error as err:
+                _logger.warning("live feed connection lost: %s", err)
+            # back off while the server can't be reached
+            if time.monotonic() - started > 60:
+                delay = 1
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def _listen(self):
+        conn = psycopg2.connect(**self.params)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL};")
+
+            while True:
+                # the timeout lets a dropped connection be noticed
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT 1;")
+                    continue
+
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    events_total.inc()
+                    self.publish(notify.payload)
+        finally:
+            conn.close()
+
+
+def _deliver(group, text):
+    for subscriber in group:
+        subscriber.put(text)
+
+
+live_feed = LiveFeed({
+    key: value for key, value in pool.dsn.items()
+    if key != "connection_factory"
+})
+
+metrics.Callback(
+    "live_feed_subscribers",
+    "Clients subscribed to the live feed in this process",
+    (),
+    lambda: [((), live_feed.count())]
+)
@@ -1,26 +1,124 @@
 """Tema 2 SPRC"""
+import atexit
+import csv
+import io
+import math
 import re
 import json
-from datetime import datetime
+import time
+from datetime import datetime, timezone
+from functools import partial, wraps
 from os import getenv
-from flask import Flask, Response, request
-import psycopg2
+from urllib.parse import urlencode
+from flask import Flask, Response, g, request
+from psycopg2 import errors
+import compress
+import ingest
+import livefeed
+import metrics
+import partitions
+import queries
+import tracing
+import rollup
+from cache import response_cache, table_versions
+from database import (
+    REPLICA_STICKY_SECONDS, STICKY_COOKIE, pool, read_pool
+)
+from livefeed import live_feed
+from refcache import refcache
+from spatial import city_grid, valid_point
+from tsstore import ts_store
 
 app = Flask(__name__)
 
+metrics.Callback(
+    "response_cache_events_total",
+    "Hits, misses, evictions, expirations and invalidations of the cache",
+    ("event",),
+    lambda: [((event,), value)
+             for event, value in response_cache.stats().items()
+             if event in ("hits", "misses", "evictions", "expirations",
+                          "invalidations")],
+    kind="counter"
+)
+metrics.Callback(
+    "response_cache_size",
+    "Entries and bytes held by the response cache",
+    ("unit",),
+    lambda: [((unit,), response_cache.stats()[unit])
+             for unit in ("entries", "bytes")]
+)
+
 COUNTRY_COLS = ["id", "nume", "lat", "lon"]
 CITY_COLS = ["id",  "idTara", "nume", "lat", "lon"]
 TEMP_COLS = ["id", "valoare", "timestamp"]
 
-
-db = psycopg2.connect(
-    host="tema2_db",
-    database=getenv("DB"),
-    user=getenv("DB_USER"),
-    password=getenv("DB_PASSWORD"),
-    port=int(getenv("DB_PORT"))
+# upper bound for the number of readings accepted by one batch request
+MAX_BATCH_SIZE = int(getenv("MAX_BATCH_SIZE", "10000"))
+# rows fetched from a server-side cursor for each streamed chunk
+STREAM_CHUNK_SIZE = int(getenv("STREAM_CHUNK_SIZE", "2000"))
+# seconds a streamed listing may wait for its client between two chunks
+# before the database ends its transaction (0 = no limit)
+STREAM_IDLE_TIMEOUT = float(getenv("STREAM_IDLE_TIMEOUT", "30"))
+# set for the transaction of a streamed listing only
+STREAM_IDLE_SQL = (
+    "SELECT set_config('idle_in_transaction_session_timeout', %s, true);"
 )
-cursor = db.cursor()
+STREAM_IDLE_MS = str(int(STREAM_IDLE_TIMEOUT * 1000))
+# page size bounds for list endpoints called with `limit`/`after`
+DEFAULT_PAGE_SIZE = int(getenv("DEFAULT_PAGE_SIZE", "1000"))
+MAX_PAGE_SIZE = int(getenv("MAX_PAGE_SIZE", "10000"))
+
+# temperature columns for responses, the raw timestamp is the page key
+TEMP_SELECT = ("SELECT id, valoare, TO_CHAR(timestamp, 'YYYY-MM-DD') timestamp"
+               " FROM Temperaturi")
+TEMP_PAGE_SELECT = ("SELECT id, valoare,"
+                    " TO_CHAR(timestamp, 'YYYY-MM-DD') timestamp,"
+                    " Temperaturi.timestamp raw_timestamp FROM Temperaturi")
+
+# output formats of the listings, by `format` URL param, and their media
+# types (also matched against the Accept header), JSON by default
+FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "columnar": "application/vnd.columnar+json"
+}
+
+# time buckets and aggregate functions accepted by `bucket`/`agg`
+BUCKETS = ["hour", "day", "month"]
+AGGREGATES = {
+    "min": "MIN(valoare)",
+    "max": "MAX(valoare)",
+    "avg": "AVG(valoare)",
+    "sum": "SUM(valoare)",
+    "count": "COUNT(*)"
+}
+DEFAULT_AGGREGATES = ["min", "max", "avg", "count"]
+# the same aggregates computed from partial (rollup) aggregates
+ROLLUP_AGGREGATES = {
+    "min": "MIN(minim)",
+    "max": "MAX(maxim)",
+    "avg": "SUM(suma) / SUM(numar)::float8",
+    "sum": "SUM(suma)",
+    "count": "SUM(numar)::bigint"
+}
+
+# max difference for coordinates to be considered equal (REAL columns)
+COORD_TOLERANCE = 0.001
+# geographic queries over more cities are cached as depending on all data
+MAX_TAGGED_CITIES = 100
+
+# responses for the writes rejected by a constraint (default names from
+# initdb.sql)
+CONSTRAINT_ERRORS = {
+    "tari_nume_key": "Error: country name unique constraint violated",
+    "orase_idtara_nume_key": "Error: (id, name) unique constraint violated",
+    "orase_idtara_fkey": "Error: FOREIGN KEY violation - unknown country id",
+    "temperaturi_idoras_fkey":
+        "Error: FOREIGN KEY violation - unknown city id"
+}
+
 
 def check_types(vals, types):
     """
@@ -68,21 +166,915 @@ def check_date(date_string):
 
     return status
 
+def read_time_args(args):
+    """
+    Parse the `from`/`until` URL params of the temperature listings
+
+    Parameters
+    ----------
+    args: werkzeug.datastructures.MultiDict
+        URL params of the request
+
+    Returns
+    -------
+        time_conds: List[Tuple[str, List[Any]]]
+            conditions on the time of the readings and their parameters
+
+        error: str
+            description of an invalid param, None if valid
+    """
+
+    # extract URL params (if not passed, defaults to None)
+    from_date = args.get("from", type=str)
+    to_date = args.get("until", type=str)
+
+    if check_date(from_date) == 1 or check_date(to_date) == 1:
+        return None, "invalid date format, please use YYYY-MM-DD"
+
+    if check_date(from_date) == 2 or check_date(to_date) == 2:
+        return None, "invalid date, please pass a correct day"
+
+    time_conds = [] # time conditions (entry date interval)
+
+    if from_date:
+        time_conds.append(("timestamp >= %s::timestamp", [from_date]))
+    if to_date:
+        time_conds.append(("timestamp <= %s::timestamp", [to_date]))
+
+    return time_conds, None
+
+def where(conds):
+    """
+    WHERE clause of some (condition, parameters) pairs
+
+    Returns
+    -------
+        clause: str
+            conditions joined with AND, empty if there are none
+
+        params: List[Any]
+            parameters of the conditions, in order
+    """
+
+    if not conds:
+        return "", []
+
+    clause = " WHERE " + " AND ".join(cond for cond, _ in conds)
+    return clause, [param for _, params in conds for param in params]
+
+def read_page_args(args, time_keyed=False):
+    """
+    Parse the keyset pagination URL params
+
+    `limit` is the page size and `after` the cursor returned with the
+    previous page: the last id seen or, for time ordered listings,
+    the last "<ISO timestamp>,<id>" pair seen.
+
+    Parameters
+    ----------
+    args: werkzeug.datastructures.MultiDict
+        URL params of the request
+
+    time_keyed: bool
+        True = listing ordered by (timestamp, id), False = ordered by id
+
+    Returns
+    -------
+        page: Tuple[int, Any]
+            page size and decoded cursor, None when not paginating
+
+        error: str
+            description of an invalid param, None if valid
+    """
+
+    limit = args.get("limit", type=str)
+    after = args.get("after", type=str)
+    if limit is None and after is None:
+        return None, None
+
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    elif not limit.isdigit() or not 1 <= int(limit) <= MAX_PAGE_SIZE:
+        return None, f"limit must be an integer from 1 to {MAX_PAGE_SIZE}"
+    else:
+        limit = int(limit)
+
+    if after is not None:
+        try:
+            if time_keyed:
+                timestamp, last_id = after.rsplit(",", 1)
+                after = (datetime.fromisoformat(timestamp), int(last_id))
+            else:
+                after = int(after)
+        except ValueError:
+            return None, "invalid pagination cursor"
+
+    return (limit, after), None
+
+def read_aggregate_args(args):
+    """
+    Parse the aggregation URL params (`bucket` and `agg`)
+
+    Parameters
+    ----------
+    args: werkzeug.datastructures.MultiDict
+        URL params of the request
+
+    Returns
+    -------
+        aggregate: Tuple[str, List[str]]
+            time bucket and aggregate function names, None when the raw
+            readings are requested
+
+        error: str
+            description of an invalid param, None if valid
+    """
+
+    bucket = args.get("bucket", type=str)
+    aggs = args.get("agg", type=str)
+    if bucket is None and aggs is None:
+        return None, None
+
+    if bucket not in BUCKETS:
+        return None, "bucket must be one of " + ", ".join(BUCKETS)
+
+    if aggs is None:
+        aggs = DEFAULT_AGGREGATES
+    else:
+        aggs = aggs.split(",")
+        if not aggs or any(agg not in AGGREGATES for agg in aggs):
+            return None, "agg must be a list of " + ", ".join(AGGREGATES)
+
+    if "limit" in args or "after" in args:
+        return None, "aggregated results can't be paginated"
+
+    return (bucket, aggs), None
+
+def read_format(args, accept):
+    """
+    Output format asked for by the `format` URL param or, without it,
+    by the Accept header
+
+    Parameters
+    ----------
+    args: werkzeug.datastructures.MultiDict
+        URL params of the request
+
+    accept: werkzeug.datastructures.MIMEAccept
+        parsed Accept header of the request
+
+    Returns
+    -------
+        fmt: str
+            key of FORMATS, None if the param is invalid
+
+        error: str
+            description of the invalid param, None if valid
+    """
+
+    fmt = args.get("format")
+    if fmt is None:
+        mimetype = accept.best_match(
+            list(FORMATS.values()), default=FORMATS["json"]
+        )
+        fmt = next(key for key, val in FORMATS.items() if val == mimetype)
+    elif fmt not in FORMATS:
+        return None, f"format must be one of {', '.join(FORMATS)}"
+
+    return fmt, None
+
+def csv_lines(rows):
+    """CSV text of some rows (sequences of values)"""
+
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerows(rows)
+    return buf.getvalue()
+
+def render_records(records, cols, fmt):
+    """
+    Body of a response holding some records (dicts with the keys `cols`)
+    in the given output format
+    """
+
+    if fmt == "ndjson":
+        return "".join([json.dumps(elem) + "\n" for elem in records])
+    if fmt == "csv":
+        return csv_lines(
+            [cols] + [[elem[col] for col in cols] for elem in records]
+        )
+    if fmt == "columnar":
+        return metrics.dumps(
+            {col: [elem[col] for elem in records] for col in cols}
+        )
+    return metrics.dumps(records)
+
+def stream_query(select, cols, fmt):
+    """
+    Query streamed by stream_records for the rows of `select` in the
+    given output format: JSON objects built by the database for JSON and
+    NDJSON, a single document with one array per column for columnar
+    """
+
+    if fmt in ("json", "ndjson"):
+        return queries.json_rows(select)
+    if fmt == "columnar":
+        return queries.json_columns(select, cols)
+    return select
+
+def read_feed_args(args):
+    """
+    Parse the `city`/`country` URL params of the live feed, each one
+    can be repeated
+
+    Returns
+    -------
+        city_ids: List[int]
+            cities whose readings are sent
+
+        country_ids: List[int]
+            countries whose readings are sent
+
+        error: str
+            description of an invalid param, None if valid
+    """
+
+    ids = {}
+    for name in ("city", "country"):
+        values = args.getlist(name)
+        if not all(elem.isdigit() for elem in values):
+            return None, None, f"{name} must be an integer id"
+        ids[name] = [int(elem) for elem in values]
+
+    return ids["city"], ids["country"], None
+
+def read_area_args(args):
+    """
+    Parse the geographic URL params of the temperature listing
+
+    `lat`/`lon` select the cities at the given coordinates (either one
+    can be missing), `bbox=min_lat,min_lon,max_lat,max_lon` the cities
+    inside a box, `near=lat,lon` together with `radius_km` the cities
+    inside a circle or together with `nearest=k` the k closest cities.
+    Latitudes must be in [-90, 90], longitudes in [-180, 180].
+
+    Parameters
+    ----------
+    args: werkzeug.datastructures.MultiDict
+        URL params of the request
+
+    Returns
+    -------
+        area: Callable[[cursor], List[int]]
+            lookup of the selected city ids in the city grid, None when
+            no geographic param was passed
+
+        error: str
+            description of an invalid param, None if valid
+    """
+
+    bbox = args.get("bbox", type=str)
+    near = args.get("near", type=str)
+
+    if bbox:
+        try:
+            min_lat, min_lon, max_lat, max_lon = map(float, bbox.split(","))
+        except ValueError:
+            return None, "bbox must be min_lat,min_lon,max_lat,max_lon"
+        if (not valid_point(min_lat, min_lon)
+                or not valid_point(max_lat, max_lon)):
+            return None, "bbox coordinates out of range"
+        return partial(
+            city_grid.in_bbox,
+            min_lat=min_lat, min_lon=min_lon, max_lat=max_lat, max_lon=max_lon
+        ), None
+
+    if near:
+        try:
+            near_lat, near_lon = map(float, near.split(","))
+        except ValueError:
+            return None, "near must be lat,lon"
+        if not valid_point(near_lat, near_lon):
+            return None, "near coordinates out of range"
+
+        radius_km = args.get("radius_km", type=float)
+        nearest = args.get("nearest", type=int)
+        if (radius_km is not None and math.isfinite(radius_km)
+                and radius_km >= 0):
+            return partial(
+                city_grid.within,
+                lat=near_lat, lon=near_lon, radius_km=radius_km
+            ), None
+        if nearest is not None and nearest > 0:
+            return partial(
+                city_grid.nearest, lat=near_lat, lon=near_lon, k=nearest
+            ), None
+        return None, "near requires a positive radius_km or nearest"
+
+    lat = args.get("lat", type=float)
+    lon = args.get("lon", type=float)
+    if not lat and not lon:
+        return None, None
+    if not valid_point(lat or 0.0, lon or 0.0):
+        return None, "lat / lon out of range"
+
+    # don't compare directly equality because of REAL type
+    min_lat, max_lat, min_lon, max_lon = -90.0, 90.0, -180.0, 180.0
+    if lat:
+        min_lat, max_lat = lat - COORD_TOLERANCE, lat + COORD_TOLERANCE
+    if lon:
+        min_lon, max_lon = lon - COORD_TOLERANCE, lon + COORD_TOLERANCE
+
+    return partial(
+        city_grid.in_bbox,
+        min_lat=min_lat, min_lon=min_lon, max_lat=max_lat, max_lon=max_lon
+    ), None
+
+def check_temperature(data):
+    """
+    Validate the payload of a new temperature reading
+
+    Parameters
+    ----------
+    data: Dict[str, Any]
+        decoded JSON body of the reading
+
+    Returns
+    -------
+        error: str
+            description of the first problem found, None if valid
+    """
+
+    target_cols = ["idOras", "valoare"]
+    all_fields_passed = all([key in data for key in target_cols])
+    wrong_fields = any([key not in target_cols for key in data])
+
+    if not all_fields_passed or wrong_fields:
+        return "Error: please provide exactly city id and temp value"
+
+    if not check_types([data["idOras"], data["valoare"]], [int, float]):
+        return "Invalid data type detected for field"
+
+    return None
+
+def insert_temperatures(cursor, readings):
+    """
+    Insert several temperature readings with a single statement
+
+    Parameters
+    ----------
+    cursor: psycopg2.extensions.cursor
+        cursor of the ongoing transaction
+
+    readings: List[Tuple[int, float]]
+        (city id, value) pairs, city ids must already be validated
+
+    Returns
+    -------
+        rows: List[Tuple[int, datetime]]
+            ids and timestamps of the new rows, in the order of `readings`
+    """
+
+    # the partitions of the coming months are kept created from then on
+    partitions.partition_keeper.start()
+    queries.execute(
+        cursor, "insert_temperatures",
+        ([elem[0] for elem in readings], [elem[1] for elem in readings])
+    )
+    rows = cursor.fetchall()
+    rollup.add_readings(cursor, rows)
+    notify_readings(cursor, [
+        ("insert", new_id, city_id, value, timestamp)
+        for (city_id, value), (new_id, timestamp) in zip(readings, rows)
+    ])
+
+    return rows
+
+def notify_readings(cursor, changes):
+    """
+    Publish changed readings to the live feed (see livefeed), once the
+    transaction of `cursor` commits
+
+    Parameters
+    ----------
+    changes: List[Tuple[str, int, int, float, datetime]]
+        event ("insert", "update" or "delete"), id, city id, value and
+        timestamp of each changed reading
+    """
+
+    if not livefeed.LIVE_FEED_ENABLED or not changes:
+        return
+
+    queries.execute(cursor, "notify_readings", ([
+        livefeed.payload(event, {
+            "id": reading_id,
+            "idOras": city_id,
+            "valoare": value,
+            "timestamp": timestamp.strftime("%Y-%m-%d")
+        })
+        for event, reading_id, city_id, value, timestamp in changes
+    ],))
+
+def stream_records(select, cols, params=None, fmt="json"):
+    """
+    Send the result of a query in an output format, chunk by chunk
+
+    Rows are read through a server-side (named) cursor, so neither the
+    database driver nor the response ever hold more than
+    STREAM_CHUNK_SIZE rows at once.
+
+    The connection and its transaction are kept until the last chunk is
+    sent: a client reading slower than STREAM_IDLE_TIMEOUT seconds per
+    chunk gets a truncated listing, the database ending the session
+    rather than keeping its snapshot (and locks) open for as long as the
+    client takes.
+
+    Parameters
+    ----------
+    select: str
+        SELECT statement to be run (without the trailing semicolon)
+
+    cols: List[str]
+        keys / column names for the columns returned by `select`
+
+    params: Tuple[Any]
+        parameters for the placeholders of `select`
+
+    fmt: str
+        output format (key of FORMATS)
+
+    Returns
+    -------
+        res: flask.Response
+            streamed response with the records
+    """
+
+    def generate():
+        with reads().connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(STREAM_IDLE_SQL, (STREAM_IDLE_MS,))
+            with conn.cursor(name="stream_records") as cursor:
+                cursor.execute(stream_query(select, cols, fmt) + ";", params)
+                rows = cursor.fetchmany(STREAM_CHUNK_SIZE)
+
+                # the query ran fine, the response can be started
+                yield None
+
+                yield from encode_chunks(rows, cols, fmt)
+                while rows:
+                    rows = cursor.fetchmany(STREAM_CHUNK_SIZE)
+                    yield from encode_chunks(rows, cols, fmt, first=False)
+
+    # run the query now so errors are reported before the status is sent
+    chunks = generate()
+    next(chunks)
+
+    return Response(
+        status=200,
+        response=chunks,
+        mimetype=FORMATS[fmt]
+    )
+
+def encode_chunks(rows, cols, fmt, first=True):
+    """
+    Pieces of a streamed listing for one chunk of the rows of a
+    stream_query (an empty chunk ends the listing)
+    """
+
+    if fmt == "json":
+        if first:
+            yield "["
+        if rows:
+            yield ("" if first else ",") + ",".join([elem[0] for elem in rows])
+        else:
+            yield "]"
+    elif fmt == "ndjson":
+        if rows:
+            yield "".join([elem[0] + "\n" for elem in rows])
+    elif fmt == "csv":
+        if first:
+            yield csv_lines([cols])
+        if rows:
+            yield csv_lines(rows)
+    elif rows:
+        # columnar: a single row holding the whole document
+        yield rows[0][0]
+
+
+def page_query(select, conds, page, time_keyed=False):
+    """
+    Build the query reading one page of a listing (keyset pagination)
+
+    Rows are ordered by id (or by (timestamp, id) for temperatures) and
+    the page starts right after the cursor, so every page costs an index
+    range scan no matter how deep into the listing it is. One extra row
+    is read to tell whether a next page follows.
+
+    Parameters
+    ----------
+    select: str
+        SELECT ... FROM part of the query, for time keyed pages the last
+        column must be the raw timestamp
+
+    conds: List[Tuple[str, List[Any]]]
+        conditions the rows must match and their parameters
+
+    page: Tuple[int, Any]
+        page size and decoded cursor, as returned by read_page_args
+
+    time_keyed: bool
+        True = order by (timestamp, id), False = order by id
+
+    Returns
+    -------
+        query: str
+            SELECT statement with placeholders
+
+        params: List[Any]
+            values of the placeholders
+    """
+
+    limit, after = page
+    conds = list(conds)
+
+    if time_keyed:
+        key = "Temperaturi.timestamp, Temperaturi.id"
+    else:
+        key = "id"
+
+    if after is not None:
+        if time_keyed:
+            # the row comparison alone doesn't prune the month partitions
+            conds.append(
+                ("Temperaturi.timestamp >= %s::timestamp", [after[0]])
+            )
+            conds.append((f"({key}) > (%s::timestamp, %s::int)", list(after)))
+        else:
+            conds.append(("id > %s", [after]))
+
+    clause, params = where(conds)
+    # one extra row tells whether there is a next page
+    query = f"{select}{clause} ORDER BY {key} LIMIT %s"
+    params.append(limit + 1)
+
+    return query, params
+
+def page_result(res, page, cols, args, base_url, time_keyed=False):
+    """
+    Turn the rows read by a page_query into the page records and the
+    headers pointing to the next page
+
+    When more rows follow, the cursor of the next page is sent in the
+    X-Next-Cursor header and as a Link header.
+
+    Parameters
+    ----------
+    res: List[Tuple[Any]]
+        rows returned by the page query
+
+    page: Tuple[int, Any]
+        page size and decoded cursor, as returned by read_page_args
+
+    cols: List[str]
+        JSON keys for the leading columns of the rows
+
+    args: werkzeug.datastructures.MultiDict
+        URL params of the request
+
+    base_url: str
+        URL of the request without the URL params
+
+    time_keyed: bool
+        True = order by (timestamp, id), False = order by id
+
+    Returns
+    -------
+        records: List[Dict[str, Any]]
+            records of the page
+
+        headers: Dict[str, str]
+            next page headers, empty on the last page
+    """
+
+    limit = page[0]
+    records = []
+    for elem in res[:limit]:
+        records.append({k:v for k, v in zip(cols, elem)})
+
+    headers = {}
+    if len(res) > limit:
+        last = res[limit - 1]
+        if time_keyed:
+            next_cursor = f"{last[-1].isoformat()},{last[0]}"
+        else:
+            next_cursor = str(last[0])
+
+        args = args.to_dict()
+        args.update(after=next_cursor, limit=limit)
+        headers["X-Next-Cursor"] = next_cursor
+        headers["Link"] = f'<{base_url}?{urlencode(args)}>; rel="next"'
+
+    return records, headers
+
+def send_page(select, conds, page, cols, time_keyed=False, fmt="json"):
+    """
+    Send one page of a listing using keyset pagination (see page_query
+    and page_result)
+
+    Returns
+    -------
+        res: flask.Response
+            records of the page in the output format `fmt`
+    """
+
+    query, params = page_query(select, conds, page, time_keyed)
+
+    with reads().transaction() as cursor:
+        queries.execute(cursor, query, params, kind="page")
+        res = cursor.fetchall()
+
+    records, headers = page_result(
+        res, page, cols, request.args, request.base_url, time_keyed
+    )
+
+    return Response(
+        status=200,
+        response=render_records(records, cols, fmt),
+        mimetype=FORMATS[fmt],
+        headers=headers
+    )
+
+
+def is_fresh(etag, last_modified, if_none_match, if_modified_since):
+    """
+    Check whether the copy held by the client is still current
+
+    Parameters
+    ----------
+    etag: str
+        current version of the data
+
+    last_modified: datetime
+        time of the change which produced the current version
+
+    if_none_match: werkzeug.datastructures.ETags
+        parsed If-None-Match header (empty if missing)
+
+    if_modified_since: datetime
+        parsed If-Modified-Since header, None if missing
+
+    Returns
+    -------
+        res: bool
+            True = a 304 Not Modified can be sent
+    """
+
+    if if_none_match:
+        return if_none_match.contains_weak(etag)
+
+    if if_modified_since:
+        if if_modified_since.tzinfo is None:
+            if_modified_since = if_modified_since.replace(tzinfo=timezone.utc)
+        return last_modified <= if_modified_since
+
+    return False
+
+def conditional(table):
+    """
+    Answer conditional GET requests (If-None-Match / If-Modified-Since)
+    for data read from `table` with 304 Not Modified while the table is
+    unchanged, without running the handler nor touching the database
+
+    Successful responses get the ETag and Last-Modified headers of the
+    table version read before running the handler, so a change made
+    while the handler runs is always seen on the next request. Responses
+    read from a replica which may miss the last change are sent untagged
+    (see replica_may_lag).
+    """
+
+    def decorator(handler):
+
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            etag, last_modified = table_versions.get(table)
+            lagging = replica_may_lag(table)
+            # every output format is a separate representation
+            fmt, _ = read_format(request.args, request.accept_mimetypes)
+            if fmt and fmt != "json":
+                etag = f"{etag}-{fmt}"
+
+            if is_fresh(etag, last_modified, request.if_none_match,
+                        request.if_modified_since):
+                response = Response(status=304)
+            else:
+                response = handler(*args, **kwargs)
+                if response.status_code != 200 or lagging:
+                    return response
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.vary.add("Accept")
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def reads():
+    """
+    Pool serving the reads of the current request: the read replicas
+    (see database.ReadPool), the primary for a client which just wrote
+    (read your writes, see stick_to_primary)
+    """
+
+    if request.cookies.get(STICKY_COOKIE):
+        return pool
+    return read_pool
+
+def replica_may_lag(*tables):
+    """
+    True if the reads of the current request go to the replicas while
+    this process changed one of `tables` less than REPLICA_STICKY_SECONDS
+    ago: the replicas may not have the change yet, so the response must
+    neither be cached nor carry the new table version
+    """
+
+    return (bool(read_pool.replicas) and reads() is read_pool
+            and table_versions.changed_within(REPLICA_STICKY_SECONDS,
+                                              *tables))
+
+@app.after_request
+def stick_to_primary(response):
+    """
+    send the next reads of a client which wrote to the primary for a
+    while, the replicas may not have its write yet
+    """
+
+    if (read_pool.replicas and REPLICA_STICKY_SECONDS > 0
+            and request.method not in ("GET", "HEAD", "OPTIONS")
+            and response.status_code < 400):
+        response.set_cookie(
+            STICKY_COOKIE, "1", max_age=REPLICA_STICKY_SECONDS,
+            httponly=True, samesite="Lax"
+        )
+
+    return response
+
+@app.before_request
+def start_timer():
+    """remember when the request started (see record_request)"""
+
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    """record the duration and size of the response in the metrics"""
+
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    method = request.method
+    started = g.get("started", time.perf_counter())
+
+    def done(size):
+        metrics.observe_request(
+            route, method, response.status_code,
+            time.perf_counter() - started, size
+        )
+
+    # streamed bodies are measured once completely sent
+    if response.is_streamed:
+        response.response = metrics.measure_chunks(response.response, done)
+    elif response.content_length is not None:
+        done(response.content_length)
+    else:
+        done(len(response.get_data()))
+
+    return response
+
+@app.before_request
+def start_trace():
+    """
+    collect the SQL statements of the request (see tracing), until the
+    next request of the thread: streamed bodies run after the request
+    context is gone
+    """
+
+    tracing.begin(
+        request.path, tracing.requested(request.headers, request.args)
+    )
+
+@app.after_request
+def send_trace(response):
+    """send the SQL statements of a traced request in a response header"""
+
+    if response.mimetype == "text/event-stream":
+        # event streams never end, they are sent without a trace
+        tracing.end()
+    elif tracing.active():
+        # the statements of a streamed body run while it is sent, so the
+        # body is built before the header (traced requests only)
+        response.get_data()
+        response.headers[tracing.TRACE_HEADER] = tracing.header(
+            tracing.end()
+        )
+
+    return response
+
+@app.after_request
+def compress_response(response):
+    """
+    compress textual bodies for clients accepting it (see compress),
+    streamed ones chunk by chunk while they are sent
+    """
+
+    if (response.status_code != 200 or "Content-Encoding" in response.headers
+            or not compress.compressible(response.mimetype)):
+        return response
+
+    # the body depends on Accept-Encoding, even when sent as it is
+    response.vary.add("Accept-Encoding")
+    encoding = compress.choose_encoding(request.headers.get("Accept-Encoding"))
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        # small bodies aren't worth it, the start of the stream tells
+        chunks = iter(response.response)
+        head, done = compress.peek(chunks, compress.COMPRESS_MIN_SIZE)
+        if done:
+            response.set_data(b"".join(head))
+            return response
+        response.response = compress.compress_chunks(head, chunks, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < compress.COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress.compress_body(data, encoding))
+
+    response.headers["Content-Encoding"] = encoding
+    # same content, other bytes: the validator only holds weakly
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """handle GET request for the metrics of this process"""
+
+    return Response(
+        status=200,
+        response=metrics.render(),
+        mimetype="text/plain; version=0.0.4"
+    )
+
+
+@app.errorhandler(errors.UniqueViolation)
+@app.errorhandler(errors.ForeignKeyViolation)
+def handle_constraint_violation(exc):
+    """report writes rejected by the DB constraints as conflicts"""
+
+    # the city ids of the readings are checked through the id cache, so
+    # they can only fail when it's stale (unknown countries of cities are
+    # client errors, checked by the database alone)
+    if exc.diag.constraint_name == "temperaturi_idoras_fkey":
+        refcache.clear()
+
+    error = CONSTRAINT_ERRORS.get(exc.diag.constraint_name)
+    if error is None:
+        error = ("Error: FOREIGN KEY violation - unknown id"
+                 if isinstance(exc, errors.ForeignKeyViolation)
+                 else "Error: unique constraint violated")
+
+    return Response(status=409, response=error)
+
 
 @app.route("/api/countries", methods=["GET"])
+@conditional("Tari")
 def get_countries():
     """handle GET request for countries"""
 
-    cursor.execute("SELECT * from Tari;")
-    res = cursor.fetchall()
+    fmt, error = read_format(request.args, request.accept_mimetypes)
+    if error:
+        return Response(status=400, response=error)
 
-    records = []
-    for elem in res:
-        records.append({k:v for k, v in zip(COUNTRY_COLS, elem)})
+    page, error = read_page_args(request.args)
+    if error:
+        return Response(status=400, response=error)
+    if page:
+        return send_page(
+            queries.COUNTRY_SELECT, [], page, COUNTRY_COLS, fmt=fmt
+        )
+    if fmt != "json":
+        return stream_records(queries.COUNTRY_SELECT, COUNTRY_COLS, fmt=fmt)
+
+    with reads().transaction() as cursor:
+        queries.execute(cursor, "countries")
+        body = cursor.fetchone()[0]
 
     return Response(
         status=200,
-        response=json.dumps(records),
+        response=body,
         mimetype="application/json"
     )
 
@@ -119,28 +1111,21 @@ def post_countries():
             response="Invalid data type detected for field"
         )
 
-    vals = ("("
-            + ",".join(
-                [
-                    repr(data["nume"]),
-                    str(data["lat"]),
-                    str(data["lon"])
-                ]
-            )
-            + ")")
+    with pool.transaction() as cursor:
+        # no row is inserted when the country name already exists
+        queries.execute(
+            cursor, "insert_country", (data["nume"], data["lat"], data["lon"])
+        )
+        res = cursor.fetchone()
 
-    # check country name doesn't already exist (preserve unique constraint)
-    cursor.execute(f"SELECT nume FROM Tari where nume={repr(data['nume'])};")
-    if cursor.fetchone():
+    if not res:
         return Response(
             status=409,
             response="Error: country name unique constraint violated"
         )
+    last_id = res[0]
 
-    table = "Tari(nume,lat,lon)"
-    cursor.execute(f"INSERT INTO {table} VALUES {vals} RETURNING id;")
-    last_id = cursor.fetchone()[0]
-    db.commit()
+    table_versions.bump("Tari")
 
     return Response(
         status=201,
@@ -187,31 +1172,21 @@ def put_countries(req_id):
             response="body and URL id don't match"
         )
 
-    # check country id exists in corresponding DB relation
-    cursor.execute(f"SELECT id FROM Tari where id={req_id}")
-    if not cursor.fetchone():
-        return Response(
-            status=404,
-            response="Requested id for country not found"
+    # a name taken by another country is reported by the error handler
+    with pool.transaction() as cursor:
+        queries.execute(
+            cursor, "update_country",
+            (data["nume"], data["lat"], data["lon"], req_id)
         )
+        found = cursor.fetchone()
 
-    # check country name to be updated doesn't already exist
-    cursor.execute(f"SELECT nume FROM Tari where nume={repr(data['nume'])};")
-    if cursor.fetchone():
+    if not found:
         return Response(
-            status=409,
-            response="Error: country name unique constraint violated"
+            status=404,
+            response="Requested id for country not found"
         )
 
-    vals = ",".join(
-                [
-                    "nume=" + repr(data["nume"]),
-                    "lat=" + str(data["lat"]),
-                    "lon=" + str(data["lon"])
-                ]
-            )
-    cursor.execute(f"UPDATE Tari SET {vals} WHERE id={req_id};")
-    db.commit()
+    table_versions.bump("Tari")
 
     return Response(
         status=200,
@@ -222,15 +1197,21 @@ def put_countries(req_id):
 def delete_countries(req_id):
     """handle DELETE request for countries"""
 
-    cursor.execute(f"SELECT id from Tari where id={req_id}")
-    if not cursor.fetchone():
+    with pool.transaction() as cursor:
+        queries.execute(cursor, "delete_country", (req_id,))
+        found = cursor.fetchone()
+
+    if not found:
         return Response(
             status=404,
             response="Requested id for country not found"
         )
 
-    cursor.execute(f"DELETE FROM Tari WHERE id={req_id};")
-    db.commit()
+    refcache.remove_country(req_id)
+    ts_store.invalidate()
+    city_grid.invalidate()
+    table_versions.bump("Tari", "Orase")
+    response_cache.clear()
 
     return Response(
         status=200,
@@ -238,36 +1219,60 @@ def delete_countries(req_id):
     )
 
 @app.route("/api/cities", methods=["GET"])
+@conditional("Orase")
 def get_cities():
     """handle GET request for cities"""
 
-    cursor.execute("SELECT * from Orase;")
-    res = cursor.fetchall()
+    fmt, error = read_format(request.args, request.accept_mimetypes)
+    if error:
+        return Response(status=400, response=error)
 
-    records = []
-    for elem in res:
-        records.append({k:v for k, v in zip(CITY_COLS, elem)})
+    page, error = read_page_args(request.args)
+    if error:
+        return Response(status=400, response=error)
+    if page:
+        return send_page(queries.CITY_SELECT, [], page, CITY_COLS, fmt=fmt)
+    if fmt != "json":
+        return stream_records(queries.CITY_SELECT, CITY_COLS, fmt=fmt)
+
+    with reads().transaction() as cursor:
+        queries.execute(cursor, "cities")
+        body = cursor.fetchone()[0]
 
     return Response(
         status=200,
-        response=json.dumps(records),
+        response=body,
         mimetype="application/json"
     )
 
 @app.route("/api/cities/country/<int:req_id>", methods=["GET"])
+@conditional("Orase")
 def get_cities_by_country(req_id):
     """handle GET request for cities from a certain country"""
 
-    cursor.execute(f"SELECT * from Orase WHERE idTara={req_id};")
-    res = cursor.fetchall()
+    fmt, error = read_format(request.args, request.accept_mimetypes)
+    if error:
+        return Response(status=400, response=error)
+
+    conds = [("idTara = %s", [req_id])]
+    page, error = read_page_args(request.args)
+    if error:
+        return Response(status=400, response=error)
+    if page:
+        return send_page(queries.CITY_SELECT, conds, page, CITY_COLS, fmt=fmt)
+    if fmt != "json":
+        clause, params = where(conds)
+        return stream_records(
+            queries.CITY_SELECT + clause, CITY_COLS, params, fmt
+        )
 
-    records = []
-    for elem in res:
-        records.append({k:v for k, v in zip(CITY_COLS, elem)})
+    with reads().transaction() as cursor:
+        queries.execute(cursor, "cities_of_country", (req_id,))
+        body = cursor.fetchone()[0]
 
     return Response(
         status=200,
-        response=json.dumps(records),
+        response=body,
         mimetype="application/json"
     )
 
@@ -303,43 +1308,27 @@ def post_cities():
             response="Invalid data type detected for field"
         )
 
-    id_cond = f"idTara={data['idTara']}"
-    name_cond = f"nume={repr(data['nume'])}"
-    base_query = "SELECT idTara, nume FROM Orase"
-
-    cursor.execute(f"{base_query} where {id_cond} AND {name_cond};")
-    if cursor.fetchone():
-        return Response(
-            status=409,
-            response="Error: (id, name) unique constraint violated"
+    # an unknown country is reported by the error handler, an existing
+    # (country, name) pair makes the insert return no row
+    with pool.transaction() as cursor:
+        queries.execute(
+            cursor, "insert_city",
+            (data["idTara"], data["nume"], data["lat"], data["lon"])
         )
+        res = cursor.fetchone()
 
-    cursor.execute("SELECT id from Tari;")
-    country_ids = list(map(lambda elem:elem[0], cursor.fetchall()))
-
-    if data["idTara"] not in country_ids:
+    if not res:
         return Response(
             status=409,
-            response="Error: FOREIGN KEY violation - unknown country id"
+            response="Error: (id, name) unique constraint violated"
         )
+    last_id = res[0]
 
-
-    vals = ("("
-            + ",".join(
-                [
-                    str(data["idTara"]),
-                    repr(data["nume"]),
-                    str(data["lat"]),
-                    str(data["lon"])
-                ]
-            )
-            + ")")
-
-    table = "Orase(idTara,nume,lat,lon)"
-    cursor.execute(f"INSERT INTO {table} VALUES {vals} RETURNING id;")
-
-    last_id = cursor.fetchone()[0]
-    db.commit()
+    refcache.add_city(last_id, data["idTara"])
+    city_grid.invalidate()
+    table_versions.bump("Orase")
+    # cached area listings don't know the new city yet
+    response_cache.invalidate("geo")
 
     return Response(
         status=201,
@@ -387,44 +1376,30 @@ def put_cities(req_id):
             response="body and URL id don't match"
         )
 
-    cursor.execute(f"SELECT id FROM Orase where id={req_id}")
-    if not cursor.fetchone():
-        return Response(
-            status=404,
-            response="Requested id for city not found"
-        )
-
-
-    id_cond = f"idTara={data['idTara']}"
-    name_cond = f"nume={repr(data['nume'])}"
-    base_query = "SELECT idTara, nume FROM Orase"
-
-    cursor.execute(f"{base_query} where {id_cond} AND {name_cond};")
-    if cursor.fetchone():
-        return Response(
-            status=409,
-            response="Error: (id, name) unique constraint violated"
+    # the update returns the previous country of the city, constraint
+    # violations are reported by the error handler
+    with pool.transaction() as cursor:
+        queries.execute(
+            cursor, "update_city",
+            (data["idTara"], data["nume"], data["lat"], data["lon"], req_id)
         )
+        old = cursor.fetchone()
+        if not old:
+            return Response(
+                status=404,
+                response="Requested id for city not found"
+            )
 
-    cursor.execute("SELECT id from Tari;")
-    country_ids = list(map(lambda elem:elem[0], cursor.fetchall()))
-
-    if data["idTara"] not in country_ids:
-        return Response(
-            status=409,
-            response="Error: FOREIGN KEY violation - unknown country id"
-        )
+        # the readings of the city now count for another country
+        if old[0] != data["idTara"]:
+            rollup.refresh_countries(cursor, [old[0], data["idTara"]])
 
-    vals = ",".join(
-                [
-                    "idTara=" + str(data["idTara"]),
-                    "nume=" + repr(data["nume"]),
-                    "lat=" + str(data["lat"]),
-                    "lon=" + str(data["lon"])
-                ]
-            )
-    cursor.execute(f"UPDATE Orase SET {vals} WHERE id={req_id};")
-    db.commit()
+    refcache.add_city(req_id, data["idTara"])
+    city_grid.invalidate()
+    table_versions.bump("Orase")
+    response_cache.invalidate(
+        "geo", ("country", old[0]), ("country", data["idTara"])
+    )
 
     return Response(
         status=200,
@@ -435,15 +1410,22 @@ def put_cities(req_id):
 def delete_cities(req_id):
     """handle DELETE request for cities"""
 
-    cursor.execute(f"SELECT id from Orase where id={req_id}")
-    if not cursor.fetchone():
-        return Response(
-            status=404,
-            response="Requested id for city not found"
-        )
+    with pool.transaction() as cursor:
+        queries.execute(cursor, "delete_city", (req_id,))
+        old = cursor.fetchone()
+        if not old:
+            return Response(
+                status=404,
+                response="Requested id for city not found"
+            )
+
+        rollup.refresh_countries(cursor, [old[0]])
 
-    cursor.execute(f"DELETE FROM Orase WHERE id={req_id};")
-    db.commit()
+    refcache.remove_city(req_id)
+    ts_store.remove_city(req_id)
+    city_grid.invalidate()
+    table_versions.bump("Orase")
+    response_cache.invalidate("all", ("city", req_id), ("country", old[0]))
 
     return Response(status=200,response="DB updated with city deleted")
 
@@ -456,218 +1438,679 @@ def post_temperatures():
     if not data:
         return Response(status=400, response="Error: No JSON format detected")
 
-    target_cols = ["idOras", "valoare"]
-    all_fields_passed = all([key in data for key in target_cols])
-    wrong_fields = any([key not in target_cols for key in data])
+    error = check_temperature(data)
+    if error:
+        return Response(status=400, response=error)
 
-    if not all_fields_passed or wrong_fields:
+    if ingest.INGEST_BUFFERED:
+        return post_temperature_buffered(data)
+
+    with pool.transaction() as cursor:
+        if not refcache.has_city(cursor, data["idOras"]):
+            return Response(
+                status=409,
+                response="Error: FOREIGN KEY violation - unknown city id"
+            )
+
+        last_id, timestamp = insert_temperatures(
+            cursor,
+            [(data["idOras"], data["valoare"])]
+        )[0]
+
+    ts_store.add(data["idOras"], last_id, timestamp, data["valoare"])
+    invalidate_readings([data["idOras"]])
+
+    return Response(
+        status=201,
+        response=json.dumps({"id":last_id}),
+        mimetype="application/json"
+    )
+
+def post_temperature_buffered(data):
+    """
+    Queue a validated reading in the ingest buffer (see ingest) and
+    answer once it is committed or, with INGEST_ACK=enqueue, right away
+    """
+
+    # a cached city needs no connection (the flush checks the ids again),
+    # the database is only asked to load the cache or for an unknown id
+    if refcache.country_of(data["idOras"]) is None:
+        with pool.transaction() as cursor:
+            if not refcache.has_city(cursor, data["idOras"]):
+                return Response(
+                    status=409,
+                    response="Error: FOREIGN KEY violation - unknown city id"
+                )
+
+    try:
+        pending = ingest_buffer.submit(
+            (data["idOras"], data["valoare"]), ingest.INGEST_ENQUEUE_TIMEOUT
+        )
+    except ingest.QueueFull:
         return Response(
-            status=400,
-            response="Error: please provide exactly city id and temp value"
+            status=503,
+            response="Error: too many readings queued, retry later",
+            headers={"Retry-After": "1"}
         )
 
-    if not check_types([data["idOras"], data["valoare"]], [int, float]):
+    if ingest.INGEST_ACK == "enqueue":
         return Response(
-            status=400,
-            response="Invalid data type detected for field"
+            status=202,
+            response=json.dumps({"id": None}),
+            mimetype="application/json"
         )
 
-    vals = ("("
-            + ",".join(
-                [
-                    str(data["idOras"]),
-                    str(data["valoare"])
-                ]
-            )
-            + ")")
-
-    cursor.execute("SELECT id from Orase;")
-    city_ids = list(map(lambda elem:elem[0], cursor.fetchall()))
-    if data["idOras"] not in city_ids:
+    if not pending.wait(ingest.INGEST_COMMIT_TIMEOUT):
         return Response(
-            status=409,
-            response="Error: FOREIGN KEY violation - unknown city id"
+            status=504,
+            response="Error: reading not committed in time"
         )
-
-    table = "Temperaturi(idOras, valoare)"
-    cursor.execute(f"INSERT INTO {table} VALUES {vals} RETURNING id;")
-
-    last_id = cursor.fetchone()[0]
-    db.commit()
+    if pending.error:
+        status = 409 if "FOREIGN KEY" in pending.error else 503
+        return Response(status=status, response=pending.error)
 
     return Response(
         status=201,
-        response=json.dumps({"id":last_id}),
+        response=json.dumps({"id":pending.result[0]}),
         mimetype="application/json"
     )
 
-@app.route("/api/temperatures", methods=["GET"])
-def get_temperatures():
-    """handle GET request for temperatures"""
+def write_buffered(readings):
+    """
+    Insert the readings gathered by the ingest buffer with one commit
 
-    # extract URL params (if not passed, defaults to None)
-    lat = request.args.get("lat", type=float)
-    lon = request.args.get("lon", type=float)
-    from_date = request.args.get("from", type=str)
-    to_date = request.args.get("until", type=str)
+    Parameters
+    ----------
+    readings: List[Tuple[int, float]]
+        (city id, value) pairs, checked when they were queued
 
-    if check_date(from_date) == 1 or check_date(to_date) == 1:
+    Returns
+    -------
+        res: List[Any]
+            (id, timestamp) of the row of each reading, or the error
+            rejecting it
+    """
+
+    for attempt in range(2):
+        try:
+            with pool.transaction() as cursor:
+                # cities may have been deleted since the readings were
+                # queued
+                known_ids = refcache.known_cities(
+                    cursor, [elem[0] for elem in readings]
+                )
+                valid = [i for i, elem in enumerate(readings)
+                         if elem[0] in known_ids]
+                new_rows = insert_temperatures(
+                    cursor, [readings[i] for i in valid]
+                ) if valid else []
+            break
+        except errors.ForeignKeyViolation:
+            # deleted by another process, the id cache was stale
+            refcache.clear()
+            if attempt:
+                raise
+
+    results = (
+        ["Error: FOREIGN KEY violation - unknown city id"] * len(readings)
+    )
+    for i, (new_id, timestamp) in zip(valid, new_rows):
+        results[i] = (new_id, timestamp)
+        ts_store.add(readings[i][0], new_id, timestamp, readings[i][1])
+    if valid:
+        invalidate_readings({readings[i][0] for i in valid})
+
+    return results
+
+ingest_buffer = ingest.IngestBuffer(
+    write_buffered,
+    max_size=ingest.INGEST_QUEUE_SIZE,
+    max_rows=ingest.INGEST_FLUSH_ROWS,
+    interval=ingest.INGEST_FLUSH_MS / 1000
+)
+# readings still queued are written before the process exits
+atexit.register(ingest_buffer.close)
+
+metrics.Callback(
+    "ingest_queue_readings",
+    "Readings waiting in the ingest buffer",
+    (),
+    lambda: [((), ingest_buffer.size())]
+)
+
+@app.route("/api/temperatures/batch", methods=["POST"])
+def post_temperatures_batch():
+    """handle POST request for a batch of temperatures"""
+
+    # the batch is either a JSON array or one JSON object per line
+    if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            return Response(
+                status=400,
+                response="Error: expected a JSON array or NDJSON body"
+            )
+
+    if not items:
+        return Response(status=400, response="Error: empty batch")
+
+    if len(items) > MAX_BATCH_SIZE:
         return Response(
-            status=400,
-            response="invalid date format, please use YYYY-MM-DD"
+            status=413,
+            response=f"Error: at most {MAX_BATCH_SIZE} readings per batch"
         )
 
-    if check_date(from_date) == 2 or check_date(to_date) == 2:
-        return Response(
-            status=400,
-            response="invalid date, please pass a correct day"
+    results = [None] * len(items)
+    for i, data in enumerate(items):
+        if not isinstance(data, dict) or not data:
+            results[i] = {"error": "Error: No JSON format detected"}
+            continue
+
+        error = check_temperature(data)
+        if error:
+            results[i] = {"error": error}
+
+    checked = [i for i, res in enumerate(results) if res is None]
+
+    for attempt in range(2):
+        try:
+            with pool.transaction() as cursor:
+                # check all referenced cities at once
+                known_ids = refcache.known_cities(
+                    cursor,
+                    [items[i]["idOras"] for i in checked]
+                )
+                valid = [i for i in checked
+                         if items[i]["idOras"] in known_ids]
+                new_rows = insert_temperatures(
+                    cursor,
+                    [(items[i]["idOras"], items[i]["valoare"]) for i in valid]
+                ) if valid else []
+            break
+        except errors.ForeignKeyViolation:
+            # deleted by another process, the id cache was stale: the ids
+            # are checked again so they are reported per reading
+            refcache.clear()
+            if attempt:
+                raise
+
+    for i in checked:
+        results[i] = {
+            "error": "Error: FOREIGN KEY violation - unknown city id"
+        }
+    for i, (new_id, timestamp) in zip(valid, new_rows):
+        results[i] = {"id": new_id}
+        ts_store.add(
+            items[i]["idOras"], new_id, timestamp, items[i]["valoare"]
         )
+    if valid:
+        invalidate_readings({items[i]["idOras"] for i in valid})
 
-    geo_conds = []  # geographic conditions(latitude and/or longitude)
-    time_conds = [] # time conditions (entry date interval)
+    if not valid:
+        status = 400
+    elif len(valid) < len(items):
+        status = 207
+    else:
+        status = 201
 
-    # don't compare directly equality because of REAL type
-    if lat:
-        geo_conds.append(f"ABS(lat-{lat})<=0.001")
-    if lon:
-        geo_conds.append(f"ABS(lon-{lon})<=0.001")
+    return Response(
+        status=status,
+        response=json.dumps(results),
+        mimetype="application/json"
+    )
+
+def rollup_query(city_conds, scope, bucket, aggs, args):
+    """
+    Build the query computing per bucket statistics from the rollups
+
+    The `from`/`until` URL params are days, so the rollup buckets from
+    `from` (inclusive) up to `until` (exclusive) hold exactly the same
+    readings as the raw table. Only the readings taken exactly at the
+    `until` instant, which the raw filter also includes, are read from
+    Temperaturi.
+    """
+
+    from_date = args.get("from", type=str)
+    to_date = args.get("until", type=str)
+    table, scope_conds = scope
 
+    source = rollup.SOURCE_BUCKETS[bucket]
+    rollup_conds = [(f"granularitate = '{source}'", [])] + list(scope_conds)
     if from_date:
-        time_conds.append(f"timestamp>={repr(from_date)}")
+        rollup_conds.append(("bucket >= %s::timestamp", [from_date]))
     if to_date:
-        time_conds.append(f"timestamp<={repr(to_date)}")
-
-    # merge conditions with AND
-    time_conds = " AND ".join(time_conds)
-    geo_conds = " AND ".join(geo_conds)
-
-    # geographic conditions are used in a subquery in order to produce
-    # a new variable city condition
-    city_cond = ""
-    if geo_conds:
-        city_cond = f"idOras in (SELECT id FROM Orase WHERE {geo_conds})"
-
-    # prepare appropriate query given the URL params
-    table_cols = "id, valoare, TO_CHAR(timestamp, 'YYYY-MM-DD') timestamp"
-    query = f"SELECT {table_cols} FROM Temperaturi"
-
-    if geo_conds and time_conds:
-        query += f" WHERE {city_cond} AND {time_conds};"
-    elif geo_conds or time_conds:
-        query += f" WHERE {city_cond}{time_conds};"
-    else:
-        query += ";"
+        rollup_conds.append(("bucket < %s::timestamp", [to_date]))
+
+    clause, params = where(rollup_conds)
+    query = (f"SELECT date_trunc('{bucket}', bucket) bucket,"
+             f" numar, suma, minim, maxim FROM {table}{clause}")
+
+    if to_date:
+        clause, raw_params = where(
+            [("timestamp = %s::timestamp", [to_date])] + list(city_conds)
+        )
+        query += (f" UNION ALL SELECT date_trunc('{bucket}', timestamp),"
+                  f" 1, valoare, valoare, valoare FROM Temperaturi{clause}")
+        params += raw_params
+
+    cols = ", ".join(ROLLUP_AGGREGATES[agg] for agg in aggs)
+    return (f"SELECT bucket, {cols} FROM ({query}) parts"
+            " GROUP BY 1 ORDER BY 1"), params
+
+def aggregate_query(city_conds, time_conds, scope, bucket, aggs, args):
+    """
+    Build the query computing per time bucket statistics of the
+    matching readings
+
+    Parameters
+    ----------
+    city_conds: List[Tuple[str, List[Any]]]
+        conditions on the city of the readings and their parameters
+
+    time_conds: List[Tuple[str, List[Any]]]
+        conditions on the time of the readings and their parameters
 
-    cursor.execute(query)
-    res = cursor.fetchall()
+    scope: Tuple[str, List[Tuple[str, List[Any]]]]
+        rollup table holding the same readings and the conditions
+        selecting them, None if the readings aren't covered by rollups
+
+    bucket: str
+        date_trunc unit the readings are grouped by
+
+    aggs: List[str]
+        names of the aggregates computed for each bucket
+
+    args: werkzeug.datastructures.MultiDict
+        URL params of the request
+
+    Returns
+    -------
+        query: str
+            SELECT statement returning one row per non-empty bucket
+
+        params: List[Any]
+            values of the placeholders of `query`
+    """
+
+    if scope and bucket in rollup.SOURCE_BUCKETS:
+        return rollup_query(city_conds, scope, bucket, aggs, args)
+
+    clause, params = where(list(city_conds) + list(time_conds))
+    cols = ", ".join(AGGREGATES[agg] for agg in aggs)
+    query = (f"SELECT date_trunc('{bucket}', timestamp) bucket, {cols}"
+             f" FROM Temperaturi{clause} GROUP BY 1 ORDER BY 1")
+    return query, params
+
+def aggregate_records(res, aggs):
+    """Turn the rows read by an aggregate_query into JSON records"""
 
     records = []
     for elem in res:
-        records.append({k:v for k, v in zip(TEMP_COLS, elem)})
+        record = {"bucket": elem[0].isoformat()}
+        record.update({k:v for k, v in zip(aggs, elem[1:])})
+        records.append(record)
+
+    return records
+
+def send_aggregates(city_conds, time_conds, scope, bucket, aggs,
+                    fmt="json"):
+    """
+    Send per time bucket statistics of the matching readings (see
+    aggregate_query)
+
+    Returns
+    -------
+        res: flask.Response
+            one record per non-empty bucket, in time order, in the output
+            format `fmt`
+    """
+
+    query, params = aggregate_query(
+        city_conds, time_conds, scope, bucket, aggs, request.args
+    )
+
+    with reads().transaction() as cursor:
+        queries.execute(cursor, query, params, kind="aggregate")
+        res = cursor.fetchall()
 
     return Response(
         status=200,
-        response=json.dumps(records),
-        mimetype="application/json"
+        response=render_records(
+            aggregate_records(res, aggs), ["bucket"] + aggs, fmt
+        ),
+        mimetype=FORMATS[fmt]
     )
 
+def query_temperatures(city_conds, time_conds, scope=None, fmt="json"):
+    """
+    Send the temperature readings matching the (possibly empty) city and
+    time conditions, streamed in full, as a single page when
+    `limit`/`after` are passed or aggregated per time bucket when
+    `bucket`/`agg` are passed (from the rollups given by `scope`
+    whenever possible, see send_aggregates)
+    """
 
-@app.route("/api/temperatures/cities/<int:req_id>", methods=["GET"])
-def get_city_temperatures(req_id):
-    """handle GET request for city temperatures"""
+    aggregate, error = read_aggregate_args(request.args)
+    if error:
+        return Response(status=400, response=error)
+    if aggregate:
+        return send_aggregates(
+            city_conds, time_conds, scope, *aggregate, fmt=fmt
+        )
 
-    from_date = request.args.get("from", type=str)
-    to_date = request.args.get("until", type=str)
+    conds = list(city_conds) + list(time_conds)
 
-    if check_date(from_date) == 1 or check_date(to_date) == 1:
-        return Response(
-            status=400,
-            response="invalid date format, please use YYYY-MM-DD"
+    page, error = read_page_args(request.args, time_keyed=True)
+    if error:
+        return Response(status=400, response=error)
+    if page:
+        return send_page(
+            TEMP_PAGE_SELECT, conds, page, TEMP_COLS, time_keyed=True,
+            fmt=fmt
         )
 
-    if check_date(from_date) == 2 or check_date(to_date) == 2:
-        return Response(
-            status=400,
-            response="invalid date, please pass a correct day"
-        )
+    # server-side cursors can't be declared over a prepared statement
+    clause, params = where(conds)
+    return stream_records(TEMP_SELECT + clause, TEMP_COLS, params, fmt)
+
+def cache_key(fmt):
+    """
+    Normalized route and URL params of the current request, with its
+    output format (which may come from the Accept header)
+    """
 
-    time_conds = []
+    args = sorted(request.args.items(multi=True))
+    return f"{request.path}?{urlencode(args)} {fmt}"
 
-    if from_date:
-        time_conds.append(f"timestamp>={repr(from_date)}")
-    if to_date:
-        time_conds.append(f"timestamp<={repr(to_date)}")
+def capture_stream(chunks, store):
+    """
+    Pass a streamed body through, handing it to `store` once completely
+    sent, unless it grew too large to be cached
+    """
+
+    parts = []
+    size = 0
+    try:
+        for chunk in chunks:
+            if parts is not None:
+                data = chunk.encode() if isinstance(chunk, str) else chunk
+                size += len(data)
+                if size > response_cache.max_entry_bytes:
+                    parts = None
+                else:
+                    parts.append(data)
+            yield chunk
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+    if parts is not None:
+        store(b"".join(parts))
+
+def send_temperatures(city_conds, time_conds, scope, tags, fmt):
+    """
+    Send the temperature readings matching the city and time conditions
+    (see query_temperatures), through the response cache
+
+    `tags` name the data the response is built from: ("city", id),
+    ("country", id), "countries" (any country), "geo" (city coordinates)
+    or "all" (readings of any city). Writes invalidate them.
 
-    time_conds = " AND ".join(time_conds)
+    A client which just wrote bypasses the cache, like the replicas (see
+    reads): it must see its own writes. So does a read served by the
+    replicas right after a local write (see replica_may_lag), which
+    would otherwise be cached as up to date.
+    """
 
-    table_cols = "id, valoare, TO_CHAR(timestamp, 'YYYY-MM-DD') timestamp"
-    query = f"SELECT {table_cols} FROM Temperaturi"
+    if (not response_cache.enabled or request.cookies.get(STICKY_COOKIE)
+            or replica_may_lag("Temperaturi", "Orase", "Tari")):
+        return query_temperatures(city_conds, time_conds, scope, fmt)
+
+    key = cache_key(fmt)
+    entry = response_cache.get(key)
+    if entry:
+        response = Response(
+            status=200,
+            response=entry.body,
+            mimetype=entry.mimetype,
+            headers=entry.headers
+        )
+        response.headers["X-Cache"] = "HIT"
+        return response
+
+    sequence = response_cache.sequence
+    response = query_temperatures(city_conds, time_conds, scope, fmt)
+    response.headers["X-Cache"] = "MISS"
+    if response.status_code != 200:
+        return response
+
+    headers = {
+        k: response.headers[k] for k in ("X-Next-Cursor", "Link")
+        if k in response.headers
+    }
+    store = partial(
+        response_cache.put,
+        key,
+        mimetype=response.mimetype,
+        headers=headers,
+        tags=tags,
+        sequence=sequence
+    )
 
-    if time_conds:
-        query += f" WHERE idOras={req_id} AND {time_conds};"
+    if response.is_streamed:
+        response.response = capture_stream(response.response, store)
     else:
-        query += f" WHERE idOras={req_id}"
+        store(response.get_data())
 
-    cursor.execute(query)
-    res = cursor.fetchall()
+    return response
 
-    records = []
-    for elem in res:
-        records.append({k:v for k, v in zip(TEMP_COLS, elem)})
+def invalidate_readings(city_ids):
+    """Drop the cached responses built from readings of some cities"""
+
+    table_versions.bump("Temperaturi")
+    tags = ["all"]
+    for city_id in city_ids:
+        tags.append(("city", city_id))
+
+        country_id = refcache.country_of(city_id)
+        if country_id is None:
+            tags.append("countries")
+        else:
+            tags.append(("country", country_id))
+
+    response_cache.invalidate(*tags)
+
+@app.route("/api/cache/stats", methods=["GET"])
+def get_cache_stats():
+    """handle GET request for the response cache counters"""
 
     return Response(
         status=200,
-        response=json.dumps(records),
+        response=json.dumps(response_cache.stats()),
         mimetype="application/json"
     )
 
-@app.route("/api/temperatures/countries/<int:req_id>", methods=["GET"])
-def get_country_temperatures(req_id):
-    """handle GET request for country temperatures"""
-    from_date = request.args.get("from", type=str)
-    to_date = request.args.get("until", type=str)
+def series_records(args, city_ids=None, country_id=None):
+    """
+    Readings of some cities (or of the cities of a country) read from
+    the in-memory time series store, for the validated `from`/`until`
+    URL params
 
-    if check_date(from_date) == 1 or check_date(to_date) == 1:
+    Returns
+    -------
+        res: List[Dict[str, Any]]
+            JSON records of the readings, None when the store is disabled
+            or the listing is paginated or aggregated (database only)
+    """
+
+    if not ts_store.enabled:
+        return None
+    if any(key in args for key in ("limit", "after", "bucket", "agg")):
+        return None
+
+    from_date = args.get("from", type=str)
+    to_date = args.get("until", type=str)
+    start = datetime.fromisoformat(from_date) if from_date else None
+    end = datetime.fromisoformat(to_date) if to_date else None
+
+    if ts_store.stale:
+        # from the primary: a snapshot from a lagging replica would stay
+        # stale, only the local writes are applied to it afterwards
+        with pool.connection() as conn:
+            ts_store.load(conn)
+    if country_id is not None:
+        with reads().transaction() as cursor:
+            city_ids = refcache.cities_of(cursor, country_id)
+
+    return ts_store.records(city_ids, start, end)
+
+def area_filter(city_ids):
+    """
+    City conditions and cache tags of a listing restricted to the cities
+    selected by the geographic URL params
+    """
+
+    # the id list is a single parameter, so the query keeps its shape
+    city_conds = [("idOras = ANY(%s::int[])", [list(city_ids)])]
+
+    tags = ["all"]
+    if len(city_ids) <= MAX_TAGGED_CITIES:
+        tags = [("city", city_id) for city_id in city_ids]
+    tags.append("geo")
+
+    return city_conds, tags
+
+@app.route("/api/temperatures/stream", methods=["GET"])
+def get_temperature_stream():
+    """handle GET request for the live feed of reading changes (SSE)"""
+
+    if not livefeed.LIVE_FEED_ENABLED:
+        return Response(status=404, response="live feed disabled")
+
+    city_ids, country_ids, error = read_feed_args(request.args)
+    if error:
+        return Response(status=400, response=error)
+
+    # each subscriber holds a thread of the worker while connected
+    if live_feed.full(threads=True):
         return Response(
-            status=400,
-            response="invalid date format, please use YYYY-MM-DD"
+            status=503,
+            response="Error: too many live feed subscribers, retry later",
+            headers={"Retry-After": "5"}
         )
 
-    if check_date(from_date) == 2 or check_date(to_date) == 2:
+    def generate():
+        # subscribed once the body is sent, so the generator is always
+        # closed and the subscriber forgotten
+        try:
+            subscriber = live_feed.subscribe(city_ids, country_ids)
+        except livefeed.TooManySubscribers:
+            return
+        try:
+            yield livefeed.RETRY
+            yield from subscriber.messages()
+        finally:
+            live_feed.unsubscribe(subscriber)
+
+    return Response(
+        status=200,
+        response=generate(),
+        mimetype="text/event-stream",
+        headers=livefeed.HEADERS
+    )
+
+@app.route("/api/temperatures", methods=["GET"])
+def get_temperatures():
+    """handle GET request for temperatures"""
+
+    time_conds, error = read_time_args(request.args)
+    if error:
+        return Response(status=400, response=error)
+
+    area, error = read_area_args(request.args)
+    if error:
+        return Response(status=400, response=error)
+
+    fmt, error = read_format(request.args, request.accept_mimetypes)
+    if error:
+        return Response(status=400, response=error)
+
+    # geographic conditions are resolved to the matching city ids, which
+    # produce a new variable city condition
+    city_conds = []
+    tags = ["all"]
+    if area:
+        with reads().transaction() as cursor:
+            city_conds, tags = area_filter(area(cursor))
+
+    return send_temperatures(
+        city_conds, time_conds, ("AgregateOrase", city_conds), tags, fmt
+    )
+
+
+@app.route("/api/temperatures/cities/<int:req_id>", methods=["GET"])
+def get_city_temperatures(req_id):
+    """handle GET request for city temperatures"""
+
+    time_conds, error = read_time_args(request.args)
+    if error:
+        return Response(status=400, response=error)
+
+    fmt, error = read_format(request.args, request.accept_mimetypes)
+    if error:
+        return Response(status=400, response=error)
+
+    records = series_records(request.args, city_ids=[req_id])
+    if records is not None:
         return Response(
-            status=400,
-            response="invalid date, please pass a correct day"
+            status=200,
+            response=render_records(records, TEMP_COLS, fmt),
+            mimetype=FORMATS[fmt]
         )
 
-    time_conds = []
+    city_conds = [("idOras = %s", [req_id])]
 
-    if from_date:
-        time_conds.append(f"timestamp>={repr(from_date)}")
-    if to_date:
-        time_conds.append(f"timestamp<={repr(to_date)}")
+    return send_temperatures(
+        city_conds, time_conds, ("AgregateOrase", city_conds),
+        [("city", req_id)], fmt
+    )
 
-    time_conds = " AND ".join(time_conds)
-    city_cond = f"idOras in (SELECT id from Orase WHERE idTara = {req_id})"
+@app.route("/api/temperatures/countries/<int:req_id>", methods=["GET"])
+def get_country_temperatures(req_id):
+    """handle GET request for country temperatures"""
 
-    table_cols = "id, valoare, TO_CHAR(timestamp, 'YYYY-MM-DD') timestamp"
-    query = f"SELECT {table_cols} FROM Temperaturi"
+    time_conds, error = read_time_args(request.args)
+    if error:
+        return Response(status=400, response=error)
 
-    if time_conds:
-        query += f" WHERE {time_conds} AND {city_cond};"
-    else:
-        query += f" WHERE {city_cond};"
+    fmt, error = read_format(request.args, request.accept_mimetypes)
+    if error:
+        return Response(status=400, response=error)
 
-    cursor.execute(query)
-    res = cursor.fetchall()
+    records = series_records(request.args, country_id=req_id)
+    if records is not None:
+        return Response(
+            status=200,
+            response=render_records(records, TEMP_COLS, fmt),
+            mimetype=FORMATS[fmt]
+        )
 
-    records = []
-    for elem in res:
-        records.append({k:v for k, v in zip(TEMP_COLS, elem)})
+    city_conds = [
+        ("idOras IN (SELECT id FROM Orase WHERE idTara = %s)", [req_id])
+    ]
 
-    return Response(
-        status=200,
-        response=json.dumps(records),
-        mimetype="application/json"
+    return send_temperatures(
+        city_conds, time_conds, ("AgregateTari", [("idTara = %s", [req_id])]),
+        [("country", req_id), "countries"], fmt
     )
 
 @app.route("/api/temperatures/<int:req_id>", methods=["PUT"])
@@ -707,22 +2150,36 @@ def put_temperatures(req_id):
             response="body and URL id don't match"
         )
 
-    cursor.execute(f"SELECT id FROM Temperaturi where id={req_id}")
-    if not cursor.fetchone():
-        return Response(
-            status=404,
-            response="Requested id for temperature not found"
+    with pool.transaction() as cursor:
+        queries.execute(cursor, "reading", (req_id,))
+        old = cursor.fetchone()
+        if not old:
+            return Response(
+                status=404,
+                response="Requested id for temperature not found"
+            )
+
+        if not refcache.has_city(cursor, data["idOras"]):
+            return Response(
+                status=409,
+                response="Error: FOREIGN KEY violation - unknown city id"
+            )
+
+        queries.execute(
+            cursor, "update_reading",
+            (data["idOras"], data["valoare"], req_id, old[1])
         )
+        rollup.refresh_readings(cursor, [old, (data["idOras"], old[1])])
 
+        changes = [("update", req_id, data["idOras"], data["valoare"],
+                    old[1])]
+        if old[0] != data["idOras"]:
+            # gone from the feed of its former city
+            changes.append(("delete", req_id, old[0], None, old[1]))
+        notify_readings(cursor, changes)
 
-    vals = ",".join(
-                [
-                    "idOras=" + str(data["idOras"]),
-                    "valoare=" + str(data["valoare"])
-                ]
-            )
-    cursor.execute(f"UPDATE Temperaturi SET {vals} WHERE id={req_id};")
-    db.commit()
+    ts_store.update(req_id, old[1], old[0], data["idOras"], data["valoare"])
+    invalidate_readings({old[0], data["idOras"]})
 
     return Response(
         status=200,
@@ -733,15 +2190,21 @@ def put_temperatures(req_id):
 def delete_temperatures(req_id):
     """handle DELETE request for temperatures"""
 
-    cursor.execute(f"SELECT id from Temperaturi where id={req_id}")
-    if not cursor.fetchone():
-        return Response(
-            status=404,
-            response="Requested id for city not found"
-        )
+    with pool.transaction() as cursor:
+        queries.execute(cursor, "reading", (req_id,))
+        old = cursor.fetchone()
+        if not old:
+            return Response(
+                status=404,
+                response="Requested id for city not found"
+            )
+
+        queries.execute(cursor, "delete_reading", (req_id, old[1]))
+        rollup.refresh_readings(cursor, [old])
+        notify_readings(cursor, [("delete", req_id, old[0], None, old[1])])
 
-    cursor.execute(f"DELETE FROM Temperaturi WHERE id={req_id};")
-    db.commit()
+    ts_store.remove(old[0], req_id, old[1])
+    invalidate_readings([old[0]])
 
     return Response(status=200,response="DB updated with temp deleted")
 
@@ -0,0 +1,275 @@
+"""
+Metrics of the server process, exposed in the Prometheus text format
+
+Every metric lives in this process only: under gunicorn each worker
+keeps its own counters and a scrape of /metrics reads the worker which
+happened to serve it.
+"""
+import json
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+
+# upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+_registry = []
+
+_VERB = re.compile(r"\s*(\w+)(?:\s+(\w+))?")
+_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", re.IGNORECASE)
+# composed prepared statements are named <kind>_<hash> (see queries)
+_COMPOSED = re.compile(r"(\w+)_[0-9a-f]{16}$")
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(ABC):
+    """
+    Named family of samples, one per combination of label values
+
+    Parameters
+    ----------
+    name: str
+        metric name
+
+    doc: str
+        HELP text
+
+    labels: Tuple[str]
+        label names, their values are passed in the same order
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    @abstractmethod
+    def samples(self):
+        """Lines of the current samples"""
+
+    def render(self):
+        """HELP, TYPE and sample lines of the metric"""
+
+        lines = [f"# HELP {self.name} {self.doc}",
+                 f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Monotonic count"""
+
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        """Add `amount` to the count of the label values"""
+
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} "
+                f"{_format_value(value)}" for key, value in values]
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        """Count one value for the label values"""
+
+        pos = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # per bucket counts (the last one is +Inf) and sum
+                state = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0
+                ]
+            state[0][pos] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total)
+                      for key, (counts, total) in self._values.items()]
+
+        lines = []
+        for key, counts, total in values:
+            count = 0
+            for bound, elem in zip(self.buckets + (float("inf"),), counts):
+                count += elem
+                labels = _format_labels(
+                    self.labels, key, f'le="{_format_value(float(bound))}"'
+                )
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Callback(Metric):
+    """
+    Values read from another component when scraped
+
+    Parameters
+    ----------
+    collect: Callable[[], Iterable[Tuple[Tuple[str], float]]]
+        returns the (label values, value) pairs of the current samples
+
+    kind: str
+        "gauge" or "counter"
+    """
+
+    def __init__(self, name, doc, labels, collect, kind="gauge"):
+        super().__init__(name, doc, labels)
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self):
+        return [f"{self.name}{_format_labels(self.labels, key)} "
+                f"{_format_value(value)}" for key, value in self.collect()]
+
+
+def render():
+    """Every registered metric in the Prometheus text format"""
+
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+request_seconds = Histogram(
+    "http_request_duration_seconds",
+    "Time spent serving requests, until the last byte of the body",
+    ("route", "method", "status")
+)
+response_bytes = Histogram(
+    "http_response_size_bytes",
+    "Size of the response bodies",
+    ("route", "method", "status"),
+    buckets=BYTES_BUCKETS
+)
+query_seconds = Histogram(
+    "db_query_duration_seconds",
+    "Time spent running database statements",
+    ("statement",)
+)
+query_rows = Histogram(
+    "db_query_rows",
+    "Rows returned or changed by database statements",
+    ("statement",),
+    buckets=ROWS_BUCKETS
+)
+json_seconds = Histogram(
+    "json_serialization_duration_seconds",
+    "Time spent encoding response bodies as JSON"
+)
+pool_wait_seconds = Histogram(
+    "db_pool_wait_duration_seconds",
+    "Time spent waiting for a database connection"
+)
+pool_timeouts = Counter(
+    "db_pool_timeouts_total",
+    "Connection checkouts which gave up waiting"
+)
+
+
+def observe_request(route, method, status, seconds, size):
+    """Record a served request"""
+
+    labels = (route, method, str(status))
+    request_seconds.observe(seconds, labels)
+    response_bytes.observe(size, labels)
+
+def observe_query(statement, seconds, rows):
+    """Record a database statement (rows = -1 when unknown)"""
+
+    labels = (statement,)
+    query_seconds.observe(seconds, labels)
+    if rows >= 0:
+        query_rows.observe(rows, labels)
+
+def statement_label(query):
+    """
+    Name of a query for the metrics: the prepared statement it executes
+    (without the hash of composed statements), otherwise its first
+    keyword and the first table it reads or writes (e.g. select_tari)
+    """
+
+    if not isinstance(query, str):
+        return "other"
+
+    match = _VERB.match(query)
+    if not match:
+        return "other"
+
+    verb = match.group(1).lower()
+    if verb == "execute" and match.group(2):
+        composed = _COMPOSED.match(match.group(2))
+        return composed.group(1) if composed else match.group(2)
+    if verb in ("prepare", "deallocate"):
+        return verb
+
+    table = _TABLE.search(query)
+    return f"{verb}_{table.group(1).lower()}" if table else verb
+
+def dumps(obj):
+    """json.dumps, timed"""
+
+    start = time.perf_counter()
+    res = json.dumps(obj)
+    json_seconds.observe(time.perf_counter() - start)
+    return res
+
+def measure_chunks(chunks, done):
+    """
+    Pass a streamed body through, calling `done` with its size once
+    it was completely sent (or the client went away)
+    """
+
+    size = 0
+    try:
+        for chunk in chunks:
+            # str chunks are sent encoded (UTF-8), count their bytes
+            size += len(chunk.encode() if isinstance(chunk, str) else chunk)
+            yield chunk
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+        done(size)
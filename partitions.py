@@ -0,0 +1,321 @@
+"""
+Month partitions of the Temperaturi table
+
+Readings are range partitioned by their timestamp, one table per month
+(temperaturi_YYYY_MM), so a query over some days only reads the
+partitions of their months and old readings are removed by dropping
+whole tables. Readings outside the created months land in the default
+partition, until their month is created: besides `create` at startup,
+every server process checks the coming months from a background thread
+(see PartitionKeeper).
+
+    python3 partitions.py create [MONTHS_AHEAD]
+    python3 partitions.py drop YYYY-MM
+    python3 partitions.py migrate
+"""
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from datetime import date
+from os import getenv
+import psycopg2
+from database import PoolTimeout, pool
+
+# months created past the current one, so inserts always find theirs
+PARTITION_MONTHS_AHEAD = int(getenv("PARTITION_MONTHS_AHEAD", "3"))
+# seconds between two checks of the partitions by a server process
+# (0 = only `create` at startup)
+PARTITION_CHECK_INTERVAL = float(getenv("PARTITION_CHECK_INTERVAL", "3600"))
+
+DEFAULT_PARTITION = "temperaturi_default"
+# schema of a fresh database, also applied by migrate
+INIT_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "initdb.sql")
+# transaction level advisory lock serializing partition changes
+LOCK_KEY = 7340001
+
+_NAME = re.compile(r"temperaturi_(\d{4})_(\d{2})$")
+
+_logger = logging.getLogger("partitions")
+
+
+def add_months(day, count):
+    """First day of the month `count` months after the one of `day`"""
+
+    months = day.year * 12 + day.month - 1 + count
+    return date(months // 12, months % 12 + 1, 1)
+
+def partition_name(month):
+    """Name of the partition of a month (any day of it)"""
+
+    return f"temperaturi_{month.year:04d}_{month.month:02d}"
+
+def is_partitioned(cursor):
+    """False for a database created before the partitioned schema"""
+
+    cursor.execute(
+        "SELECT relkind FROM pg_class WHERE oid = 'temperaturi'::regclass;"
+    )
+    return cursor.fetchone()[0] == "p"
+
+def partitions(cursor):
+    """Months of the existing partitions, in order"""
+
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits i"
+        " JOIN pg_class c ON c.oid = i.inhrelid"
+        " WHERE i.inhparent = 'temperaturi'::regclass;"
+    )
+    months = []
+    for (name,) in cursor.fetchall():
+        match = _NAME.match(name)
+        if match:
+            months.append(date(int(match.group(1)), int(match.group(2)), 1))
+
+    return sorted(months)
+
+def create(cursor, first, last):
+    """
+    Create the missing partitions of the months from `first` to `last`
+
+    Readings of these months already held by the default partition are
+    moved to the new partitions.
+
+    Parameters
+    ----------
+    cursor: psycopg2.extensions.cursor
+        cursor of the ongoing transaction
+
+    first, last: datetime.date
+        any days of the first and the last month
+
+    Returns
+    -------
+        res: List[str]
+            names of the created partitions
+    """
+
+    cursor.execute("SELECT pg_advisory_xact_lock(%s);", (LOCK_KEY,))
+    existing = set(partitions(cursor))
+
+    created = []
+    month = add_months(first, 0)
+    while month <= last:
+        following = add_months(month, 1)
+        if month not in existing:
+            name = partition_name(month)
+            bounds = (month.isoformat(), following.isoformat())
+            cursor.execute(
+                f"CREATE TABLE {name}"
+                " (LIKE Temperaturi INCLUDING DEFAULTS INCLUDING CONSTRAINTS);"
+            )
+            cursor.execute(
+                "WITH moved AS ("
+                f"DELETE FROM {DEFAULT_PARTITION}"
+                " WHERE timestamp >= %s AND timestamp < %s RETURNING *)"
+                f" INSERT INTO {name} SELECT * FROM moved;",
+                bounds
+            )
+            # the indexes and the foreign key come with the attachment
+            cursor.execute(
+                f"ALTER TABLE Temperaturi ATTACH PARTITION {name}"
+                " FOR VALUES FROM (%s) TO (%s);",
+                bounds
+            )
+            created.append(name)
+        month = following
+
+    return created
+
+def ensure(cursor, months_ahead=PARTITION_MONTHS_AHEAD):
+    """
+    Create the partitions of the current month, of the next
+    `months_ahead` months and of the readings held by the default
+    partition (see create)
+    """
+
+    cursor.execute(
+        "SELECT CURRENT_DATE, MIN(timestamp)::date, MAX(timestamp)::date"
+        f" FROM {DEFAULT_PARTITION};"
+    )
+    today, first, last = cursor.fetchone()
+
+    last = max(last or today, add_months(today, months_ahead))
+    return create(cursor, min(first or today, today), last)
+
+def drop(cursor, before):
+    """
+    Remove the readings taken before a month: their partitions are
+    dropped as whole tables, the rollups of the same time are deleted
+
+    Returns
+    -------
+        res: List[str]
+            names of the dropped partitions
+    """
+
+    before = add_months(before, 0)
+    cursor.execute("SELECT pg_advisory_xact_lock(%s);", (LOCK_KEY,))
+
+    dropped = []
+    for month in partitions(cursor):
+        if month < before:
+            name = partition_name(month)
+            cursor.execute(f"DROP TABLE {name};")
+            dropped.append(name)
+
+    cursor.execute(
+        f"DELETE FROM {DEFAULT_PARTITION} WHERE timestamp < %s;", (before,)
+    )
+    # the rollups hold the same readings as the table (see rollup)
+    cursor.execute("DELETE FROM AgregateOrase WHERE bucket < %s;", (before,))
+    cursor.execute("DELETE FROM AgregateTari WHERE bucket < %s;", (before,))
+
+    return dropped
+
+def migrate(cursor):
+    """
+    Move the readings of a database created before the partitioned
+    schema into month partitions
+
+    The old table is locked for the whole migration, which rewrites
+    every reading: stop the servers first. Ids, and so the rollups,
+    stay the same.
+
+    Returns
+    -------
+        res: bool
+            False if the table was already partitioned
+    """
+
+    if is_partitioned(cursor):
+        return False
+
+    cursor.execute("LOCK TABLE Temperaturi IN ACCESS EXCLUSIVE MODE;")
+    cursor.execute("ALTER TABLE Temperaturi RENAME TO Temperaturi_vechi;")
+
+    # free the names of the indexes and of the id sequence for the new table
+    cursor.execute(
+        "SELECT c.relname FROM pg_index i"
+        " JOIN pg_class c ON c.oid = i.indexrelid"
+        " WHERE i.indrelid = 'temperaturi_vechi'::regclass;"
+    )
+    for (name,) in cursor.fetchall():
+        cursor.execute(f"ALTER INDEX {name} RENAME TO {name}_vechi;")
+    cursor.execute(
+        "SELECT pg_get_serial_sequence('temperaturi_vechi', 'id');"
+    )
+    sequence = cursor.fetchone()[0]
+    if sequence:
+        cursor.execute(
+            f"ALTER SEQUENCE {sequence} RENAME TO temperaturi_vechi_id_seq;"
+        )
+
+    with open(INIT_SQL) as file:
+        cursor.execute(file.read())
+
+    cursor.execute(
+        "SELECT CURRENT_DATE, MIN(timestamp)::date FROM Temperaturi_vechi;"
+    )
+    today, first = cursor.fetchone()
+    create(cursor, min(first or today, today),
+           add_months(today, PARTITION_MONTHS_AHEAD))
+
+    cursor.execute(
+        "INSERT INTO Temperaturi(id, valoare, timestamp, idOras)"
+        " SELECT id, valoare, timestamp, idOras FROM Temperaturi_vechi;"
+    )
+    cursor.execute(
+        "SELECT setval(pg_get_serial_sequence('temperaturi', 'id'),"
+        " COALESCE(MAX(id), 0) + 1, false) FROM Temperaturi;"
+    )
+    cursor.execute("DROP TABLE Temperaturi_vechi;")
+    cursor.execute("ANALYZE Temperaturi;")
+
+    return True
+
+
+class PartitionKeeper:
+    """
+    Background thread of a server process creating the partitions of the
+    coming months (see ensure) every `interval` seconds, so a server
+    running for months never writes its readings to the default
+    partition
+
+    The thread of a process is started by its first write (see start).
+
+    Parameters
+    ----------
+    interval: float
+        seconds between two checks, 0 = never check
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """Start the checks of this process on first use"""
+
+        pid = os.getpid()
+        if self.interval > 0 and self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    threading.Thread(
+                        target=self._run, name="partition-keeper",
+                        daemon=True
+                    ).start()
+                    self._pid = pid
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with pool.transaction() as cursor:
+                    # moving readings out of the default partition may
+                    # take longer than a request
+                    cursor.execute("SET LOCAL statement_timeout = 0;")
+                    if is_partitioned(cursor):
+                        names = ensure(cursor)
+                        if names:
+                            _logger.info("created partitions %s",
+                                         " ".join(names))
+            except (psycopg2.Error, PoolTimeout) as err:
+                _logger.warning("partition check failed: %s", err)
+
+
+partition_keeper = PartitionKeeper(PARTITION_CHECK_INTERVAL)
+
+
+if __name__ == "__main__":
+    USAGE = (f"usage: {sys.argv[0]} create [MONTHS_AHEAD]"
+             " | drop YYYY-MM | migrate")
+    command = sys.argv[1:]
+
+    with pool.transaction() as db_cursor:
+        db_cursor.execute("SET LOCAL statement_timeout = 0;")
+        if command[:1] == ["create"] and len(command) <= 2:
+            if not is_partitioned(db_cursor):
+                sys.exit("Temperaturi isn't partitioned, run migrate first")
+            ahead = (int(command[1]) if len(command) == 2
+                     else PARTITION_MONTHS_AHEAD)
+            names = ensure(db_cursor, ahead)
+            print(f"created {len(names)} partitions: {' '.join(names)}")
+        elif command[:1] == ["drop"] and len(command) == 2:
+            if not re.fullmatch(r"\d{4}-\d{2}", command[1]):
+                sys.exit(USAGE)
+            year, month = map(int, command[1].split("-"))
+            names = drop(db_cursor, date(year, month, 1))
+            print(f"dropped {len(names)} partitions: {' '.join(names)}")
+        elif command == ["migrate"]:
+            if migrate(db_cursor):
+                print("Temperaturi migrated to month partitions")
+            else:
+                print("Temperaturi is already partitioned")
+        else:
+            sys.exit(USAGE)
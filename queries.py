@@ -0,0 +1,173 @@
+"""SQL statements of the server, prepared once per database connection"""
+import hashlib
+import re
+from os import getenv
+
+# columns of the listings, quoted aliases keep the case of the JSON keys
+COUNTRY_SELECT = "SELECT id, nume, lat, lon FROM Tari"
+CITY_SELECT = 'SELECT id, idTara "idTara", nume, lat, lon FROM Orase'
+
+
+def json_rows(select):
+    """Query returning the rows of `select` as JSON objects (text)"""
+
+    return f"SELECT row_to_json(r)::text FROM ({select}) r"
+
+def json_array(select):
+    """Query returning the rows of `select` as one JSON array (text)"""
+
+    return ("SELECT '[' || COALESCE(string_agg(row_to_json(r)::text, ','),"
+            f" '') || ']' FROM ({select}) r")
+
+def json_columns(select, cols):
+    """
+    Query returning the rows of `select` as one JSON object (text) with
+    an array of values per column
+    """
+
+    arrays = ", ".join(
+        f"'{col}', COALESCE(json_agg(r.\"{col}\"), '[]')" for col in cols
+    )
+    return f"SELECT json_build_object({arrays})::text FROM ({select}) r"
+
+
+# fixed statements, by name (placeholders in psycopg2 style)
+STATEMENTS = {
+    # listings are rendered by the database and sent as they are
+    "countries": json_array(COUNTRY_SELECT),
+    # writes check their own constraints: a conflicting insert returns no
+    # row, other violations raise (see main.handle_constraint_violation)
+    "insert_country":
+        "INSERT INTO Tari(nume, lat, lon) VALUES (%s, %s, %s)"
+        " ON CONFLICT (nume) DO NOTHING RETURNING id",
+    "update_country":
+        "UPDATE Tari SET nume = %s, lat = %s, lon = %s WHERE id = %s"
+        " RETURNING id",
+    "delete_country": "DELETE FROM Tari WHERE id = %s RETURNING id",
+
+    "cities": json_array(CITY_SELECT),
+    "cities_of_country": json_array(CITY_SELECT + " WHERE idTara = %s"),
+    "insert_city":
+        "INSERT INTO Orase(idTara, nume, lat, lon) VALUES (%s, %s, %s, %s)"
+        " ON CONFLICT (idTara, nume) DO NOTHING RETURNING id",
+    # the locked subquery returns the country the city had before
+    "update_city":
+        "UPDATE Orase SET idTara = %s, nume = %s, lat = %s, lon = %s"
+        " FROM (SELECT id, idTara FROM Orase WHERE id = %s FOR UPDATE) old"
+        " WHERE Orase.id = old.id RETURNING old.idTara",
+    "delete_city": "DELETE FROM Orase WHERE id = %s RETURNING idTara",
+
+    # CURRENT_TIMESTAMP is fixed for the whole transaction and would break
+    # the (timestamp, idOras) unique constraint for repeated city ids; the
+    # clock alone may repeat within a microsecond, so the position of each
+    # reading is added to keep the timestamps of a batch distinct
+    "insert_temperatures":
+        "INSERT INTO Temperaturi(idOras, valoare, timestamp)"
+        " SELECT r.idOras, r.valoare,"
+        " clock_timestamp() + r.ord * interval '1 microsecond'"
+        " FROM unnest(%s::int[], %s::real[]) WITH ORDINALITY"
+        " r(idOras, valoare, ord)"
+        " ORDER BY r.ord"
+        " RETURNING id, timestamp",
+    # looked up by id alone in every month partition, the writes then
+    # touch the partition of its timestamp only
+    "reading": "SELECT idOras, timestamp FROM Temperaturi WHERE id = %s",
+    "update_reading":
+        "UPDATE Temperaturi SET idOras = %s, valoare = %s"
+        " WHERE id = %s AND timestamp = %s",
+    "delete_reading":
+        "DELETE FROM Temperaturi WHERE id = %s AND timestamp = %s",
+    # changes of readings for the live feed (channel livefeed.CHANNEL),
+    # delivered on commit, with the current country of their city
+    "notify_readings":
+        "SELECT pg_notify('temperaturi', (p.payload::jsonb"
+        " || jsonb_build_object('idTara', o.idTara))::text)"
+        " FROM unnest(%s::text[]) p(payload)"
+        " LEFT JOIN Orase o ON o.id = (p.payload::jsonb ->> 'idOras')::int"
+}
+
+# statements without side effects, which the slow query log may run again
+# under EXPLAIN ANALYZE (see database.MeteredCursor): writes and notifies
+# must stay out of these
+READ_ONLY = {"countries", "cities", "cities_of_country", "reading"}
+# composed queries, by kind
+READ_ONLY_KINDS = {"page", "aggregate"}
+
+# prepared statements kept per connection, least recently used dropped
+MAX_PREPARED = int(getenv("MAX_PREPARED_STATEMENTS", "256"))
+
+_PLACEHOLDER = re.compile(r"%(s|%)")
+
+
+def _numbered(sql):
+    """Turn psycopg2 placeholders (%s) into PREPARE parameters ($1, $2...)"""
+
+    count = 0
+
+    def number(match):
+        nonlocal count
+        if match.group(1) == "%":
+            return "%"
+        count += 1
+        return f"${count}"
+
+    return _PLACEHOLDER.sub(number, sql)
+
+
+def read_only(name):
+    """True for the prepared statements (by name) safe to run twice"""
+
+    if name in STATEMENTS:
+        return name in READ_ONLY
+    return name.rpartition("_")[0] in READ_ONLY_KINDS
+
+def execute(cursor, statement, params=(), kind="query"):
+    """
+    Run a statement as a prepared statement of the cursor's connection
+
+    The statement is prepared (parsed once, its plan cached by the
+    server) the first time a connection runs it. Queries composed at
+    run time get a name derived from their text, so every request with
+    the same shape (same conditions, different values) reuses the same
+    prepared statement.
+
+    Parameters
+    ----------
+    cursor: psycopg2.extensions.cursor
+        cursor of a connection created by database.ConnectionPool
+
+    statement: str
+        name of one of STATEMENTS or text of a composed query, with %s
+        placeholders and without the trailing semicolon
+
+    params: Sequence[Any]
+        values of the placeholders
+
+    kind: str
+        prefix of the name of a composed query (e.g. "page"), which
+        identifies it in the metrics
+    """
+
+    if statement in STATEMENTS:
+        name, sql = statement, STATEMENTS[statement]
+    else:
+        sql = statement
+        name = f"{kind}_" + hashlib.sha1(sql.encode()).hexdigest()[:16]
+
+    prepared = cursor.connection.prepared
+    if name in prepared:
+        prepared.move_to_end(name)
+    else:
+        numbered = _numbered(sql)
+        cursor.execute(f"PREPARE {name} AS {numbered}")
+        prepared[name] = numbered
+
+        if len(prepared) > MAX_PREPARED:
+            oldest, _ = prepared.popitem(last=False)
+            cursor.execute(f"DEALLOCATE {oldest}")
+
+    if params:
+        placeholders = ", ".join(["%s"] * len(params))
+        cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+    else:
+        cursor.execute(f"EXECUTE {name}")
@@ -0,0 +1,120 @@
+"""In-process index of the city ids used for foreign key checks"""
+import threading
+
+
+class ReferenceCache:
+    """
+    Known city ids, with their country ids, kept in memory
+
+    The index is loaded on first use and then kept up to date by the
+    write handlers, so foreign key checks become dictionary lookups.
+    An id missing from the index is looked up in the database before
+    being rejected (it may have been created by another process) and
+    stale entries are caught by the foreign key constraints, which stay
+    the final authority.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cities = None  # city id -> country id
+
+    def _ensure_loaded(self, cursor):
+        """Load every id from the database the first time it is needed"""
+
+        if self._cities is not None:
+            return
+
+        cursor.execute("SELECT id, idTara FROM Orase;")
+        cities = dict(cursor.fetchall())
+
+        with self._lock:
+            if self._cities is None:
+                self._cities = cities
+
+    def has_city(self, cursor, city_id):
+        """Check a city id exists"""
+
+        return city_id in self.known_cities(cursor, [city_id])
+
+    def known_cities(self, cursor, city_ids):
+        """
+        Filter the existing ids out of a collection of city ids
+
+        Parameters
+        ----------
+        cursor: psycopg2.extensions.cursor
+            cursor used for loading the index or looking up unknown ids
+
+        city_ids: Iterable[int]
+            ids to be checked
+
+        Returns
+        -------
+            res: Set[int]
+                the ids from `city_ids` which exist
+        """
+
+        self._ensure_loaded(cursor)
+        city_ids = set(city_ids)
+        found = {elem for elem in city_ids if elem in self._cities}
+
+        missing = list(city_ids - found)
+        if missing:
+            cursor.execute(
+                "SELECT id, idTara FROM Orase WHERE id = ANY(%s);",
+                (missing,)
+            )
+            for city_id, country_id in cursor.fetchall():
+                self.add_city(city_id, country_id)
+                found.add(city_id)
+
+        return found
+
+    def cities_of(self, cursor, country_id):
+        """Ids of the cities of a country"""
+
+        self._ensure_loaded(cursor)
+        return [
+            city_id for city_id, owner in self._cities.items()
+            if owner == country_id
+        ]
+
+    def country_of(self, city_id):
+        """Country id of a cached city (None if unknown)"""
+
+        cities = self._cities
+        return cities.get(city_id) if cities is not None else None
+
+    def remove_country(self, country_id):
+        """Forget the cities of a deleted country (ON DELETE CASCADE)"""
+
+        with self._lock:
+            if self._cities is None:
+                return
+            self._cities = {
+                city_id: owner for city_id, owner in self._cities.items()
+                if owner != country_id
+            }
+
+    def add_city(self, city_id, country_id):
+        """Record a new city or the new country of an existing one"""
+
+        with self._lock:
+            if self._cities is not None:
+                self._cities[city_id] = country_id
+
+    def remove_city(self, city_id):
+        """Forget a deleted city"""
+
+        with self._lock:
+            if self._cities is not None:
+                self._cities.pop(city_id, None)
+
+    def clear(self):
+        """Drop the index, it is reloaded on next use"""
+
+        with self._lock:
+            self._cities = None
+
+
+refcache = ReferenceCache()
@@ -0,0 +1,266 @@
+"""Pre-aggregated temperature statistics per city and per country"""
+import sys
+from database import pool
+
+# granularities kept in AgregateOrase/AgregateTari
+ROLLUP_BUCKETS = ["hour", "day"]
+# rollup granularity each query bucket is computed from
+SOURCE_BUCKETS = {"hour": "hour", "day": "day", "month": "day"}
+
+_GRANULARITIES = (
+    "(VALUES " + ", ".join(f"('{elem}')" for elem in ROLLUP_BUCKETS)
+    + ") g(granularitate)"
+)
+
+_MERGE = """
+ON CONFLICT (granularitate, {key}, bucket) DO UPDATE SET
+    numar = {table}.numar + EXCLUDED.numar,
+    suma = {table}.suma + EXCLUDED.suma,
+    minim = LEAST({table}.minim, EXCLUDED.minim),
+    maxim = GREATEST({table}.maxim, EXCLUDED.maxim);
+"""
+
+
+def _lock_buckets(cursor, source, params):
+    """
+    Take the locks of the city and country buckets of some readings,
+    until the end of the transaction
+
+    Every writer of the rollups locks the buckets it changes (advisory
+    locks, in the order of their keys so writers never deadlock), so a
+    refresh sees the committed readings of every other writer and two
+    refreshes of a bucket don't both insert it. Each country is also
+    locked in shared mode, against refresh_countries.
+
+    Parameters
+    ----------
+    source: str
+        query returning the (city id, timestamp) of the readings
+
+    params: Sequence[Any]
+        values of the placeholders of `source`
+    """
+
+    readings = f"WITH r(idOras, ts) AS ({source})"
+    cursor.execute(
+        f"{readings} SELECT pg_advisory_xact_lock_shared(l.key) FROM"
+        " (SELECT DISTINCT hashtextextended('country/' || o.idTara, 0) key"
+        " FROM r JOIN Orase o ON o.id = r.idOras"
+        " WHERE o.idTara IS NOT NULL ORDER BY 1) l;",
+        params
+    )
+    cursor.execute(
+        f"{readings}, k AS (SELECT 'city' kind, r.idOras id, r.ts FROM r"
+        " UNION SELECT 'country', o.idTara, r.ts FROM r"
+        " JOIN Orase o ON o.id = r.idOras WHERE o.idTara IS NOT NULL)"
+        " SELECT pg_advisory_xact_lock(l.key) FROM"
+        " (SELECT DISTINCT hashtextextended(concat_ws('/', k.kind,"
+        " g.granularitate, date_trunc(g.granularitate, k.ts), k.id), 0) key"
+        f" FROM k CROSS JOIN {_GRANULARITIES} ORDER BY 1) l;",
+        params
+    )
+
+def add_readings(cursor, readings):
+    """
+    Fold newly inserted readings into the rollups
+
+    Buckets are upserted in key order, so concurrent writers lock the
+    rollup rows in the same order. The new rows are looked up within
+    their time span, so only the month partitions holding them are read.
+
+    Parameters
+    ----------
+    cursor: psycopg2.extensions.cursor
+        cursor of the transaction which inserted the readings
+
+    readings: List[Tuple[int, datetime]]
+        ids and timestamps of the new Temperaturi rows
+    """
+
+    if not readings:
+        return
+
+    reading_ids = [elem[0] for elem in readings]
+    first = min(elem[1] for elem in readings)
+    last = max(elem[1] for elem in readings)
+
+    _lock_buckets(
+        cursor,
+        "SELECT t.idOras, t.timestamp FROM Temperaturi t"
+        " WHERE t.id = ANY(%s) AND t.timestamp BETWEEN %s AND %s"
+        " AND t.idOras IS NOT NULL",
+        (reading_ids, first, last)
+    )
+
+    cursor.execute(
+        "INSERT INTO AgregateOrase"
+        " (granularitate, bucket, idOras, numar, suma, minim, maxim)"
+        " SELECT g.granularitate, date_trunc(g.granularitate, t.timestamp),"
+        " t.idOras, COUNT(*), SUM(t.valoare), MIN(t.valoare), MAX(t.valoare)"
+        f" FROM Temperaturi t CROSS JOIN {_GRANULARITIES}"
+        " WHERE t.id = ANY(%s) AND t.timestamp BETWEEN %s AND %s"
+        " AND t.idOras IS NOT NULL"
+        " GROUP BY 1, 2, 3 ORDER BY 1, 2, 3"
+        + _MERGE.format(key="idOras", table="AgregateOrase"),
+        (reading_ids, first, last)
+    )
+
+    cursor.execute(
+        "INSERT INTO AgregateTari"
+        " (granularitate, bucket, idTara, numar, suma, minim, maxim)"
+        " SELECT g.granularitate, date_trunc(g.granularitate, t.timestamp),"
+        " o.idTara, COUNT(*), SUM(t.valoare), MIN(t.valoare), MAX(t.valoare)"
+        " FROM Temperaturi t JOIN Orase o ON o.id = t.idOras"
+        f" CROSS JOIN {_GRANULARITIES}"
+        " WHERE t.id = ANY(%s) AND t.timestamp BETWEEN %s AND %s"
+        " AND o.idTara IS NOT NULL"
+        " GROUP BY 1, 2, 3 ORDER BY 1, 2, 3"
+        + _MERGE.format(key="idTara", table="AgregateTari"),
+        (reading_ids, first, last)
+    )
+
+
+def refresh_readings(cursor, readings):
+    """
+    Recompute the buckets touched by updated or deleted readings
+
+    MIN/MAX can't be taken back incrementally, so every affected city
+    bucket is aggregated again from Temperaturi (a single city over one
+    hour or day) and every affected country bucket from the city ones,
+    once their locks are held (see _lock_buckets).
+
+    Parameters
+    ----------
+    cursor: psycopg2.extensions.cursor
+        cursor of the transaction which changed the readings
+
+    readings: List[Tuple[int, datetime]]
+        (city id, timestamp) of the readings before and after the change
+    """
+
+    readings = [elem for elem in readings if elem[0] is not None]
+    if not readings:
+        return
+
+    city_ids = [elem[0] for elem in readings]
+    timestamps = [elem[1] for elem in readings]
+
+    _lock_buckets(
+        cursor,
+        "SELECT * FROM unnest(%s::int[], %s::timestamp[])",
+        (city_ids, timestamps)
+    )
+
+    keys = (
+        "SELECT DISTINCT g.granularitate,"
+        " date_trunc(g.granularitate, r.ts) bucket, r.idOras"
+        " FROM unnest(%s::int[], %s::timestamp[]) r(idOras, ts)"
+        f" CROSS JOIN {_GRANULARITIES}"
+    )
+
+    cursor.execute(
+        f"WITH k AS ({keys}) DELETE FROM AgregateOrase a USING k"
+        " WHERE a.granularitate = k.granularitate"
+        " AND a.bucket = k.bucket AND a.idOras = k.idOras;",
+        (city_ids, timestamps)
+    )
+    cursor.execute(
+        f"WITH k AS ({keys}) INSERT INTO AgregateOrase"
+        " (granularitate, bucket, idOras, numar, suma, minim, maxim)"
+        " SELECT k.granularitate, k.bucket, k.idOras, COUNT(*),"
+        " SUM(t.valoare), MIN(t.valoare), MAX(t.valoare)"
+        " FROM k JOIN Temperaturi t ON t.idOras = k.idOras"
+        " AND t.timestamp >= k.bucket"
+        " AND t.timestamp < k.bucket + ('1 ' || k.granularitate)::interval"
+        " GROUP BY 1, 2, 3;",
+        (city_ids, timestamps)
+    )
+
+    country_keys = (
+        "SELECT DISTINCT k.granularitate, k.bucket, o.idTara"
+        f" FROM ({keys}) k JOIN Orase o ON o.id = k.idOras"
+        " WHERE o.idTara IS NOT NULL"
+    )
+
+    cursor.execute(
+        f"WITH k AS ({country_keys}) DELETE FROM AgregateTari a USING k"
+        " WHERE a.granularitate = k.granularitate"
+        " AND a.bucket = k.bucket AND a.idTara = k.idTara;",
+        (city_ids, timestamps)
+    )
+    cursor.execute(
+        f"WITH k AS ({country_keys}) INSERT INTO AgregateTari"
+        " (granularitate, bucket, idTara, numar, suma, minim, maxim)"
+        " SELECT k.granularitate, k.bucket, k.idTara, SUM(a.numar),"
+        " SUM(a.suma), MIN(a.minim), MAX(a.maxim)"
+        " FROM k JOIN Orase o ON o.idTara = k.idTara"
+        " JOIN AgregateOrase a ON a.idOras = o.id"
+        " AND a.granularitate = k.granularitate AND a.bucket = k.bucket"
+        " GROUP BY 1, 2, 3;",
+        (city_ids, timestamps)
+    )
+
+
+def refresh_countries(cursor, country_ids):
+    """
+    Recompute every bucket of some countries from their city rollups
+    (after one of their cities was moved or deleted), with the countries
+    locked against the other writers (see _lock_buckets)
+    """
+
+    country_ids = sorted({elem for elem in country_ids if elem is not None})
+    if not country_ids:
+        return
+
+    cursor.execute(
+        "SELECT pg_advisory_xact_lock(l.key) FROM"
+        " (SELECT hashtextextended('country/' || c.id, 0) key"
+        " FROM unnest(%s::int[]) c(id) ORDER BY 1) l;",
+        (country_ids,)
+    )
+    cursor.execute(
+        "DELETE FROM AgregateTari WHERE idTara = ANY(%s);", (country_ids,)
+    )
+    cursor.execute(
+        "INSERT INTO AgregateTari"
+        " (granularitate, bucket, idTara, numar, suma, minim, maxim)"
+        " SELECT a.granularitate, a.bucket, o.idTara, SUM(a.numar),"
+        " SUM(a.suma), MIN(a.minim), MAX(a.maxim)"
+        " FROM AgregateOrase a JOIN Orase o ON o.id = a.idOras"
+        " WHERE o.idTara = ANY(%s)"
+        " GROUP BY 1, 2, 3;",
+        (country_ids,)
+    )
+
+
+def rebuild(cursor):
+    """Recompute all the rollups from scratch (e.g. after a data import)"""
+
+    cursor.execute("TRUNCATE AgregateOrase, AgregateTari;")
+    cursor.execute(
+        "INSERT INTO AgregateOrase"
+        " (granularitate, bucket, idOras, numar, suma, minim, maxim)"
+        " SELECT g.granularitate, date_trunc(g.granularitate, t.timestamp),"
+        " t.idOras, COUNT(*), SUM(t.valoare), MIN(t.valoare), MAX(t.valoare)"
+        f" FROM Temperaturi t CROSS JOIN {_GRANULARITIES}"
+        " WHERE t.idOras IS NOT NULL"
+        " GROUP BY 1, 2, 3;"
+    )
+    cursor.execute(
+        "INSERT INTO AgregateTari"
+        " (granularitate, bucket, idTara, numar, suma, minim, maxim)"
+        " SELECT a.granularitate, a.bucket, o.idTara, SUM(a.numar),"
+        " SUM(a.suma), MIN(a.minim), MAX(a.maxim)"
+        " FROM AgregateOrase a JOIN Orase o ON o.id = a.idOras"
+        " WHERE o.idTara IS NOT NULL"
+        " GROUP BY 1, 2, 3;"
+    )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit(f"usage: {sys.argv[0]} rebuild")
+
+    with pool.transaction() as db_cursor:
+        db_cursor.execute("SET LOCAL statement_timeout = 0;")
+        rebuild(db_cursor)
@@ -0,0 +1,240 @@
+"""In-memory grid index over city coordinates"""
+import heapq
+import math
+import threading
+import time
+from os import getenv
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle (haversine) distance between two points"""
+
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+
+    hav = (math.sin(dphi / 2) ** 2
+           + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(hav)))
+
+def valid_point(lat, lon):
+    """True for finite coordinates, in [-90, 90] and [-180, 180]"""
+
+    return (math.isfinite(lat) and math.isfinite(lon)
+            and -90 <= lat <= 90 and -180 <= lon <= 180)
+
+
+class CityGrid:
+    """
+    Cities bucketed in a uniform latitude/longitude grid
+
+    Only the cells overlapping a query are visited, so finding the
+    candidate cities of a bounding box, radius or nearest neighbour
+    query does not depend on the total number of cities. The grid is
+    built from the database on first use, rebuilt after local city
+    writes (see `invalidate`) and at most `max_age` seconds old, to pick
+    up changes made by other processes.
+
+    Parameters
+    ----------
+    cell_size: float
+        cell side, in degrees
+
+    max_age: float
+        seconds after which the grid is rebuilt
+    """
+
+    def __init__(self, cell_size, max_age):
+        self.cell_size = cell_size
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._cells = None  # (row, col) -> List[(id, lat, lon)]
+        self._count = 0
+        self._built_at = 0.0
+
+    def invalidate(self):
+        """Rebuild the grid on next use"""
+
+        self._cells = None
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_size),
+                math.floor(lon / self.cell_size))
+
+    @property
+    def stale(self):
+        """True when the grid must be (re)built before being used"""
+
+        return (self._cells is None
+                or time.monotonic() - self._built_at >= self.max_age)
+
+    def _build(self, rows, built_at):
+        cells = {}
+        count = 0
+        for city_id, lat, lon in rows:
+            cells.setdefault(self._cell(lat, lon), []).append(
+                (city_id, lat, lon)
+            )
+            count += 1
+
+        self._cells = cells
+        self._count = count
+        self._built_at = built_at
+
+    def load(self, rows, built_at=None):
+        """
+        Build the grid from (id, lat, lon) rows of every city
+
+        Parameters
+        ----------
+        rows: Iterable[Tuple[int, float, float]]
+            result of `SELECT id, lat, lon FROM Orase`
+
+        built_at: float
+            time.monotonic() before the rows were read, defaults to now
+        """
+
+        if built_at is None:
+            built_at = time.monotonic()
+
+        with self._lock:
+            self._build(rows, built_at)
+
+    def _get_cells(self, cursor):
+        """
+        Current grid, built (again) if missing or too old
+
+        Without a cursor (the caller loads the grid itself, see `load`)
+        an old grid is still used rather than failing.
+        """
+
+        cells = self._cells
+        if cells is not None and (cursor is None or not self.stale):
+            return cells
+
+        with self._lock:
+            if not self.stale:
+                return self._cells
+
+            built_at = time.monotonic()
+            cursor.execute("SELECT id, lat, lon FROM Orase;")
+            self._build(cursor.fetchall(), built_at)
+            return self._cells
+
+    def _scan(self, cells, min_lat, max_lat, lon_ranges):
+        """Cities inside a latitude band and any of the longitude ranges"""
+
+        min_row = math.floor(min_lat / self.cell_size)
+        max_row = math.floor(max_lat / self.cell_size)
+        col_ranges = [
+            (math.floor(lo / self.cell_size), math.floor(hi / self.cell_size))
+            for lo, hi in lon_ranges
+        ]
+
+        n_visited = (max_row - min_row + 1) * sum(
+            hi - lo + 1 for lo, hi in col_ranges
+        )
+
+        # for huge boxes it is cheaper to go over the non-empty cells
+        if n_visited > len(cells):
+            keys = [
+                key for key in cells
+                if min_row <= key[0] <= max_row
+                and any(lo <= key[1] <= hi for lo, hi in col_ranges)
+            ]
+        else:
+            keys = [
+                (row, col)
+                for row in range(min_row, max_row + 1)
+                for lo, hi in col_ranges
+                for col in range(lo, hi + 1)
+            ]
+
+        for key in keys:
+            for city in cells.get(key, ()):
+                if (min_lat <= city[1] <= max_lat
+                        and any(lo <= city[2] <= hi for lo, hi in lon_ranges)):
+                    yield city
+
+    def in_bbox(self, cursor, min_lat, min_lon, max_lat, max_lon):
+        """
+        Ids of the cities inside a bounding box
+
+        A box with `min_lon` > `max_lon` crosses the antimeridian.
+        """
+
+        cells = self._get_cells(cursor)
+        if min_lon <= max_lon:
+            lon_ranges = [(min_lon, max_lon)]
+        else:
+            lon_ranges = [(min_lon, 180.0), (-180.0, max_lon)]
+
+        return [city[0] for city in self._scan(
+            cells, min_lat, max_lat, lon_ranges
+        )]
+
+    def _within(self, cells, lat, lon, radius_km):
+        """(distance, id) of the cities at most `radius_km` away"""
+
+        angle = radius_km / EARTH_RADIUS_KM
+        min_lat = lat - math.degrees(angle)
+        max_lat = lat + math.degrees(angle)
+
+        # longitude span of the spherical cap, all longitudes when the
+        # cap contains a pole
+        if min_lat <= -90 or max_lat >= 90 or angle >= math.pi / 2:
+            lon_ranges = [(-180.0, 180.0)]
+        else:
+            span = math.degrees(math.asin(
+                min(1.0, math.sin(angle) / math.cos(math.radians(lat)))
+            ))
+            lo, hi = lon - span, lon + span
+            if lo < -180:
+                lon_ranges = [(lo + 360, 180.0), (-180.0, hi)]
+            elif hi > 180:
+                lon_ranges = [(lo, 180.0), (-180.0, hi - 360)]
+            else:
+                lon_ranges = [(lo, hi)]
+
+        res = []
+        for city_id, city_lat, city_lon in self._scan(
+                cells, max(min_lat, -90.0), min(max_lat, 90.0), lon_ranges):
+            dist = distance_km(lat, lon, city_lat, city_lon)
+            if dist <= radius_km:
+                res.append((dist, city_id))
+
+        return res
+
+    def within(self, cursor, lat, lon, radius_km):
+        """Ids of the cities at most `radius_km` away from a point"""
+
+        cells = self._get_cells(cursor)
+        return [elem[1] for elem in self._within(cells, lat, lon, radius_km)]
+
+    def nearest(self, cursor, lat, lon, k):
+        """Ids of the `k` cities closest to a point, closest first"""
+
+        cells = self._get_cells(cursor)
+        k = min(k, self._count)
+        if k <= 0:
+            return []
+
+        # grow the search radius until it holds at least k cities, the
+        # k nearest ones are then certainly among them
+        radius_km = self.cell_size * 111.0
+        while True:
+            found = self._within(cells, lat, lon, radius_km)
+            if len(found) >= k or radius_km >= math.pi * EARTH_RADIUS_KM:
+                break
+            radius_km *= 2
+
+        return [elem[1] for elem in heapq.nsmallest(k, found)]
+
+
+city_grid = CityGrid(
+    cell_size=float(getenv("SPATIAL_CELL_SIZE", "0.5")),
+    max_age=float(getenv("SPATIAL_MAX_AGE", "60"))
+)
@@ -2,4 +2,16 @@
 
 while ! nc -z tema2_db 5432; do sleep 1; done
 
-python3 main.py
+# partitions of the readings for the current and the next months
+python3 partitions.py create
+
+# SERVER_MODE=dev runs the Flask development server (debugger, reloader),
+# SERVER_MODE=async serves the API on asyncio event loops (asgi.py),
+# otherwise pre-forked gunicorn workers serve main.py (gunicorn.conf.py)
+if [ "$SERVER_MODE" = "dev" ]; then
+    exec python3 main.py
+elif [ "$SERVER_MODE" = "async" ]; then
+    exec gunicorn -c gunicorn.conf.py -k uvicorn_worker.UvicornWorker asgi:app
+else
+    exec gunicorn -c gunicorn.conf.py main:app
+fi
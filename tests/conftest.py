@@ -0,0 +1,47 @@
+import os
+import sys
+import psycopg2
+import pytest
+
+# the modules of the server live in the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__
+))))
+
+
+@pytest.fixture
+def db_params():
+    """
+    psycopg2.connect keyword arguments of a disposable database, named
+    by TEST_DB, whose tables are created again from initdb.sql (tests
+    needing it are skipped without TEST_DB)
+    """
+
+    name = os.getenv("TEST_DB")
+    if not name:
+        pytest.skip("TEST_DB not set")
+
+    params = {
+        "host": os.getenv("DB_HOST", "localhost"),
+        "port": int(os.getenv("DB_PORT", "5432")),
+        "database": name,
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASSWORD")
+    }
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(root, "initdb.sql")) as file:
+        schema = file.read()
+
+    conn = psycopg2.connect(**params)
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "DROP TABLE IF EXISTS AgregateTari, AgregateOrase,"
+                " Temperaturi, Orase, Tari CASCADE;"
+            )
+            cursor.execute(schema)
+    finally:
+        conn.close()
+
+    return params
@@ -0,0 +1,61 @@
+import pytest
+from werkzeug.datastructures import MultiDict
+import main
+
+
+def area_args(**params):
+    return main.read_area_args(MultiDict(params))
+
+
+@pytest.mark.parametrize("bbox", [
+    "0,0,inf,20",
+    "-inf,0,10,20",
+    "nan,0,10,20",
+    "0,0,91,20",
+    "0,-181,10,20",
+])
+def test_bbox_out_of_range(bbox):
+    area, error = area_args(bbox=bbox)
+    assert area is None and error
+
+
+@pytest.mark.parametrize("near", ["nan,0", "0,nan", "inf,0", "0,-inf",
+                                  "-91,0", "0,180.5"])
+def test_near_out_of_range(near):
+    area, error = area_args(near=near, nearest="3")
+    assert area is None and error
+
+
+@pytest.mark.parametrize("radius", ["inf", "nan", "-1"])
+def test_radius_not_finite(radius):
+    area, error = area_args(near="10,20", radius_km=radius)
+    assert area is None and error
+
+
+@pytest.mark.parametrize("params", [
+    {"lat": "inf"},
+    {"lon": "nan"},
+    {"lat": "95", "lon": "10"},
+])
+def test_point_out_of_range(params):
+    area, error = area_args(**params)
+    assert area is None and error
+
+
+def test_valid_areas():
+    for params in ({"bbox": "-90,170,90,-170"},
+                   {"near": "45.5,-180", "radius_km": "10"},
+                   {"near": "90,180", "nearest": "2"},
+                   {"lat": "44.4", "lon": "26.1"}):
+        area, error = area_args(**params)
+        assert area is not None and error is None
+
+
+@pytest.mark.parametrize("query", [
+    "bbox=0,0,inf,20",
+    "near=nan,0&nearest=3",
+    "near=0,0&radius_km=inf",
+])
+def test_listing_rejects_out_of_range(query):
+    response = main.app.test_client().get(f"/api/temperatures?{query}")
+    assert response.status_code == 400
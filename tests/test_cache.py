@@ -0,0 +1,20 @@
+import time
+from cache import TableVersions
+
+
+def test_changed_within():
+    versions = TableVersions(max_age=30)
+    assert not versions.changed_within(5, "Tari")
+
+    versions.bump("Tari")
+    assert versions.changed_within(5, "Orase", "Tari")
+    assert not versions.changed_within(5, "Orase")
+
+    time.sleep(0.05)
+    assert not versions.changed_within(0.01, "Tari")
+
+
+def test_renewal_is_not_a_change():
+    versions = TableVersions(max_age=0)
+    versions.get("Tari")
+    assert not versions.changed_within(5, "Tari")
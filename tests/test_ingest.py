@@ -0,0 +1,52 @@
+import threading
+import time
+import pytest
+import ingest
+
+
+def blocked_buffer(max_size):
+    """Buffer whose writes wait for the returned event"""
+
+    release = threading.Event()
+    written = []
+
+    def write(readings):
+        release.wait()
+        written.extend(readings)
+        return [(len(written), None)] * len(readings)
+
+    buffer = ingest.IngestBuffer(write, max_size, max_rows=1, interval=0)
+    return buffer, release, written
+
+
+def test_close_waits_for_submits_in_flight():
+    buffer, release, written = blocked_buffer(max_size=1)
+    first = buffer.submit((1, 1.0), timeout=1)
+    # the flusher holds the first reading, the second one fills the queue
+    time.sleep(0.05)
+    buffer.submit((2, 2.0), timeout=1)
+
+    # the third one waits for room without holding the lock
+    third = {}
+    waiting = threading.Thread(
+        target=lambda: third.update(res=buffer.submit((3, 3.0), timeout=5)),
+        daemon=True
+    )
+    waiting.start()
+    time.sleep(0.05)
+
+    closing = threading.Thread(target=buffer.close, daemon=True)
+    closing.start()
+    time.sleep(0.05)
+    try:
+        # closed at once, while still waiting for the third one
+        assert buffer._closed and closing.is_alive()
+        with pytest.raises(ingest.QueueFull):
+            buffer.submit((4, 4.0), timeout=0.1)
+    finally:
+        release.set()
+    waiting.join(2)
+    closing.join(2)
+    assert not closing.is_alive()
+    assert first.wait(0) and third["res"].wait(0)
+    assert [reading[0] for reading in written] == [1, 2, 3]
@@ -0,0 +1,92 @@
+import threading
+import time
+from datetime import datetime
+import psycopg2
+import rollup
+
+DAY = datetime(2024, 3, 5)
+
+
+def seed(params):
+    conn = psycopg2.connect(**params)
+    with conn, conn.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO Tari(nume, lat, lon) VALUES ('T', 0, 0) RETURNING id;"
+        )
+        country_id = cursor.fetchone()[0]
+        cursor.execute(
+            "INSERT INTO Orase(idTara, nume, lat, lon)"
+            " VALUES (%s, 'A', 0, 0), (%s, 'B', 1, 1) RETURNING id;",
+            (country_id, country_id)
+        )
+        city_ids = [elem[0] for elem in cursor.fetchall()]
+        readings = []
+        for city_id in city_ids:
+            for hour, value in ((1, 10.0), (2, 20.0)):
+                cursor.execute(
+                    "INSERT INTO Temperaturi(idOras, valoare, timestamp)"
+                    " VALUES (%s, %s, %s) RETURNING id, timestamp;",
+                    (city_id, value, DAY.replace(hour=hour))
+                )
+                readings.append((city_id,) + cursor.fetchone())
+        rollup.rebuild(cursor)
+    conn.close()
+    return readings
+
+
+def rollups(params):
+    conn = psycopg2.connect(**params)
+    with conn, conn.cursor() as cursor:
+        res = []
+        for table in ("AgregateOrase", "AgregateTari"):
+            cursor.execute(f"SELECT * FROM {table} ORDER BY 1, 2, 3;")
+            res.append(cursor.fetchall())
+    conn.close()
+    return res
+
+
+def test_overlapping_refreshes(db_params):
+    readings = seed(db_params)
+    # a reading of each city, same country, same day
+    (city_a, id_a, ts_a), (city_b, id_b, ts_b) = readings[0], readings[2]
+
+    first = psycopg2.connect(**db_params)
+    second = psycopg2.connect(**db_params)
+    errors = []
+
+    def delete_b():
+        try:
+            with second, second.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM Temperaturi WHERE id = %s"
+                    " AND timestamp = %s;", (id_b, ts_b)
+                )
+                rollup.refresh_readings(cursor, [(city_b, ts_b)])
+        except psycopg2.Error as err:
+            errors.append(err)
+
+    with first.cursor() as cursor:
+        cursor.execute(
+            "UPDATE Temperaturi SET valoare = 30 WHERE id = %s"
+            " AND timestamp = %s;", (id_a, ts_a)
+        )
+        rollup.refresh_readings(cursor, [(city_a, ts_a)])
+
+        # the second refresh waits for the country buckets of the first
+        thread = threading.Thread(target=delete_b)
+        thread.start()
+        time.sleep(0.5)
+        assert thread.is_alive()
+    first.commit()
+    thread.join(10)
+
+    first.close()
+    second.close()
+    assert errors == []
+
+    refreshed = rollups(db_params)
+    conn = psycopg2.connect(**db_params)
+    with conn, conn.cursor() as cursor:
+        rollup.rebuild(cursor)
+    conn.close()
+    assert refreshed == rollups(db_params)
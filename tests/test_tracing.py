@@ -0,0 +1,79 @@
+from collections import OrderedDict
+import pytest
+from psycopg2 import extensions
+import queries
+import tracing
+from database import MeteredCursor
+
+
+class FakeConnection:
+    """Connection in a transaction, failing if a plan is requested"""
+
+    def __init__(self, prepared):
+        self.prepared = prepared
+
+    def get_transaction_status(self):
+        return extensions.TRANSACTION_STATUS_INTRANS
+
+    def cursor(self, cursor_factory=None):
+        raise AssertionError("statement run again to get its plan")
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 1
+
+
+def prepared(*names):
+    return OrderedDict(
+        (name, queries._numbered(queries.STATEMENTS[name]))
+        for name in names
+    )
+
+
+def test_notify_is_not_explainable():
+    query = "EXECUTE notify_readings (%s)"
+    assert not tracing.explainable(query, queries.read_only)
+    assert not queries.read_only("notify_readings")
+
+
+def test_writes_are_not_explainable():
+    for name in ("insert_temperatures", "update_reading", "delete_reading",
+                 "insert_city", "delete_country"):
+        assert not tracing.explainable(f"EXECUTE {name} (%s)",
+                                       queries.read_only)
+
+
+def test_reads_are_explainable():
+    assert tracing.explainable("EXECUTE countries", queries.read_only)
+    assert tracing.explainable("EXECUTE page_0123456789abcdef (%s)",
+                               queries.read_only)
+    assert tracing.explainable("SELECT id FROM Tari;")
+    assert not tracing.explainable("EXECUTE countries")
+
+
+def test_slow_notify_is_never_explained(monkeypatch):
+    monkeypatch.setattr(tracing, "SLOW_QUERY_MS", 1.0)
+    logged = []
+    monkeypatch.setattr(tracing, "log_slow",
+                        lambda *args: logged.append(args))
+
+    cursor = FakeCursor(FakeConnection(prepared("notify_readings")))
+    MeteredCursor._trace(
+        cursor, "notify_readings", "EXECUTE notify_readings (%s)",
+        (["{}"],), 0.0, 5.0, False
+    )
+    # logged, without an analyzed plan
+    assert len(logged) == 1
+    assert logged[0][0] == "notify_readings"
+    assert logged[0][-1] is None
+
+
+def test_slow_read_is_explained(monkeypatch):
+    monkeypatch.setattr(tracing, "SLOW_QUERY_MS", 1.0)
+
+    cursor = FakeCursor(FakeConnection(prepared("countries")))
+    with pytest.raises(AssertionError):
+        MeteredCursor._trace(cursor, "countries", "EXECUTE countries", None,
+                             0.0, 5.0, False)
@@ -0,0 +1,180 @@
+"""
+SQL statements issued by each request and the slow query log
+
+Every statement run through the database cursors is reported here with
+its duration. When the client of the request asked for a trace (with
+SQL_TRACE_ENABLED=1, by the X-SQL-Trace: 1 header or the trace=1 URL
+param) the statements are collected and sent back in the X-SQL-Trace
+response header. Statements slower than SLOW_QUERY_MS are written to a
+rotating log with one JSON object per line, the read ones with their
+plan (they are run again with EXPLAIN (ANALYZE, BUFFERS)).
+"""
+import json
+import logging
+import re
+import sys
+import time
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from os import getenv
+
+TRACE_ENABLED = getenv("SQL_TRACE_ENABLED", "0") == "1"
+TRACE_HEADER = "X-SQL-Trace"
+TRACE_PARAM = "trace"
+
+# statements slower than this are logged with their plan (0 = never)
+SLOW_QUERY_MS = float(getenv("SLOW_QUERY_MS", "0"))
+# log file ("-" = standard error) and its rotation
+SLOW_QUERY_LOG = getenv("SLOW_QUERY_LOG", "slow_queries.log")
+SLOW_QUERY_LOG_BYTES = int(
+    getenv("SLOW_QUERY_LOG_BYTES", str(10 * 1024 * 1024))
+)
+SLOW_QUERY_LOG_BACKUPS = int(getenv("SLOW_QUERY_LOG_BACKUPS", "5"))
+
+EXPLAIN = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+
+_EXECUTE = re.compile(r"\s*EXECUTE\s+(\w+)", re.IGNORECASE)
+
+_current = ContextVar("sql_trace", default=None)
+_logger = None
+
+
+class Trace:
+    """
+    Statements of one request
+
+    Parameters
+    ----------
+    path: str
+        URL path of the request, written to the slow query log
+
+    traced: bool
+        True = every statement is kept for the X-SQL-Trace header
+    """
+
+    __slots__ = ("path", "started", "entries")
+
+    def __init__(self, path, traced):
+        self.path = path
+        self.started = time.perf_counter()
+        self.entries = [] if traced else None
+
+
+def requested(headers, args):
+    """True when the client asked for the trace of its request"""
+
+    return TRACE_ENABLED and (
+        headers.get(TRACE_HEADER) == "1" or args.get(TRACE_PARAM) == "1"
+    )
+
+def begin(path, traced):
+    """Start collecting the statements of the current request"""
+
+    _current.set(Trace(path, traced))
+
+def end():
+    """Stop collecting, returning the trace of the finished request"""
+
+    trace = _current.get()
+    _current.set(None)
+    return trace
+
+def active():
+    """True when the statements of the current request are collected"""
+
+    trace = _current.get()
+    return trace is not None and trace.entries is not None
+
+def is_slow(seconds):
+    """True for statements which deserve a slow query log entry"""
+
+    return SLOW_QUERY_MS > 0 and seconds * 1000 >= SLOW_QUERY_MS
+
+def source(query, prepared):
+    """
+    Text of a statement: the SQL of the prepared statement it executes
+    (`prepared` maps statement names to their SQL) or itself
+    """
+
+    if isinstance(query, bytes):
+        query = query.decode(errors="replace")
+
+    match = _EXECUTE.match(query)
+    if match and match.group(1) in prepared:
+        return prepared[match.group(1)]
+    return query
+
+def explainable(query, read_only=None):
+    """
+    Only statements without side effects can safely be run again to get
+    their plan: SELECT statements and the prepared statements accepted by
+    `read_only` (a predicate on their name, see queries.read_only)
+    """
+
+    if isinstance(query, bytes):
+        query = query.decode(errors="replace")
+
+    match = _EXECUTE.match(query)
+    if match:
+        return read_only is not None and read_only(match.group(1))
+    return query.lstrip()[:6].upper() == "SELECT"
+
+def record(statement, sql, params, started, seconds, rows):
+    """Add a statement to the trace of the current request (if kept)"""
+
+    trace = _current.get()
+    if trace is None or trace.entries is None:
+        return
+
+    trace.entries.append({
+        "statement": statement,
+        "sql": sql,
+        "params": params,
+        "offset_ms": round((started - trace.started) * 1000, 3),
+        "ms": round(seconds * 1000, 3),
+        "rows": rows
+    })
+
+def _get_logger():
+    global _logger
+
+    if _logger is None:
+        logger = logging.getLogger("slow_queries")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        if SLOW_QUERY_LOG == "-":
+            handler = logging.StreamHandler(sys.stderr)
+        else:
+            handler = RotatingFileHandler(
+                SLOW_QUERY_LOG,
+                maxBytes=SLOW_QUERY_LOG_BYTES,
+                backupCount=SLOW_QUERY_LOG_BACKUPS,
+                delay=True
+            )
+        logger.addHandler(handler)
+        _logger = logger
+
+    return _logger
+
+def log_slow(statement, sql, params, seconds, rows, plan):
+    """
+    Write a slow statement and its plan (None for a statement which
+    couldn't be run again) to the slow query log
+    """
+
+    trace = _current.get()
+    _get_logger().info(json.dumps({
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "path": trace.path if trace else None,
+        "statement": statement,
+        "ms": round(seconds * 1000, 3),
+        "rows": rows,
+        "sql": sql,
+        "params": params,
+        "plan": plan
+    }, default=str))
+
+def header(trace):
+    """Value of the X-SQL-Trace response header"""
+
+    return json.dumps(trace.entries, default=str)
@@ -0,0 +1,290 @@
+"""
+In-memory columnar copy of the temperature readings, per city
+
+Used by the synchronous server (main.py) only, asgi.py always reads the
+readings from the database.
+"""
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from os import getenv
+
+EPOCH = datetime(1970, 1, 1)
+MICROS_PER_DAY = 86400 * 1000000
+
+_FLOAT32 = struct.Struct("f")
+
+
+def to_micros(timestamp):
+    """Microseconds since the epoch of a (naive) timestamp"""
+
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+
+def real_value(value):
+    """
+    Shortest decimal form of a float32, as PostgreSQL prints REAL values
+    (e.g. 21.3 instead of 21.299999237060547)
+    """
+
+    for digits in range(6, 10):
+        res = float(f"{value:.{digits}g}")
+        if _FLOAT32.unpack(_FLOAT32.pack(res))[0] == value:
+            return res
+    return value
+
+
+class Series:
+    """
+    Readings of one city as parallel arrays sorted by (timestamp, id)
+
+    16 bytes per reading: timestamp (int64 microseconds), id (int32) and
+    value (float32, the REAL column type).
+    """
+
+    __slots__ = ("times", "ids", "values")
+
+    def __init__(self):
+        self.times = array("q")
+        self.ids = array("i")
+        self.values = array("f")
+
+    def _find(self, micros, reading_id):
+        """Position of a reading, -1 if missing"""
+
+        pos = bisect_left(self.times, micros)
+        while pos < len(self.times) and self.times[pos] == micros:
+            if self.ids[pos] == reading_id:
+                return pos
+            pos += 1
+        return -1
+
+    def add(self, micros, reading_id, value):
+        """Insert a reading at its place (unless already there)"""
+
+        if self._find(micros, reading_id) >= 0:
+            return
+
+        pos = bisect_right(self.times, micros)
+        while (pos > 0 and self.times[pos - 1] == micros
+               and self.ids[pos - 1] > reading_id):
+            pos -= 1
+        self.times.insert(pos, micros)
+        self.ids.insert(pos, reading_id)
+        self.values.insert(pos, value)
+
+    def remove(self, micros, reading_id):
+        """Delete a reading (if present)"""
+
+        pos = self._find(micros, reading_id)
+        if pos >= 0:
+            del self.times[pos]
+            del self.ids[pos]
+            del self.values[pos]
+
+    def range(self, start, end):
+        """Copies of the arrays restricted to start <= time <= end"""
+
+        lo = 0 if start is None else bisect_left(self.times, start)
+        hi = len(self.times) if end is None else bisect_right(self.times, end)
+        return self.times[lo:hi], self.ids[lo:hi], self.values[lo:hi]
+
+
+class TimeSeriesStore:
+    """
+    Temperature readings of every city held in memory as `Series`
+
+    The store is loaded from a snapshot of Temperaturi on first use and
+    the write handlers keep it up to date after each commit (the
+    database stays the system of record). Writes done by other processes
+    are only seen after the next snapshot, taken once the current one is
+    `max_age` seconds old (0 = never), so the store is meant for single
+    process deployments or reads which tolerate that delay.
+
+    Parameters
+    ----------
+    enabled: bool
+        False = the store is never used
+
+    max_age: float
+        seconds after which a new snapshot is loaded, 0 = never
+    """
+
+    def __init__(self, enabled, max_age):
+        self.enabled = enabled
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._series = None   # city id -> Series
+        self._loaded_at = 0.0
+        self._pending = None  # writes made while a snapshot is loading
+        self._days = {}       # day number -> "YYYY-MM-DD"
+        self._reals = {}      # float32 value -> shortest REAL form
+
+    def invalidate(self):
+        """Load a new snapshot on next use"""
+
+        self._series = None
+
+    @property
+    def stale(self):
+        """True when a (new) snapshot must be loaded before reading"""
+
+        if self._series is None:
+            return True
+        return (self.max_age > 0
+                and time.monotonic() - self._loaded_at >= self.max_age)
+
+    def load(self, conn):
+        """
+        Load a snapshot of Temperaturi, streamed through a server-side
+        cursor of `conn` (psycopg2 connection)
+        """
+
+        with self._load_lock:
+            if not self.stale:
+                return
+
+            with self._lock:
+                self._pending = []
+
+            loaded_at = time.monotonic()
+            series = {}
+            with conn.cursor(name="tsstore_load") as cursor:
+                cursor.itersize = 20000
+                cursor.execute(
+                    "SELECT idOras, (EXTRACT(EPOCH FROM timestamp)"
+                    " * 1000000)::bigint, id, valoare FROM Temperaturi"
+                    " WHERE idOras IS NOT NULL"
+                    " ORDER BY idOras, timestamp, id;"
+                )
+                current_id, current = None, None
+                for city_id, micros, reading_id, value in cursor:
+                    if city_id != current_id:
+                        current_id, current = city_id, Series()
+                        series[city_id] = current
+                    current.times.append(micros)
+                    current.ids.append(reading_id)
+                    current.values.append(value)
+
+            with self._lock:
+                # replay the local writes which raced with the snapshot
+                pending, self._pending = self._pending, None
+                self._series = series
+                self._loaded_at = loaded_at
+                for method, args in pending:
+                    method(*args)
+
+    def _write(self, method, *args):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((method, args))
+            if self._series is not None:
+                method(*args)
+
+    def _add(self, city_id, micros, reading_id, value):
+        self._series.setdefault(city_id, Series()).add(
+            micros, reading_id, value
+        )
+
+    def _remove(self, city_id, micros, reading_id):
+        series = self._series.get(city_id)
+        if series is not None:
+            series.remove(micros, reading_id)
+
+    def _remove_city(self, city_id):
+        self._series.pop(city_id, None)
+
+    def add(self, city_id, reading_id, timestamp, value):
+        """Record a committed new reading"""
+
+        self._write(self._add, city_id, to_micros(timestamp), reading_id,
+                    value)
+
+    def remove(self, city_id, reading_id, timestamp):
+        """Forget a committed deleted reading"""
+
+        self._write(self._remove, city_id, to_micros(timestamp), reading_id)
+
+    def update(self, reading_id, timestamp, old_city_id, city_id, value):
+        """Record a committed change of a reading's city and value"""
+
+        micros = to_micros(timestamp)
+        self._write(self._remove, old_city_id, micros, reading_id)
+        self._write(self._add, city_id, micros, reading_id, value)
+
+    def remove_city(self, city_id):
+        """Forget the readings of a deleted city (ON DELETE CASCADE)"""
+
+        self._write(self._remove_city, city_id)
+
+    def _day(self, micros):
+        day = micros // MICROS_PER_DAY
+        text = self._days.get(day)
+        if text is None:
+            text = (EPOCH + timedelta(days=day)).strftime("%Y-%m-%d")
+            self._days[day] = text
+        return text
+
+    def _real(self, value):
+        res = self._reals.get(value)
+        if res is None:
+            if len(self._reals) > 65536:
+                self._reals.clear()
+            res = self._reals[value] = real_value(value)
+        return res
+
+    def records(self, city_ids, start=None, end=None):
+        """
+        Readings of some cities taken between `start` and `end`
+        (inclusive, None = unbounded), as the JSON records of the
+        temperature listings, in time order per city
+
+        Parameters
+        ----------
+        city_ids: Iterable[int]
+            cities whose readings are returned
+
+        start: datetime
+            earliest timestamp
+
+        end: datetime
+            latest timestamp
+
+        Returns
+        -------
+            res: List[Dict[str, Any]]
+                {"id", "valoare", "timestamp"} records, None if no
+                snapshot is loaded
+        """
+
+        start = None if start is None else to_micros(start)
+        end = None if end is None else to_micros(end)
+
+        parts = []
+        with self._lock:
+            series = self._series
+            if series is None:
+                return None
+            for city_id in city_ids:
+                elem = series.get(city_id)
+                if elem is not None:
+                    parts.append(elem.range(start, end))
+
+        day, real = self._day, self._real
+        return [
+            {"id": reading_id, "valoare": real(value),
+             "timestamp": day(micros)}
+            for times, ids, values in parts
+            for micros, reading_id, value in zip(times, ids, values)
+        ]
+
+
+ts_store = TimeSeriesStore(
+    enabled=getenv("TSSTORE_ENABLED", "0") == "1",
+    max_age=float(getenv("TSSTORE_MAX_AGE", "300"))
+)